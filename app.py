@@ -1,62 +1,254 @@
+import time
+_import_started = time.perf_counter()
+
+import heapq
 import os
+import weakref
+import click
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from itertools import chain
 import sqlalchemy
-from flask import Flask, render_template, request, jsonify, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (Blueprint, Flask, Response, abort, current_app, render_template, request, jsonify, flash, redirect,
+                   g, stream_with_context)
+from jinja2 import FileSystemBytecodeCache
 from sqlalchemy.exc import IntegrityError
-import requests 
+from sqlalchemy.orm import joinedload, selectinload
 from json import JSONDecodeError
 try:
     from secret import SECRET_KEY
 except:
     SECRET_KEY = os.environ.get('SECRET_KEY')
-from forms import UserAddForm, UserEditForm, TrainingForm, LoginForm, SearchRacesForm
+from forms import UserAddForm, UserEditForm, TrainingForm, LoginForm, SearchRacesForm, WORKOUTS
 from models import db, connect_db, User, Training, Race, User_Race
+from race_cache import race_cache
+from runsignup import runsignup, UpstreamError
+from race_sync import catalog_ready, sync_races, run_forever, parse_date, race_from_listing
+from pagination import (EMPTY_PAGE, Position, cursor_after, decode_merge_cursor, encode_merge_cursor,
+                        paginate)
+from passwords import passwords, HashingBusy
+from identity import CURR_USER_KEY, current_user, remember, forget
+from training_stats import training_totals, rebuild_totals, rebuild_weekly, weekly_mileage
+from training_import import FORMATS, TrainingImportError, format_for, import_trainings
+import training_export
+from page_cache import page_cache, cached_page, touch
+from fragment_cache import fragment_cache, race_items
+from metrics import metrics, timed, timing
+from query_budget import query_budget
+from loading import load_plan
 # os.getenv()
 
-CURR_USER_KEY = "curr_user"
+# seconds spent importing this module's dependencies, reported with create_app's own time
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+RACES_PER_PAGE = 50
+UPSTREAM_DOWN = 'Race listings are temporarily unavailable, results may be out of date.'
+
+bp = Blueprint('main', __name__, cli_group=None)
+
+
+# engines of every app built in this process, whose pools forked children drop
+_engines = weakref.WeakSet()
+
+
+def _dispose_engines():
+    for engine in list(_engines):
+        engine.dispose(close=False)
+
+
+# once per process, however many apps get built, even if this module is reloaded
+if not globals().get('_fork_hook'):
+    os.register_at_fork(after_in_child=_dispose_engines)
+    _fork_hook = True
+
+
+def create_app(config=None):
+    """Builds the app. config (a dict) overrides the defaults read from the environment.
 
-app = Flask(__name__)
-app.app_context().push()
+    Nothing here connects to Postgres, so gunicorn can preload it in the
+    master and fork workers cheaply (see gunicorn.conf.py). The debug toolbar
+    is only imported when enabled, which by default means debug mode."""
 
-# app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///runners_vision'
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    started = time.perf_counter()
+    app = Flask(__name__)
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    # app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///runners_vision'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
 
-app.config['SECRET_KEY'] = SECRET_KEY
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['DEBUG_TB_ENABLED'] = app.debug
+    app.config['RACE_SEARCH_MIN_RESULTS'] = int(os.environ.get('RACE_SEARCH_MIN_RESULTS', 5))
+    app.config['RACE_SEARCH_PAGES'] = int(os.environ.get('RACE_SEARCH_PAGES', 2))
 
-toolbar = DebugToolbarExtension(app)
+    app.config['SECRET_KEY'] = SECRET_KEY
+    # compiled templates persist across restarts, so cold workers skip recompiling them; None is jinja's per-user temp dir
+    app.config['JINJA_BYTECODE_CACHE_DIR'] = os.environ.get('JINJA_BYTECODE_CACHE_DIR')
+    app.config.update(config or {})
+
+    if app.config['JINJA_BYTECODE_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE_DIR'])
+
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    # first, so its request hooks run around everyone else's
+    metrics.init_app(app)
+    connect_db(app)
+    race_cache.init_app(app)
+    page_cache.init_app(app)
+    fragment_cache.init_app(app)
+    runsignup.init_app(app)
+    passwords.init_app(app)
+
+    app.register_blueprint(bp)
+
+    # pooled connections must not be shared with forked children
+    with app.app_context():
+        _engines.update(db.engines.values())
+
+    app.config['STARTUP'] = {'import_ms': round(IMPORT_SECONDS * 1000, 1),
+                             'create_app_ms': round((time.perf_counter() - started) * 1000, 1)}
+    app.logger.info('app ready: %s', app.config['STARTUP'])
+
+    return app
+
+
+def __getattr__(name):
+    # `from app import app` (tests, scripts, `flask --app app`) gets an app built on first
+    # use, with an app context pushed for the whole process as before. Servers should call
+    # create_app() instead.
+    global app
+    if name == 'app':
+        app = create_app()
+        app.app_context().push()
+        return app
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-connect_db(app)
 
 ###################################################################################################
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global. The user row is only loaded if a view needs it."""
+
+    g.user = current_user()
 
-    if CURR_USER_KEY in session:
-        g.user = db.session.execute(db.select(User).filter_by(id=(session[CURR_USER_KEY]))).scalar()
 
+@bp.app_errorhandler(HashingBusy)
+def hashing_busy(e):
+    """Password pool is saturated: shed the request rather than queue it"""
+
+    flash('Too many sign-ins right now, please try again in a moment.', 'warning')
+
+    return render_template('busy.html'), 503, {'Retry-After': '2'}
+
+
+def get_races(params):
+    """Race listing for params, served from the shared cache when possible.
+
+    If RunSignup is down, falls back to whatever the cache last held for the
+    query (or no races) instead of failing the request."""
+
+    try:
+        return race_cache.get_or_fetch(params, timed('upstream', runsignup.races))
+    except UpstreamError:
+        flash(UPSTREAM_DOWN, 'warning')
+        return race_cache.peek(params) or {'races': []}
+
+
+@bp.cli.command('race-cache-stats')
+def race_cache_stats():
+    """Print race cache hit/miss counts"""
+
+    for k, v in race_cache.stats().items():
+        print(f'{k}: {v}')
+
+
+@bp.cli.command('sync-races')
+@click.option('--loop', is_flag=True, help='Keep syncing every --interval seconds.')
+@click.option('--interval', default=900, show_default=True)
+def sync_races_command(loop, interval):
+    """Sync the RunSignup race catalog into the races table"""
+
+    if loop:
+        run_forever(interval)
     else:
-        g.user = None
+        print(f'synced {sync_races()} races')
+
+
+@bp.cli.command('rebuild-training-stats')
+def rebuild_training_stats():
+    """Recompute training rollups from the trainings table"""
+
+    rebuild_totals()
+    rebuild_weekly()
+    db.session.commit()
+    print('training totals and weekly mileage rebuilt')
+
+
+@bp.cli.command('import-trainings')
+@click.argument('users_races_id', type=int)
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format_', type=click.Choice(FORMATS), help='Defaults to the file extension.')
+def import_trainings_command(users_races_id, path, format_):
+    """Bulk import a CSV or NDJSON file of trainings into one of a user's races"""
+
+    format_ = format_ or format_for(path)
+    if format_ is None:
+        raise click.UsageError('cannot tell the format from the file name, pass --format')
+    if db.session.get(User_Race, users_races_id) is None:
+        raise click.UsageError(f'no users_races row {users_races_id}')
+
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        try:
+            count = import_trainings(users_races_id, f, format_)
+        except TrainingImportError as e:
+            db.session.rollback()
+            raise click.ClickException(str(e))
+    db.session.commit()
+    print(f'imported {count} trainings in {time.perf_counter() - started:.2f}s')
+
+
+@bp.route('/api/stats')
+@query_budget(2)
+def show_stats():
+    """Startup times, race cache counters, race fragment cache and RunSignup latency for this worker"""
+
+    return jsonify(pid=os.getpid(), startup=current_app.config['STARTUP'], race_cache=race_cache.stats(),
+                   fragment_cache=fragment_cache.stats(), runsignup=runsignup.stats())
+
+
+@bp.route('/metrics')
+@query_budget(0)
+def show_metrics():
+    """Per-route latency, SQL, RunSignup and template histograms of every worker, in Prometheus text format"""
+
+    if not metrics.enabled:
+        abort(404)
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 def do_login(user):
     """Log in user."""
 
-    session[CURR_USER_KEY] = user.id
+    remember(user)
 
 
 def do_logout():
     """Logout user."""
 
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
+    forget()
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
+@query_budget(3)
 def signup():
     """Handle user signup.
 
@@ -94,7 +286,8 @@ def signup():
         return render_template('signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
+@query_budget(3)
 def login():
     """Handle user login."""
 
@@ -105,6 +298,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # keep a rehashed password
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -114,7 +309,8 @@ def login():
     return render_template('login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
+@query_budget(0)
 def logout():
     """Handle logout of user."""
 
@@ -125,121 +321,252 @@ def logout():
 ########################################################################################################
 # homepage and race search
 
-@app.route('/')
+@bp.route('/')
+@query_budget(1)
 def homepage():
     """display homepage with login/signup options"""
     return redirect('/races')
 
-@app.route('/races')
-def show_all_races():
-    """Calls api and shows the 50 races coming up next by default"""
-    
+ALL_RACES = {'format': 'json', 'sort': 'end_date ASC', 'event_type': 'running_race'}
+LISTING_FIELDS = {'race': 'race', 'name': 'name', 'date': 'next_date', 'address': 'address',
+                  'city': 'city', 'state': 'state', 'link': 'url', 'description': 'description'}
+
+
+def render_races(races, **context):
+    """show.html for races in RunSignup listing shape, assembled from cached per-race fragments"""
+
     user_id = g.user.id if g.user else 0
+    with timing('template'):
+        items = race_items(current_app.jinja_env, races, user_id, LISTING_FIELDS)
 
-    resp = requests.get('https://runsignup.com/rest/races', params={'format': 'json', 'sort': 'end_date ASC', 'event_type': 'running_race'})
-    data = resp.json()
-    races = data['races']
-    race = 'race'
-    name = 'name'
-    date = 'next_date'
-    address = 'address'
-    city = 'city'
-    state = 'state'
-    link = 'url'
-    description = 'description'
- 
-   
-    return render_template('show.html', data=data, races=races, race=race, name=name, date=date, address=address, city=city, state=state, link=link, description=description, user_id=user_id)
+    return render_template('show.html', race_items=items, user_id=user_id, **context)
+
+
+def race_listings(page):
+    """Page items in RunSignup listing shape"""
+
+    return [row.as_listing() if isinstance(row, Race) else user_race_listing(row) for _, row in page.items]
+
+
+@bp.route('/races')
+@query_budget(2)
+def show_all_races():
+    """Shows the races coming up next, 50 per page, from the synced catalog"""
+
+    next_cursor = prev_cursor = None
+
+    if catalog_ready():
+        page = paginate([Race.search_query(event_type='running_race')], request.args.get('cursor'), RACES_PER_PAGE)
+        races = race_listings(page)
+        next_cursor, prev_cursor = page.next, page.prev
+    else:
+        races = get_races(ALL_RACES)['races']
+
+    return render_races(races, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+def user_race_listing(row):
+    """race on a user's vision board in RunSignup listing shape, linking to the user"""
+
+    return {'race': { 
+                'name': row.name,
+                'address': {
+                    'city': row.city,
+                    'state': row.state
+                },
+                'next_date': row.start_date,
+                'sort_date': row.next_date,
+                'url': f'/user/{row.user_id}',
+                'url_name': row.username}}
+
+
+SearchPlan = namedtuple('SearchPlan', 'streams search_catalog local_catalog upstream event_types')
+
+
+def plan_search(form, ready):
+    """Local result streams for a validated SearchRacesForm, plus the RunSignup params to top them up with.
+
+    ready is whether the catalog has been synced."""
+
+    un = form.username.data
+    filters = {k: v for k, v in {'name': form.name.data,
+                                 'start_date': form.start_date.data,
+                                 'city': form.city.data,
+                                 'state': form.state.data,
+                                 'max_distance': form.max_distance.data}.items() if v}
+    if filters.get('max_distance') and form.distance_units.data:
+        filters['distance_units'] = form.distance_units.data
+    search_catalog = bool(filters) or not un
+    local_catalog = search_catalog and ready and not filters.get('max_distance')
+    event_types = form.event_types.data or ['running_race']
+
+    streams = []
+    if local_catalog:
+        streams.append(Race.search_query(event_type=event_types, **filters))
+    if un:
+        streams.append(User.public_races_query(un))
+
+    upstream = {'format': 'json', 'sort': 'date ASC', **filters}
+
+    return SearchPlan(streams, search_catalog, local_catalog, upstream, event_types)
+
+
+def catalog_count(plan, page):
+    return sum(1 for s, _ in page.items if plan.local_catalog and s == 0)
+
+
+def needs_upstream(plan, page, cursor):
+    """Whether to top up a first page that has too few catalog races with RunSignup results"""
+
+    return (plan.search_catalog and not cursor
+            and catalog_count(plan, page) < current_app.config['RACE_SEARCH_MIN_RESULTS'])
+
+
+def upstream_calls(plan):
+    """RunSignup params for the first RACE_SEARCH_PAGES result pages of every selected event type"""
 
+    return [{**plan.upstream, 'event_type': t, 'results_per_page': RACES_PER_PAGE, 'page': p}
+            for t in plan.event_types for p in range(1, current_app.config['RACE_SEARCH_PAGES'] + 1)]
 
-@app.route('/races/search', methods = ['GET', 'POST'])
+
+def upstream_results(calls, results):
+    """Listings per call; calls that failed (None) get the cache's last copy, or no races"""
+
+    if any(r is None for r in results):
+        flash(UPSTREAM_DOWN, 'warning')
+
+    return [r if r is not None else race_cache.peek(params) or {'races': []} for params, r in zip(calls, results)]
+
+
+def fetch_upstream(calls):
+    """Fetches every call at once on threads, all under one deadline"""
+
+    deadline = runsignup.deadline()
+
+    def fetch(params):
+        # also used for background refreshes of stale entries, which outlive this request
+        return runsignup.races(params, deadline if time.monotonic() < deadline else None)
+
+    def call(params):
+        try:
+            return race_cache.get_or_fetch(params, fetch)
+        except UpstreamError:
+            return None
+
+    with timing('upstream'), ThreadPoolExecutor(len(calls)) as pool:
+        results = list(pool.map(call, calls))
+
+    return upstream_results(calls, results)
+
+
+def listing_date(listing):
+    race = listing['race']
+
+    return race.get('sort_date') or parse_date(race.get('next_date')) or date.max
+
+
+def merge_page(plan, page, calls, results, position, trail):
+    """Up to RACES_PER_PAGE races from position on, with the next and previous cursors.
+
+    Catalog races and each event type's pages are already in date order, so
+    they are k-way merged; races on users' vision boards follow once the
+    listings run out, as they follow the catalog on unmerged pages. A race
+    seen earlier, locally or under another event type, is skipped. The next
+    cursor records how far the local streams and every event type got."""
+
+    lists = {}
+    for params, data in zip(calls, results):
+        lists.setdefault(params['event_type'], []).extend(data['races'])
+
+    local = race_listings(page)
+    catalog = catalog_count(plan, page)
+    offsets = {t: position.offsets.get(t, 0) for t in lists}
+    seen = {listing['race'].get('race_id') for t, listings in lists.items() for listing in listings[:offsets[t]]}
+    seen.discard(None)
+
+    runs = [[(listing, None, i) for i, listing in enumerate(local[:catalog])]]
+    runs += [[(listing, t, i) for i, listing in enumerate(listings) if i >= offsets[t]]
+             for t, listings in lists.items()]
+    merged = chain(heapq.merge(*runs, key=lambda item: listing_date(item[0])),
+                   [(listing, None, i) for i, listing in enumerate(local) if i >= catalog])
+    races, used = [], 0
+    for listing, t, i in merged:
+        if len(races) == RACES_PER_PAGE:
+            break
+        if t is None:
+            used = i + 1
+        else:
+            offsets[t] = i + 1
+        race_id = listing['race'].get('race_id')
+        if race_id is not None:
+            if race_id in seen:
+                continue
+            seen.add(race_id)
+        races.append(listing)
+
+    if used == len(local):
+        after = Position(page.next, page.next is None, offsets)
+    else:
+        after = Position(cursor_after(page, used - 1) if used else position.cursor, False, offsets)
+    more = not after.done or any(offsets[t] < len(listings) for t, listings in lists.items())
+
+    return (races,
+            encode_merge_cursor(after, [*trail, position]) if more else None,
+            encode_merge_cursor(trail[-1], trail[:-1]) if trail else None)
+
+
+def merge_start(plan):
+    """Position of the first merged page"""
+
+    return Position(None, False, {t: 0 for t in plan.event_types})
+
+
+def search_results(form, races, next_cursor, prev_cursor):
+    if not races:
+        flash('There are no races matching the criteria', 'error')
+        return render_template('search.html', form=form)
+
+    return render_races(races, form=form, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+@bp.route('/races/search', methods = ['GET', 'POST'])
+@query_budget(4)
 def search_races():
-    """Renders form and calls api with form info"""
+    """Renders form and searches races with form info.
+
+    Catalog filters are answered from the synced races table's search indexes,
+    followed by races on matching users' vision boards, paged with a cursor.
+    RunSignup is only called for the first page: before the first sync, for
+    distance filters, which the catalog doesn't carry, or when too few local
+    races match. Then the first pages of every selected event type are
+    fetched concurrently and merged with the local races by date,
+    RACES_PER_PAGE at a time; later pages merge from the cached listings."""
     
     form = SearchRacesForm()
-    search = {'format': 'json', 'sort': 'date ASC', 'event_type': 'running_race'}
-    u_r = []
-    races = []
-    race = 'race'
-    
-    date = 'next_date'
-    address = 'address'
-    city = 'city'
-    state = 'state'
-    link = 'url'
-    
-    description = 'description'
-    user_id = g.user.id if g.user else 0
     if form.validate_on_submit():
-        un = form.username.data
-        if un:
-            db_u = db.session.execute(db.select(User).filter(User.username.like(f'%{un}%'))).all()
-            if db_u:
-                for u in db_u:
-                    for r in u[0].races:
-                        if u[0].is_public:
-                            ra = {'race': { 
-                                    'name': r.name,
-                                    'address': {
-                                        'city': r.city,
-                                        'state': r.state
-                                    },
-                                    'next_date': r.start_date,
-                                    'url': f'/user/{u[0].id}',
-                                    'url_name': u[0].username}}
-                            u_r.append(ra)
-
-        name = form.name.data
-        if name:
-            search.update({'name': name})
-        start_date = form.start_date.data
-        if start_date:
-            search.update({'start_date': start_date})
-        city = form.city.data
-        if city:
-            search.update({'city': city})
-        state = form.state.data
-        if state:
-            search.update({'state': state})
-        max_distance = form.max_distance.data
-        if max_distance:
-            search.update({'max_distance': max_distance})
-        distance_units = form.distance_units.data
-        if distance_units:
-            search.update({'distance_units': distance_units})
-     
-        if len(search) == 4 and not u_r:
-            resp = requests.get('https://runsignup.com/rest/races', params=search)
-    
-            data = resp.json()
-            races = data['races']
-        
-        elif len(search) == 4 and u_r: 
-            for r in u_r:
-                races.append(r)
-        elif len(search) > 4:
-            resp = requests.get('https://runsignup.com/rest/races', params=search)
-    
-            data = resp.json()
-            races = data['races']
-            for r in u_r:
-                races.append(r)
-        
-        if not races:
-            flash('There are no races matching the criteria', 'error')
-            return render_template('search.html', form=form)
+        plan = plan_search(form, catalog_ready())
+        merging = decode_merge_cursor(form.cursor.data)
+        if merging:
+            position, trail = merging
+            page = EMPTY_PAGE if position.done else paginate(plan.streams, position.cursor, RACES_PER_PAGE)
+        else:
+            page = paginate(plan.streams, form.cursor.data, RACES_PER_PAGE)
+            if not needs_upstream(plan, page, form.cursor.data):
+                return search_results(form, race_listings(page), page.next, page.prev)
+            position, trail = merge_start(plan), []
+
+        calls = upstream_calls(plan)
+        return search_results(form, *merge_page(plan, page, calls, fetch_upstream(calls), position, trail))
 
-        
-        return render_template('show.html', races=races, race=race,  date=date, address=address, city=city, state=state, link=link, description=description, user_id=user_id)
-
-       
     return render_template('search.html', form=form)
 
 
 ###################################################################################################
 # user
 
-@app.route('/user/<int:user_id>')
+@bp.route('/user/<int:user_id>')
+@query_budget(4)
+@cached_page
 def user_profile(user_id):
     """Display user profile. Have active race heading a field and race countdown"""
     """Have a spot for completed races. Possibly with medals to indicate completion."""
@@ -249,69 +576,95 @@ def user_profile(user_id):
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    user = db.session.execute(db.select(User).filter_by(id = user_id)).scalar_one()
+    user = db.session.execute(db.select(User).filter_by(id = user_id).options(*load_plan())).scalar_one()
     if not g.user.id == user_id and user.is_public == False:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     
     race = ''
-    u_r = db.session.execute(db.select(User_Race).filter_by(is_active=True, user_id = user.id)).scalar()
+    u_r = db.session.execute(db.select(User_Race).filter_by(is_active=True, user_id = user.id)
+                             .options(*load_plan(joinedload(User_Race.race_info),
+                                                 selectinload(User_Race.trainings)))).scalar()
     if u_r:
-        r = db.session.execute(db.select(Race).filter_by(id = u_r.race_id)).scalar()
-        race = r.name
+        race = u_r.race_info.name
 
     trainings = []
-    total_run_m = 0
-    total_bike_m = 0
-    total_walk_m = 0
+    totals = {}
     if u_r:
         trainings = u_r.trainings
-        for t in trainings:
-            v = t.type
-            if v == 'run' and t.distance:
-                d = float(t.distance)
-                if t.units == 'meters':
-                    d = t.distance / 1609
-                if t.units == 'km':
-                    d = t.distance/1.609
-                total_run_m = total_run_m + d
-            if v == 'bicycle' and t.distance:
-                d = float(t.distance)
-                if t.units == 'meters':
-                    d = t.distance / 1609
-                if t.units == 'km':
-                    d = t.distance/1.609
-                total_bike_m = total_bike_m + d
-            if v == 'walk' and t.distance:
-                d = float(t.distance)
-                if t.units == 'meters':
-                    d = t.distance / 1609
-                if t.units == 'km':
-                    d = t.distance/1.609
-                total_walk_m = total_walk_m + d
-    
-    
+        totals = {k: t.miles for k, t in training_totals(u_r.id).items()}
+
+    return render_template('profile.html', user=user, race=race, trainings=trainings, u_r=u_r, total_r=round(totals.get('run', 0),1), total_b=round(totals.get('bicycle', 0),1), total_w=round(totals.get('walk', 0),1))
+
 
-    return render_template('profile.html', user=user, race=race, trainings=trainings, u_r=u_r, total_r=round(total_run_m,1), total_b=round(total_bike_m,1), total_w=round(total_walk_m,1))
+@bp.route('/api/users/<int:user_id>/weekly')
+@query_budget(2)
+def user_weekly_mileage(user_id):
+    """Weekly training buckets for charts.
 
+    Query args: from and to (YYYY-MM-DD, default the last 12 weeks) and an
+    optional workout type. Weeks without trainings are left out."""
 
-@app.route('/user/delete', methods=['POST'])
+    if not g.user:
+        return jsonify(error='Access unauthorized.'), 401
+    user = db.get_or_404(User, user_id)
+    if not g.user.id == user_id and user.is_public == False:
+        return jsonify(error='Access unauthorized.'), 403
+
+    try:
+        end = date.fromisoformat(request.args['to']) if 'to' in request.args else date.today()
+        start = date.fromisoformat(request.args['from']) if 'from' in request.args else end - timedelta(weeks=11)
+    except ValueError:
+        return jsonify(error='from and to must be YYYY-MM-DD'), 400
+    type = request.args.get('type')
+    if type and type not in WORKOUTS:
+        return jsonify(error=f'type must be one of {", ".join(WORKOUTS)}'), 400
+
+    weeks = weekly_mileage(user_id, start, end, type)
+
+    return jsonify(user_id=user_id, weeks=[w.serialize() for w in weeks])
+
+
+@bp.route('/user/<int:user_id>/trainings/export.<format>')
+@query_budget(2)
+def export_trainings(user_id, format):
+    """Download all of a user's races and trainings as CSV or NDJSON, streamed as it is read"""
+
+    if format not in training_export.FORMATS:
+        abort(404)
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+    user = db.get_or_404(User, user_id)
+    if not g.user.id == user_id and user.is_public == False:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return Response(stream_with_context(training_export.export_chunks(user_id, format)),
+                    mimetype=training_export.FORMATS[format],
+                    headers={'Content-Disposition': f'attachment; filename={user.username}-trainings.{format}'})
+
+
+@bp.route('/user/delete', methods=['POST'])
+@query_budget(3)
 def delete_user():
     """Deletes user and all subsequent users_races and trainings from db"""
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
+    user = g.user.row
     do_logout()
 
-    db.session.delete(g.user)
+    db.session.delete(user)
     db.session.commit()
 
     return redirect('/signup')
 
 
-@app.route('/user/edit', methods=['GET', 'POST'])
+@bp.route('/user/edit', methods=['GET', 'POST'])
+@query_budget(5)
 def edit_user():
     """Render edit user form and update user"""
     if not g.user:
@@ -345,6 +698,8 @@ def edit_user():
             g.user.is_public=form.is_public.data
 
             db.session.commit()
+            # username and is_public are carried in the session
+            do_login(g.user.row)
 
             flash(f'{g.user.username} updated', 'success')
             return redirect(f'/user/{g.user.id}')
@@ -358,12 +713,15 @@ def edit_user():
 ######################################################################################################
 # user-races
 
-@app.route('/user/<int:user_id>/races')
+@bp.route('/user/<int:user_id>/races')
+@query_budget(3)
+@cached_page
 def show_user_races(user_id):
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    user = db.session.execute(db.select(User).filter_by(id = user_id)).scalar_one()
+    user = db.session.execute(db.select(User).filter_by(id = user_id)
+                              .options(*load_plan(selectinload(User.races)))).scalar_one()
     if g.user.id != user_id and user.is_public == False:
         flash("Access unauthorized.", "danger")
         return redirect("/")
@@ -378,7 +736,8 @@ def show_user_races(user_id):
     return render_template('user_races.html', user=user, races=races, active=active)
 
 
-@app.route('/races/<int:user_id>/<race_id>/delete', methods=['POST'])
+@bp.route('/races/<int:user_id>/<race_id>/delete', methods=['POST'])
+@query_budget(5)
 def remove_users_race(user_id, race_id):
     """Deletes race from users_races table and user profile along with linked trainings"""
     # maybe make this an inhouse api call instead so their will not have to be any rerouting
@@ -388,85 +747,105 @@ def remove_users_race(user_id, race_id):
 
     u_race = db.session.execute(db.select(User_Race).filter_by(race_id=race_id, user_id=user_id)).scalar_one()
 
+    # trainings and race totals go with it by foreign key cascade
     db.session.delete(u_race)
+    db.session.flush()
+    rebuild_weekly(user_id)
     db.session.commit()
 
     return redirect(f'/user/{user_id}/races')
 
 
-@app.route('/user/<int:user_id>/races/add', methods=['GET', 'POST'])
-def add_race(user_id):
-    """add race to user in db""" 
+def add_race_denied(user_id):
+    """Redirect for a user who may not add races to user_id's board, else None"""
+
     if not g.user or user_id == 0:
         flash("Must be logged in", "danger")
         return redirect("/")
 
-    if g.user:
-        if not g.user.id == user_id:
-            flash('Access unauthorized.', 'danger')
-            return redirect('/')
+    if not g.user.id == user_id:
+        flash('Access unauthorized.', 'danger')
+        return redirect('/')
 
 
-    name = request.form["name"]
-    db_race = db.session.execute(db.select(Race).filter_by(name=name)).scalar()
-    for r in g.user.races:
-        if r.name == name:
-            return redirect('/races')
-    
-    if db_race:
-        g.user.races.append(db_race)
+def race_not_found(name):
+    flash(f'Could not find {name}', 'danger')
+    return redirect('/races')
 
-        db.session.add(g.user)
-        db.session.commit()
 
-        return render_template('activate.html', name = name, user_id=user_id, race_id=db_race.id)
+def posted_race():
+    """Race values from the listing details show.html posts, or None for a post with just a name"""
 
-    resp = requests.get('https://runsignup.com/rest/races', params={'format': 'json', 'name': name})
+    race_id = request.form.get('race_id', type=int)
+    if not race_id:
+        return None
 
-    data = resp.json()
-    race = data['races'][0]['race']
+    return race_from_listing({'race_id': race_id,
+                              'name': request.form['name'],
+                              'address': {'city': request.form.get('city'), 'state': request.form.get('state')},
+                              'next_date': request.form.get('next_date'),
+                              'url': request.form.get('url')})
 
-    name = race['name']
-    city = race['address']['city']
-    state = race['address']['state']
-    start_date = race['next_date']
 
-    race = Race(name=name, city=city, state=state, start_date=start_date)
+def on_board_query(user_id, race_id):
+    return db.select(User_Race.id).filter_by(user_id=user_id, race_id=race_id).limit(1)
 
-    db.session.add(race)
-    db.session.commit()
 
-    g.user.races.append(race)
+@bp.route('/user/<int:user_id>/races/add', methods=['GET', 'POST'])
+@query_budget(6)
+def add_race(user_id):
+    """add race to user in db.
+
+    Races are keyed on their RunSignup id and upserted from the posted
+    listing. Posts with only a name fall back to a name lookup, then to
+    RunSignup's first match.""" 
+    denied = add_race_denied(user_id)
+    if denied:
+        return denied
+
+    values = posted_race()
+    if values:
+        name = values['name']
+        race_id = db.session.execute(Race.upsert_query(values)).scalar_one()
+    else:
+        name = request.form["name"]
+        race_id = db.session.execute(db.select(Race.id).filter_by(name=name).limit(1)).scalar()
+        if race_id is None:
+            data = get_races({'format': 'json', 'name': name})
+            if not data['races']:
+                return race_not_found(name)
+            race_id = db.session.execute(Race.upsert_query(race_from_listing(data['races'][0]['race']))).scalar_one()
+
+    if db.session.execute(on_board_query(user_id, race_id)).scalar():
+        db.session.commit()
+        return redirect('/races')
 
-    db.session.add(g.user)
+    db.session.add(User_Race(user_id=user_id, race_id=race_id))
     db.session.commit()
 
-
-    return render_template('activate.html', name = name, user_id=user_id, race_id=race.id)
+    return render_template('activate.html', name=name, user_id=user_id, race_id=race_id)
      
 
-@app.route('/races/<int:user_id>/<int:race_id>/activate', methods=['POST'])
+@bp.route('/races/<int:user_id>/<int:race_id>/activate', methods=['POST'])
+@query_budget(2)
 def set_active_status(user_id, race_id):
     """sets the newly added race as either active or inactive"""
     if not g.user.id == user_id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    races = g.user.races
-
-    for r in races:
-        r = db.session.execute(db.select(User_Race).filter_by(race_id=r.id, user_id = g.user.id)).scalar_one()
-
-        r.deactivate()
-
-    u_race = db.session.execute(db.select(User_Race).filter_by(race_id=race_id, user_id=user_id)).scalar_one()
-    u_race.is_active = True 
+    if User_Race.activate(user_id, race_id) is None:
+        flash("Race not found on your vision board.", "danger")
+        return redirect(f'/user/{user_id}/races')
+    # a bulk UPDATE, which the page cache's mapper events don't see
+    touch(user_id)
     db.session.commit()
     
     return redirect(f'/user/{user_id}')
 
 
-@app.route('/races/<int:user_id>/<int:race_id>/inactivate', methods=['POST'])
+@bp.route('/races/<int:user_id>/<int:race_id>/inactivate', methods=['POST'])
+@query_budget(2)
 def inactivate_race(user_id, race_id):
     """Sets race in user profile to inactive. Removes all trainings from main profile page along with race"""
 
@@ -477,11 +856,30 @@ def inactivate_race(user_id, race_id):
     r = db.session.execute(db.select(User_Race).filter_by(race_id=race_id, user_id = g.user.id)).scalar_one()
 
     r.deactivate()
+    db.session.commit()
 
     return redirect(f'/user/{user_id}/races')
 
 
-@app.route('/race/<int:users_races_id>/trainings', methods=['GET', 'POST'])
+def add_track(t, form):
+    """Attach the form's GPX upload to training t, taking distance and time from it.
+
+    Returns False with the problem added to the form's errors if the file isn't a usable track."""
+
+    # numpy is only needed here, so workers that never see a GPX upload don't pay for importing it
+    from training_tracks import DEFAULT_TOLERANCE_M, TrackError, attach_track
+
+    try:
+        track = attach_track(t, form.gpx.data.stream, current_app.config.get('GPX_TOLERANCE_M', DEFAULT_TOLERANCE_M))
+    except TrackError as e:
+        form.gpx.errors.append(str(e))
+        return False
+
+    flash(f'Track: {t.distance} {t.units} from {track.point_count} points', 'success')
+    return True
+
+@bp.route('/race/<int:users_races_id>/trainings', methods=['GET', 'POST'])
+@query_budget(7)
 def add_training(users_races_id):
     """Render TrainingForm. Add training to users_races table in db."""
     u_r = db.session.execute(db.select(User_Race).filter_by(id = users_races_id)).scalar_one()
@@ -501,14 +899,51 @@ def add_training(users_races_id):
     
         t = Training(users_races_id=users_races_id, title=title, body=body, time_spent=time_spent, type=type, distance=distance, units=units)
 
+        if form.gpx.data and not add_track(t, form):
+            return render_template('add_training.html', form=form, users_races_id=users_races_id)
+
         db.session.add(t)
         db.session.commit()
 
         return redirect(f'/user/{g.user.id}')
 
-    return render_template('add_training.html', form=form)
+    return render_template('add_training.html', form=form, users_races_id=users_races_id)
 
-@app.route('/trainings/<int:id>/edit', methods=['GET', 'POST'])
+@bp.route('/race/<int:users_races_id>/trainings/import', methods=['POST'])
+@query_budget(6)
+def import_training_file(users_races_id):
+    """Bulk add trainings from an uploaded CSV or NDJSON file, or a raw text/csv or application/x-ndjson body"""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    u_r = db.get_or_404(User_Race, users_races_id)
+    if not g.user.id == u_r.user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    upload = request.files.get('file')
+    if upload:
+        stream, format = upload.stream, format_for(upload.filename, upload.mimetype)
+    else:
+        stream, format = request.stream, format_for(None, request.mimetype)
+    if format is None:
+        flash("Upload a .csv or .ndjson file.", "danger")
+        return redirect(f'/race/{users_races_id}/trainings')
+
+    try:
+        count = import_trainings(users_races_id, stream, format)
+    except TrainingImportError as e:
+        db.session.rollback()
+        flash(f"Nothing imported, {e}", "danger")
+        return redirect(f'/race/{users_races_id}/trainings')
+    db.session.commit()
+
+    flash(f"Imported {count} trainings", "success")
+    return redirect(f'/user/{g.user.id}')
+
+@bp.route('/trainings/<int:id>/edit', methods=['GET', 'POST'])
+@query_budget(11)
 def edit_training(id):
     """Render populated training form and allow to edit"""
     t = db.session.execute(db.select(Training).filter_by(id = id)).scalar_one()
@@ -522,6 +957,10 @@ def edit_training(id):
         t.distance = form.distance.data
         t.units = form.units.data
 
+        if form.gpx.data and not add_track(t, form):
+            db.session.rollback()
+            return render_template('add_training.html', form=form)
+
         db.session.commit()
 
         flash(f'{t.title} updated', "success")
@@ -529,7 +968,8 @@ def edit_training(id):
 
     return render_template('add_training.html', form=form)
 
-@app.route('/trainings/<int:id>/delete', methods=['POST'])
+@bp.route('/trainings/<int:id>/delete', methods=['POST'])
+@query_budget(8)
 def del_training(id):
     """Delete training from database"""
     t = db.session.execute(db.select(Training).filter_by(id = id)).scalar_one()
@@ -0,0 +1,296 @@
+"""ASGI entry point: upstream-bound race views served async, everything else by the Flask app.
+
+/races, /races/search and adding a race spend nearly all their time waiting
+on RunSignup. Here they run as coroutines with the httpx RunSignup client and
+an asyncpg session, so one worker keeps many upstream calls in flight. They
+reuse the Flask app's templates, forms, session cookie, flashes and helpers
+by running inside a Flask request context built from the ASGI scope. Every
+other route goes to the unchanged sync app through asgiref's WsgiToAsgi.
+
+    uvicorn asgi:application --workers 2
+"""
+
+import asyncio
+import io
+import re
+import sys
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import flash, redirect, render_template, request
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app import (create_app, RACES_PER_PAGE, ALL_RACES, UPSTREAM_DOWN, add_race_denied, merge_page, merge_start,
+                 needs_upstream, on_board_query, plan_search, posted_race, race_listings, race_not_found,
+                 render_races, search_results, upstream_calls, upstream_results)
+from forms import SearchRacesForm
+from identity import arefresh_claims
+from models import db, Race, User_Race
+from page_cache import defer_bumps, page_cache, take_bumps
+from pagination import EMPTY_PAGE, apaginate, decode_merge_cursor
+from race_cache import race_cache
+from race_sync import acatalog_ready, race_from_listing
+from runsignup import UpstreamError
+from runsignup_async import async_runsignup
+
+
+class AsyncDB:
+    """asyncpg engine for the app's database, created on first use in each event loop"""
+
+    def __init__(self):
+        self.url = None
+        self.pool_size = 10
+        self._engine = None
+        self._loop = None
+
+    def init_app(self, app):
+        self.url = make_url(app.config['SQLALCHEMY_DATABASE_URI']).set(drivername='postgresql+asyncpg')
+        self.pool_size = app.config.get('ASYNC_DB_POOL_SIZE', self.pool_size)
+        self._engine = None
+
+    @property
+    def engine(self):
+        # asyncpg connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        if self._engine is None or self._loop is not loop:
+            self._engine = create_async_engine(self.url, pool_size=self.pool_size)
+            self._loop = loop
+
+        return self._engine
+
+    def session(self):
+        """New AsyncSession on this loop's engine, leaving page cache bumps to commit()"""
+
+        session = AsyncSession(self.engine, expire_on_commit=False)
+        defer_bumps(session.sync_session)
+
+        return session
+
+    async def dispose(self):
+        if self._engine is not None:
+            await self._engine.dispose()
+            self._engine = None
+
+
+app = create_app()
+async_db = AsyncDB()
+async_db.init_app(app)
+async_runsignup.init_app(app)
+
+
+async def commit(session):
+    """Commits session, then bumps the page cache versions it wrote on a thread, off the loop"""
+
+    await session.commit()
+    user_ids = take_bumps(session.sync_session)
+    if user_ids:
+        await asyncio.to_thread(page_cache.bump, *user_ids)
+
+
+async def aget_races(params):
+    """get_races() awaiting RunSignup instead of blocking on it"""
+
+    try:
+        return await race_cache.aget_or_fetch(params, async_runsignup.races)
+    except UpstreamError:
+        flash(UPSTREAM_DOWN, 'warning')
+        return await asyncio.to_thread(race_cache.peek, params) or {'races': []}
+
+
+async def afetch_upstream(calls):
+    """app.fetch_upstream with the calls gathered on the event loop"""
+
+    deadline = async_runsignup.deadline()
+
+    async def fetch(params):
+        # also used for background refreshes of stale entries, which outlive this request
+        return await async_runsignup.races(params, deadline if time.monotonic() < deadline else None)
+
+    async def call(params):
+        try:
+            return await race_cache.aget_or_fetch(params, fetch)
+        except UpstreamError:
+            return None
+
+    results = await asyncio.gather(*[call(params) for params in calls])
+    # peeks at the race cache for failed calls; to_thread carries the request context over
+    return await asyncio.to_thread(upstream_results, calls, results)
+
+
+async def show_all_races(session):
+    """Async app.show_all_races"""
+
+    next_cursor = prev_cursor = None
+
+    if await acatalog_ready(session):
+        page = await apaginate(session, [Race.search_query(event_type='running_race')],
+                               request.args.get('cursor'), RACES_PER_PAGE)
+        races = race_listings(page)
+        next_cursor, prev_cursor = page.next, page.prev
+    else:
+        races = (await aget_races(ALL_RACES))['races']
+
+    return render_races(races, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+async def search_races(session):
+    """Async app.search_races"""
+
+    form = SearchRacesForm()
+    if form.validate_on_submit():
+        plan = plan_search(form, await acatalog_ready(session))
+        merging = decode_merge_cursor(form.cursor.data)
+        if merging:
+            position, trail = merging
+            page = (EMPTY_PAGE if position.done else
+                    await apaginate(session, plan.streams, position.cursor, RACES_PER_PAGE))
+        else:
+            page = await apaginate(session, plan.streams, form.cursor.data, RACES_PER_PAGE)
+            if not needs_upstream(plan, page, form.cursor.data):
+                return search_results(form, race_listings(page), page.next, page.prev)
+            position, trail = merge_start(plan), []
+
+        calls = upstream_calls(plan)
+        return search_results(form, *merge_page(plan, page, calls, await afetch_upstream(calls), position, trail))
+
+    return render_template('search.html', form=form)
+
+
+async def add_race(session, user_id):
+    """Async app.add_race"""
+
+    denied = add_race_denied(user_id)
+    if denied:
+        return denied
+
+    values = posted_race()
+    if values:
+        name = values['name']
+        race_id = await session.scalar(Race.upsert_query(values))
+    else:
+        name = request.form["name"]
+        race_id = await session.scalar(db.select(Race.id).filter_by(name=name).limit(1))
+        if race_id is None:
+            data = await aget_races({'format': 'json', 'name': name})
+            if not data['races']:
+                return race_not_found(name)
+            race_id = await session.scalar(Race.upsert_query(race_from_listing(data['races'][0]['race'])))
+
+    if await session.scalar(on_board_query(user_id, race_id)):
+        await commit(session)
+        return redirect('/races')
+
+    session.add(User_Race(user_id=user_id, race_id=race_id))
+    await commit(session)
+
+    return render_template('activate.html', name=name, user_id=user_id, race_id=race_id)
+
+
+ROUTES = [
+    (re.compile(r'/races'), {'GET'}, show_all_races),
+    (re.compile(r'/races/search'), {'GET', 'POST'}, search_races),
+    (re.compile(r'/user/(?P<user_id>\d+)/races/add'), {'GET', 'POST'}, add_race),
+]
+
+
+def _wsgi_app(environ, start_response):
+    # a process-wide app context pushed by whoever imported this (tests, scripts) would be
+    # inherited by every task, so give each request its own or they would share g and db.session
+    with app.app_context():
+        return app.wsgi_app(environ, start_response)
+
+
+sync_application = WsgiToAsgi(_wsgi_app)
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def _environ(scope, body):
+    """WSGI environ for an ASGI http scope, as WsgiToAsgi would build it"""
+
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'REMOTE_ADDR': (scope.get('client') or ('',))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        key = {'content-type': 'CONTENT_TYPE', 'content-length': 'CONTENT_LENGTH'}.get(
+            name, 'HTTP_' + name.upper().replace('-', '_'))
+        value = value.decode('latin1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+
+    return environ
+
+
+async def _send_response(response, send):
+    headers = [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in response.headers.items()]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+async def dispatch(view, kwargs, scope, receive, send):
+    """Runs an async view inside a Flask request context, with the app's hooks and error handlers"""
+
+    environ = _environ(scope, await _read_body(receive))
+
+    with app.app_context(), app.request_context(environ):
+        async with async_db.session() as session:
+            try:
+                # before the hooks, or an expired identity would be reloaded with a blocking query
+                await arefresh_claims(session)
+                rv = app.preprocess_request()
+                if rv is None:
+                    rv = await view(session, **kwargs)
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+        response = app.process_response(app.make_response(rv))
+
+    await _send_response(response, send)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_runsignup.aclose()
+            await async_db.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+
+    if scope['type'] == 'http':
+        for pattern, methods, view in ROUTES:
+            match = pattern.fullmatch(scope['path'])
+            if match and scope['method'] in methods:
+                kwargs = {k: int(v) for k, v in match.groupdict().items()}
+                return await dispatch(view, kwargs, scope, receive, send)
+
+    await sync_application(scope, receive, send)
@@ -0,0 +1,66 @@
+"""Login throughput at each bcrypt cost.
+
+Fires a burst of password checks from request-like threads through the
+PasswordHasher's host-wide slots and reports logins/s, latency percentiles and how many
+checks were shed with HashingBusy.
+
+    python benchmarks/bcrypt_throughput.py --rounds 8 10 12 --logins 64 --threads 16
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from passwords import PasswordHasher, HashingBusy  # noqa: E402
+from runsignup import percentile  # noqa: E402
+
+
+def run(rounds, logins, threads, max_pending, path):
+    hasher = PasswordHasher(rounds=rounds, max_pending=max_pending, path=path)
+    hashed = hasher.hash('correct horse battery staple')
+
+    def login(_):
+        started = time.perf_counter()
+        try:
+            hasher.check(hashed, 'correct horse battery staple')
+        except HashingBusy:
+            return None
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as requests:
+        results = list(requests.map(login, range(logins)))
+    elapsed = time.perf_counter() - started
+
+    done = sorted(r * 1000 for r in results if r is not None)
+
+    return {
+        'rounds': rounds,
+        'logins/s': round(len(done) / elapsed, 1),
+        'p50 ms': round(percentile(done, 50), 1) if done else None,
+        'p95 ms': round(percentile(done, 95), 1) if done else None,
+        'shed': len(results) - len(done),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, nargs='+', default=[8, 10, 12])
+    parser.add_argument('--logins', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--max-pending', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    print(f'{args.logins} logins from {args.threads} threads, {args.max_pending} hashing slots')
+    with tempfile.TemporaryDirectory() as tmp:
+        for rounds in args.rounds:
+            print(run(rounds, args.logins, args.threads, args.max_pending, os.path.join(tmp, 'slot')))
+
+
+if __name__ == '__main__':
+    main()
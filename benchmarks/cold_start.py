@@ -0,0 +1,69 @@
+"""Cold-start time of a web worker.
+
+Starts --runs fresh interpreters that import app and call create_app(), and
+reports median and p95 of the import, create_app and total times (what
+app.config['STARTUP'] and /api/stats report). --top lists the slowest
+imports from one `python -X importtime` run.
+
+    DATABASE_URL=postgresql:///runners_vision python benchmarks/cold_start.py --runs 20 --top 15
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from runsignup import percentile  # noqa: E402
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+from app import create_app
+app = create_app()
+print(json.dumps(dict(app.config['STARTUP'], total_ms=round((time.perf_counter() - started) * 1000, 1))))
+"""
+
+
+def probe():
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.splitlines()[-1])
+
+
+def slowest_imports(top):
+    """(cumulative ms, module) of the top slowest imports, by cumulative time"""
+
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT, check=True,
+                         capture_output=True, text=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            rows.append((int(cumulative) / 1000, name.rstrip()))
+
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=0, help='also list the N slowest imports')
+    args = parser.parse_args()
+
+    runs = [probe() for _ in range(args.runs)]
+    for key in ('import_ms', 'create_app_ms', 'total_ms'):
+        values = [r[key] for r in runs]
+        print(f'{key:>14}: median {statistics.median(values):7.1f}  p95 {percentile(sorted(values), 95):7.1f}')
+
+    if args.top:
+        print('\nslowest imports (cumulative ms):')
+        for ms, name in slowest_imports(args.top):
+            print(f'{ms:8.1f}  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+"""Large synthetic dataset for scaling tests.
+
+Bulk-loads users, races, vision boards and trainings into the models.py
+schema with COPY, from --workers processes. Activity is skewed the way real
+sites are: user activity follows a Pareto distribution (a few users log most
+trainings, many log none), race popularity follows Zipf, and each user's
+active race gets most of their trainings.
+
+Every table is cut into fixed-size shards, and each shard draws from its own
+random stream seeded with (--seed, table, shard number). Ids are assigned up
+front, so the same seed, volumes and --anchor date load the same rows
+whatever the number of workers.
+
+The target tables are recreated, loaded without their secondary indexes and
+foreign keys, which are added back afterwards. Training rollups are rebuilt
+and the tables analyzed at the end.
+
+    createdb runners_vision-scale
+    DATABASE_URL=postgresql:///runners_vision-scale python benchmarks/dataset.py \\
+        --users 200000 --races 50000 --trainings 10000000 --workers 8
+
+Every user's password is "scale-password". Like benchmarks/routes.py it only
+drops databases whose name contains "bench", "scale" or "test".
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bcrypt  # noqa: E402
+import numpy as np  # noqa: E402
+import psycopg2  # noqa: E402
+from faker import Faker  # noqa: E402
+from sqlalchemy import inspect  # noqa: E402
+from sqlalchemy.engine import make_url  # noqa: E402
+from sqlalchemy.schema import AddConstraint, CreateIndex, DropIndex  # noqa: E402
+
+from app import create_app  # noqa: E402
+from forms import TYPE  # noqa: E402
+from models import db, User, Race, User_Race, Training, SyncState  # noqa: E402
+from passwords import passwords  # noqa: E402
+from race_sync import SYNC_NAME  # noqa: E402
+from training_import import ESCAPES, NULL  # noqa: E402
+from training_stats import KM_PER_MILE, rebuild_totals, rebuild_weekly  # noqa: E402
+
+PASSWORD = 'scale-password'
+TABLES = {'users': 1, 'races': 2, 'users_races': 3, 'trainings': 4}
+# rows per shard; part of the seed, so changing one changes the dataset
+SHARD = {'users': 10_000, 'races': 10_000, 'users_races': 100_000, 'trainings': 250_000}
+
+USER_COLUMNS = ('id', 'username', 'password', 'first_name', 'last_name', 'bio', 'email', 'is_public', 'created_at',
+                'header_image_url', 'profile_image_url')
+RACE_COLUMNS = ('id', 'name', 'city', 'state', 'info', 'start_date', 'runsignup_id', 'next_date', 'url',
+                'event_type', 'last_modified', 'image_url')
+USERS_RACES_COLUMNS = ('id', 'user_id', 'race_id', 'is_active', 'is_complete')
+TRAINING_COLUMNS = ('id', 'users_races_id', 'title', 'body', 'time_spent', 'type', 'distance', 'units', 'created_at')
+
+RACE_KINDS = ['5K', '10K', 'Half Marathon', 'Marathon', 'Trail Run', 'Fun Run', 'Triathlon', 'Relay']
+TITLES = ['Easy run', 'Long run', 'Tempo', 'Intervals', 'Recovery', 'Hill repeats', 'Fartlek', 'Race pace',
+          'Commute', 'Morning miles', 'Track workout', 'Shakeout']
+BODIES = [NULL] * 7 + ['Felt strong.', 'Legs were heavy today.', 'Windy, kept it easy.',
+                       'Negative split the second half.', 'Hot and humid, walked the hills.']
+# workout mix, and minutes per mile for the ones with a distance (nan = no distance)
+WORKOUT_SHARE = {'run': .62, 'bicycle': .1, 'swim': .05, 'walk': .1, 'weight train': .08, 'cross train': .05}
+PACE = {'run': 9.5, 'bicycle': 3.5, 'swim': 30, 'walk': 18, 'weight train': np.nan, 'cross train': np.nan}
+
+
+def default(column):
+    """COPY text of a column's Python-side default, which COPY doesn't apply"""
+
+    return text(column.default.arg)
+
+
+def rng(seed, table, shard=0):
+    return np.random.default_rng([seed, TABLES[table], shard])
+
+
+def shards(table, total):
+    return [(start, min(start + SHARD[table], total)) for start in range(0, total, SHARD[table])]
+
+
+def text(value):
+    return NULL if value is None else str(value).translate(ESCAPES)
+
+
+def copy(table, columns, lines):
+    """COPYs lines of COPY text into table on this worker's connection"""
+
+    cursor = _conn.cursor()
+    cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', io.StringIO(''.join(lines)))
+    _conn.commit()
+    cursor.close()
+
+
+_conn = None
+
+
+def _connect(url):
+    global _conn
+    args = make_url(url).translate_connect_args(username='user', database='dbname')
+    _conn = psycopg2.connect(**args)
+
+
+def _faker(seed, table, shard):
+    fake = Faker()
+    fake.seed_instance(int(rng(seed, table, shard).integers(2 ** 31)))
+
+    return fake
+
+
+def password_hash(seed, rounds):
+    """bcrypt hash of PASSWORD with a salt drawn from seed, so reruns store the same hash"""
+
+    alphabet = np.array(list('./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'))
+    # the 22nd salt character only carries 2 bits
+    salt = ''.join(rng(seed, 'users', 2 ** 32).choice(alphabet, 21)) + '.'
+
+    return bcrypt.hashpw(PASSWORD.encode(), f'$2b${rounds:02}${salt}'.encode()).decode()
+
+
+def pool(fake, make, size=500):
+    """size Faker values to draw from; Faker is too slow to call per row"""
+
+    return np.array([text(make(fake)) for _ in range(size)], dtype=object)
+
+
+def load_users(task):
+    seed, shard, (start, end), password, anchor = task
+    fake = _faker(seed, 'users', shard)
+    r = rng(seed, 'users', shard)
+    n = end - start
+    names = pool(fake, lambda f: f.user_name())[r.integers(0, 500, n)]
+    firsts = pool(fake, lambda f: f.first_name()[:30])[r.integers(0, 500, n)]
+    lasts = pool(fake, lambda f: f.last_name()[:30])[r.integers(0, 500, n)]
+    bios = np.r_[pool(fake, lambda f: f.sentence()), [NULL] * 1000][r.integers(0, 1500, n)]
+    public = r.random(n) < .85
+    joined = (np.datetime64(anchor, 's') - r.integers(0, 3 * 365 * 86400, n).astype('timedelta64[s]'))
+    images = '\t'.join((default(User.__table__.c.header_image_url), default(User.__table__.c.profile_image_url)))
+    lines = []
+    for id, name, first, last, bio, is_public, when in zip(range(start + 1, end + 1), names, firsts, lasts, bios,
+                                                           public.tolist(), np.datetime_as_string(joined).tolist()):
+        username = f'{name}{id}'[:50]
+        lines.append('\t'.join((str(id), username, password, first, last, bio, f'{username}@example.com',
+                                't' if is_public else 'f', when, images)) + '\n')
+    copy('users', USER_COLUMNS, lines)
+
+    return len(lines)
+
+
+def load_races(task):
+    seed, shard, (start, end), anchor = task
+    fake = _faker(seed, 'races', shard)
+    r = rng(seed, 'races', shard)
+    n = end - start
+    cities = pool(fake, lambda f: f.city())[r.integers(0, 500, n)]
+    states = pool(fake, lambda f: f.state_abbr())[r.integers(0, 500, n)]
+    infos = pool(fake, lambda f: f.sentence())[r.integers(0, 500, n)]
+    days = r.integers(-60, 365, n)
+    kinds = r.integers(0, len(RACE_KINDS), n)
+    types = r.choice([t for t, _ in TYPE], n, p=[.8, .05, .15])
+    image = default(Race.__table__.c.image_url)
+    lines = []
+    for i, id in enumerate(range(start + 1, end + 1)):
+        when = anchor + timedelta(days=int(days[i]))
+        lines.append('\t'.join((str(id), f'{cities[i]} {RACE_KINDS[kinds[i]]}'[:80], cities[i], states[i], infos[i],
+                                when.strftime('%m/%d/%Y'), str(id), when.isoformat(),
+                                f'https://runsignup.com/Race/{id}', types[i], '0', image)) + '\n')
+    copy('races', RACE_COLUMNS, lines)
+
+    return len(lines)
+
+
+def load_users_races(task):
+    start, user_ids, race_ids, active = task
+    lines = [f'{id}\t{u}\t{r}\t{"t" if a else "f"}\tf\n'
+             for id, u, r, a in zip(range(start + 1, start + 1 + len(user_ids)), user_ids.tolist(),
+                                    race_ids.tolist(), active.tolist())]
+    copy('users_races', USERS_RACES_COLUMNS, lines)
+
+    return len(lines)
+
+
+def load_trainings(task):
+    seed, shard, first_id, users_races_ids, counts, anchor = task
+    r = rng(seed, 'trainings', shard)
+    n = int(counts.sum())
+    kinds = list(WORKOUT_SHARE)
+    kind = r.choice(len(kinds), n, p=list(WORKOUT_SHARE.values()))
+    pace = np.array([PACE[k] for k in kinds])[kind] * r.normal(1, .12, n).clip(.6, 1.5)
+    miles = r.gamma(2, 2.5, n) + .5
+    miles = np.where(np.array(kinds)[kind] == 'swim', miles / 5, miles)
+    minutes = np.where(np.isnan(pace), r.integers(20, 90, n), np.round(miles * np.nan_to_num(pace)))
+    km = r.random(n) < .25
+    distance = np.round(np.where(km, miles * KM_PER_MILE, miles), 2)
+    created = (np.datetime64(anchor, 's') - r.integers(0, 365 * 86400, n).astype('timedelta64[s]'))
+
+    titles = np.array(TITLES)[r.integers(0, len(TITLES), n)].tolist()
+    bodies = np.array(BODIES)[r.integers(0, len(BODIES), n)].tolist()
+    kind_names = np.array(kinds)[kind].tolist()
+    distances = [NULL if np.isnan(p) else str(d) for p, d in zip(pace.tolist(), distance.tolist())]
+    units = np.where(km, 'km', 'miles').tolist()
+    lines = ['\t'.join(row) + '\n' for row in zip(
+        map(str, range(first_id, first_id + n)),
+        map(str, np.repeat(users_races_ids, counts).tolist()),
+        titles, bodies, map(str, minutes.astype(int).tolist()), kind_names, distances, units,
+        np.datetime_as_string(created).tolist())]
+    copy('trainings', TRAINING_COLUMNS, lines)
+
+    return n
+
+
+def boards(seed, users, races, per_user):
+    """(user_ids, race_ids, is_active) of every users_races row, sorted by user then race"""
+
+    r = rng(seed, 'users_races')
+    sizes = np.where(r.random(users) < .2, 0, 1 + r.poisson(per_user - 1, users)).clip(0, races)
+    user_ids = np.repeat(np.arange(1, users + 1), sizes)
+    # Zipf popularity over a shuffled race order, so popular races aren't just the low ids
+    popular = r.permutation(races) + 1
+    race_ids = popular[(r.zipf(1.3, len(user_ids)) - 1) % races]
+    pairs = np.unique(user_ids.astype(np.int64) * (races + 1) + race_ids)
+    user_ids, race_ids = pairs // (races + 1), pairs % (races + 1)
+    active = np.r_[True, user_ids[1:] != user_ids[:-1]]
+
+    return user_ids, race_ids, active
+
+
+def allocate(seed, user_ids, active, total):
+    """Trainings per users_races row: Pareto user activity, weighted towards the active race"""
+
+    r = rng(seed, 'trainings')
+    users = int(user_ids.max()) if len(user_ids) else 0
+    activity = r.pareto(1.2, users + 1)
+    weight = activity[user_ids] * np.where(active, 4, 1)
+    share = weight / weight.sum() * total
+    counts = np.floor(share).astype(np.int64)
+    # largest remainders get the rows floor() dropped, so the counts add up to total exactly
+    short = total - int(counts.sum())
+    counts[np.argsort(counts - share, kind='stable')[:short]] += 1
+
+    return counts
+
+
+def training_shards(seed, users_races_ids, counts, anchor):
+    """Tasks of about SHARD['trainings'] trainings each, cut on users_races boundaries"""
+
+    if len(counts) == 0:
+        return []
+
+    ends = np.cumsum(counts)
+    cuts = np.searchsorted(ends, np.arange(SHARD['trainings'], int(ends[-1]), SHARD['trainings']), 'right')
+    tasks, lo = [], 0
+    for shard, hi in enumerate([*cuts.tolist(), len(counts)]):
+        if hi > lo:
+            first_id = int(ends[lo - 1]) + 1 if lo else 1
+            tasks.append((seed, shard, first_id, users_races_ids[lo:hi], counts[lo:hi], anchor))
+        lo = hi
+
+    return tasks
+
+
+def deferred(tables):
+    """Secondary indexes and foreign keys of tables, which COPY is faster without"""
+
+    indexes = [i for t in tables for i in t.indexes]
+    keys = [fk for t in tables for fk in t.foreign_key_constraints]
+
+    return indexes, keys
+
+
+def drop_deferred(conn, tables, indexes):
+    for table in tables:
+        # the models leave foreign keys unnamed, so use the names Postgres gave them
+        for fk in inspect(conn).get_foreign_keys(table.name):
+            conn.exec_driver_sql(f'ALTER TABLE {table.name} DROP CONSTRAINT {fk["name"]}')
+    for index in indexes:
+        conn.execute(DropIndex(index))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200_000)
+    parser.add_argument('--races', type=int, default=50_000)
+    parser.add_argument('--board', type=int, default=3, help='mean races per vision board')
+    parser.add_argument('--trainings', type=int, default=10_000_000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--anchor', type=date.fromisoformat, default=date.today(),
+                        help='date the data is generated around, YYYY-MM-DD (default today)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    url = os.environ.get('DATABASE_URL', '')
+    database = make_url(url).database or ''
+    if not any(word in database for word in ('bench', 'scale', 'test')):
+        parser.error(f'refusing to drop and reload {database!r}; use a *bench*, *scale* or *test* database')
+
+    anchor = datetime.combine(args.anchor, datetime.min.time())
+    app = create_app({'DEBUG_TB_ENABLED': False})
+    started = time.perf_counter()
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        tables = [User.__table__, Race.__table__, User_Race.__table__, Training.__table__]
+        indexes, keys = deferred(tables)
+        with db.engine.begin() as conn:
+            drop_deferred(conn, tables, indexes)
+        password = password_hash(args.seed, passwords.rounds)
+        user_ids, race_ids, active = boards(args.seed, args.users, args.races, args.board)
+        counts = allocate(args.seed, user_ids, active, args.trainings)
+        users_races_ids = np.arange(1, len(user_ids) + 1)
+
+    steps = [
+        ('users', load_users, [(args.seed, n, s, password, anchor) for n, s in enumerate(shards('users', args.users))]),
+        ('races', load_races, [(args.seed, n, s, args.anchor) for n, s in enumerate(shards('races', args.races))]),
+        ('users_races', load_users_races, [(lo, user_ids[lo:hi], race_ids[lo:hi], active[lo:hi])
+                                           for lo, hi in shards('users_races', len(user_ids))]),
+        ('trainings', load_trainings, training_shards(args.seed, users_races_ids, counts, anchor)),
+    ]
+    with Pool(args.workers, _connect, (url,)) as pool:
+        for table, load, tasks in steps:
+            step = time.perf_counter()
+            rows = sum(pool.imap_unordered(load, tasks))
+            elapsed = time.perf_counter() - step
+            print(f'{table:<12} {rows:>11,} rows  {elapsed:7.1f}s  {rows / max(elapsed, 1e-9):>9,.0f} rows/s')
+
+    with app.app_context():
+        step = time.perf_counter()
+        with db.engine.begin() as conn:
+            for index in indexes:
+                conn.execute(CreateIndex(index))
+            for fk in keys:
+                conn.execute(AddConstraint(fk))
+            for table in tables:
+                conn.exec_driver_sql(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                                     f"(SELECT coalesce(max(id), 0) + 1 FROM {table.name}), false)")
+        print(f'{"indexes":<12} {len(indexes) + len(keys):>11} built  {time.perf_counter() - step:7.1f}s')
+
+        step = time.perf_counter()
+        db.session.add(SyncState(name=SYNC_NAME, last_run_at=datetime.utcnow(), last_count=args.races))
+        rebuild_totals()
+        rebuild_weekly()
+        db.session.commit()
+        print(f'{"rollups":<12} {"":>11}        {time.perf_counter() - step:7.1f}s')
+
+        step = time.perf_counter()
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('ANALYZE')
+        print(f'{"analyze":<12} {"":>11}        {time.perf_counter() - step:7.1f}s')
+
+    print(f'loaded in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
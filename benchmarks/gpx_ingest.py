@@ -0,0 +1,68 @@
+"""GPX ingest time for large tracks.
+
+Builds a synthetic GPX file (a wandering 1 Hz run with GPS jitter) of each
+--points size and times build_track on it: parse, haversine, moving time,
+Douglas-Peucker and packing.
+
+    python benchmarks/gpx_ingest.py --points 10000 100000 --tolerance 5
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from training_tracks import build_track, parse_gpx  # noqa: E402
+
+
+def synthetic_gpx(points, seed=0):
+    rng = np.random.default_rng(seed)
+    heading = np.cumsum(rng.normal(0, .05, points))
+    step = 3 / 111195  # ~3 m/s
+    lat = 42 + np.cumsum(np.cos(heading) * step) + rng.normal(0, 2e-5, points)
+    lon = -71 + np.cumsum(np.sin(heading) * step / np.cos(np.radians(42))) + rng.normal(0, 2e-5, points)
+    ele = 20 + np.cumsum(rng.normal(0, .1, points))
+    start = datetime(2024, 1, 1, 7)
+
+    out = io.StringIO()
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" creator="bench" '
+              'xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>\n')
+    for i in range(points):
+        out.write(f'<trkpt lat="{lat[i]:.7f}" lon="{lon[i]:.7f}"><ele>{ele[i]:.1f}</ele>'
+                  f'<time>{(start + timedelta(seconds=i)).isoformat()}Z</time></trkpt>\n')
+    out.write('</trkseg></trk></gpx>\n')
+
+    return out.getvalue().encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--tolerance', type=float, default=5)
+    args = parser.parse_args()
+
+    for points in args.points:
+        data = synthetic_gpx(points)
+
+        started = time.perf_counter()
+        parse_gpx(io.BytesIO(data))
+        parsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        track = build_track(io.BytesIO(data), args.tolerance)
+        total = time.perf_counter() - started
+
+        print({'points': points, 'file MB': round(len(data) / 2 ** 20, 1), 'parse s': round(parsed, 3),
+               'ingest s': round(total, 3), 'kept': track.stored_count,
+               'stored KB': round((len(track.lat_e7) * 2 + len(track.elevation) + len(track.seconds)) / 1024, 1),
+               'km': round(track.distance_m / 1000, 2)})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""Route benchmarks against seeded data and a local RunSignup stub.
+
+Seeds a throwaway database with Faker data (--users, --races, --board races
+per user, --trainings per board race), starts a RunSignup stub on localhost
+answering /races after --stub-latency ms, and times every route of the app
+through the test client:
+
+    cold  race, page and fragment caches emptied before each request
+    warm  one request to fill them, then --samples timed requests
+
+Reports p50/p95/p99 in ms and the SQL statements per request (median).
+--save writes the results as a JSON baseline; --compare reads one and exits
+1 if a route got slower than --tolerance allows on p95 or runs more queries.
+
+    createdb runners_vision-bench
+    DATABASE_URL=postgresql:///runners_vision-bench python benchmarks/routes.py --save benchmarks/baseline.json
+    DATABASE_URL=postgresql:///runners_vision-bench python benchmarks/routes.py --compare benchmarks/baseline.json
+
+Seeding drops and recreates every table, so it refuses databases whose name
+doesn't contain "bench" or "test"; --no-seed reuses what is there.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from faker import Faker  # noqa: E402
+from sqlalchemy import event, insert  # noqa: E402
+from sqlalchemy.engine import make_url  # noqa: E402
+
+from app import create_app  # noqa: E402
+from fragment_cache import fragment_cache  # noqa: E402
+from identity import CURR_USER_KEY  # noqa: E402
+from models import db, User, Race, User_Race, Training, SyncState  # noqa: E402
+from page_cache import page_cache  # noqa: E402
+from passwords import passwords  # noqa: E402
+from race_cache import race_cache  # noqa: E402
+from race_sync import SYNC_NAME  # noqa: E402
+from runsignup import percentile  # noqa: E402
+from training_stats import rebuild_totals, rebuild_weekly  # noqa: E402
+from forms import WORKOUTS  # noqa: E402
+
+PASSWORD = 'bench-password'
+
+
+class Stub:
+    """RunSignup stand-in on localhost: /races answers a page of fake listings after a delay"""
+
+    def __init__(self, latency, seed):
+        stub = self
+        self.latency = latency
+        self.calls = 0
+        self.fake = Faker()
+        self.fake.seed_instance(seed)
+        self.listings = [self.listing(i) for i in range(200)]
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.calls += 1
+                time.sleep(stub.latency)
+                body = json.dumps({'races': stub.listings[:50]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def listing(self, i):
+        when = date.today() + timedelta(days=1 + i)
+        return {'race': {'race_id': 9_000_000 + i, 'name': f'{self.fake.city()} {self.fake.word().title()} Run',
+                         'address': {'city': self.fake.city(), 'state': self.fake.state_abbr()},
+                         'next_date': when.strftime('%m/%d/%Y'), 'url': f'https://runsignup.com/Race/{i}',
+                         'last_modified': 0}}
+
+    def close(self):
+        self.server.shutdown()
+
+
+def seed(users, races, board, trainings, seed):
+    """Fills the emptied tables. Returns (user count, race count, users_races count, training count)."""
+
+    fake = Faker()
+    fake.seed_instance(seed)
+    rng = random.Random(seed)
+
+    db.drop_all()
+    db.create_all()
+
+    today = date.today()
+    db.session.execute(insert(Race), [
+        {'name': f'{fake.city()} {fake.word().title()} {rng.choice(["5K", "10K", "Half", "Marathon"])}'[:80],
+         'city': fake.city(), 'state': fake.state_abbr(), 'info': fake.sentence(),
+         'start_date': (today + timedelta(days=i % 365)).strftime('%m/%d/%Y'),
+         'next_date': today + timedelta(days=i % 365), 'runsignup_id': i + 1,
+         'url': f'https://runsignup.com/Race/{i + 1}', 'event_type': 'running_race', 'last_modified': 0}
+        for i in range(races)])
+
+    hashed = passwords.hash(PASSWORD)
+    db.session.execute(insert(User), [
+        {'username': f'{fake.user_name()}{i}'[:50], 'password': hashed, 'first_name': fake.first_name()[:30],
+         'last_name': fake.last_name()[:30], 'bio': fake.sentence(), 'email': f'bench{i}@example.com',
+         'is_public': i % 4 != 0}
+        for i in range(users)])
+
+    user_ids = db.session.execute(db.select(User.id).order_by(User.id)).scalars().all()
+    race_ids = db.session.execute(db.select(Race.id).order_by(Race.id)).scalars().all()
+    db.session.execute(insert(User_Race), [
+        {'user_id': user_id, 'race_id': race_id, 'is_active': n == 0}
+        for user_id in user_ids for n, race_id in enumerate(rng.sample(race_ids, min(board, len(race_ids))))])
+
+    users_races_ids = db.session.execute(db.select(User_Race.id)).scalars().all()
+    started = datetime.utcnow() - timedelta(days=180)
+    for chunk in range(0, len(users_races_ids), 500):
+        db.session.execute(insert(Training), [
+            {'users_races_id': users_races_id, 'title': fake.word().title()[:30], 'body': fake.sentence()[:300],
+             'time_spent': rng.randint(15, 150), 'type': rng.choice(WORKOUTS),
+             'distance': round(rng.uniform(1, 20), 2), 'units': rng.choice(['miles', 'km']),
+             'created_at': started + timedelta(hours=rng.randint(0, 180 * 24))}
+            for users_races_id in users_races_ids[chunk:chunk + 500] for _ in range(trainings)])
+
+    db.session.add(SyncState(name=SYNC_NAME, last_run_at=datetime.utcnow(), last_count=races))
+    rebuild_totals()
+    rebuild_weekly()
+    db.session.commit()
+
+    return len(user_ids), len(race_ids), len(users_races_ids), len(users_races_ids) * trainings
+
+
+def fixtures():
+    """Ids the routes are filled in with: the first user's active race and one of its trainings"""
+
+    u_r = db.session.execute(db.select(User_Race).join(Training, Training.users_races_id == User_Race.id)
+                             .filter(User_Race.is_active).order_by(User_Race.user_id).limit(1)).scalar_one()
+    user = db.session.get(User, u_r.user_id)
+    race = db.session.get(Race, u_r.race_id)
+    t = u_r.trainings[0]
+
+    return {'user': user.id, 'username': user.username, 'race': race.id, 'race_name': race.name,
+            'runsignup_id': race.runsignup_id, 'users_races': u_r.id, 'training': t.id,
+            'training_form': {'title': t.title, 'body': t.body or '', 'time_spent': t.time_spent or '',
+                              'type': t.type, 'distance': t.distance or '', 'units': t.units or 'miles'}}
+
+
+def routes(f):
+    """(name, endpoint, method, path, form data, logged in) for every route worth timing"""
+
+    user, race = f['user'], f['race']
+    return [
+        ('home', 'main.homepage', 'GET', '/', None, False),
+        ('stats', 'main.show_stats', 'GET', '/api/stats', None, False),
+        ('signup form', 'main.signup', 'GET', '/signup', None, False),
+        ('login form', 'main.login', 'GET', '/login', None, False),
+        ('login', 'main.login', 'POST', '/login', {'username': f['username'], 'password': PASSWORD}, False),
+        ('logout', 'main.logout', 'GET', '/logout', None, False),
+        ('races', 'main.show_all_races', 'GET', '/races', None, True),
+        ('search form', 'main.search_races', 'GET', '/races/search', None, True),
+        ('search catalog', 'main.search_races', 'POST', '/races/search', {'name': f['race_name'].split()[0]}, True),
+        ('search username', 'main.search_races', 'POST', '/races/search', {'username': f['username'][:4]}, True),
+        # distance filters always go to RunSignup (the stub)
+        ('search upstream', 'main.search_races', 'POST', '/races/search',
+         {'max_distance': 10, 'distance_units': 'K'}, True),
+        ('profile', 'main.user_profile', 'GET', f'/user/{user}', None, True),
+        ('vision board', 'main.show_user_races', 'GET', f'/user/{user}/races', None, True),
+        ('weekly mileage', 'main.user_weekly_mileage', 'GET', f'/api/users/{user}/weekly', None, True),
+        ('export csv', 'main.export_trainings', 'GET', f'/user/{user}/trainings/export.csv', None, True),
+        ('export ndjson', 'main.export_trainings', 'GET', f'/user/{user}/trainings/export.ndjson', None, True),
+        ('edit user form', 'main.edit_user', 'GET', '/user/edit', None, True),
+        ('training form', 'main.add_training', 'GET', f'/race/{f["users_races"]}/trainings', None, True),
+        ('edit training form', 'main.edit_training', 'GET', f'/trainings/{f["training"]}/edit', None, True),
+        # writes below leave the data as they found it
+        ('edit training', 'main.edit_training', 'POST', f'/trainings/{f["training"]}/edit', f['training_form'], True),
+        ('add race (on board)', 'main.add_race', 'POST', f'/user/{user}/races/add',
+         {'race_id': f['runsignup_id'], 'name': f['race_name']}, True),
+        ('inactivate race', 'main.inactivate_race', 'POST', f'/races/{user}/{race}/inactivate', None, True),
+        ('activate race', 'main.set_active_status', 'POST', f'/races/{user}/{race}/activate', None, True),
+    ]
+
+
+def clear_caches():
+    race_cache.clear()
+    page_cache.clear()
+    fragment_cache.clear()
+
+
+def measure(app, route, user_id, samples, cold, queries):
+    """(sorted ms per request, median queries per request, last status) of samples requests"""
+
+    name, endpoint, method, path, data, logged_in = route
+    times, counts, status = [], [], None
+    with app.test_client() as client:
+        if logged_in:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+        if not cold:
+            client.open(path, method=method, data=data)
+        for _ in range(samples):
+            if cold:
+                clear_caches()
+            queries[0] = 0
+            started = time.perf_counter()
+            resp = client.open(path, method=method, data=data)
+            resp.get_data()
+            times.append((time.perf_counter() - started) * 1000)
+            counts.append(queries[0])
+            status = resp.status_code
+            resp.close()
+            with client.session_transaction() as sess:
+                # flashes would keep the next request off the page cache
+                sess.pop('_flashes', None)
+
+    return sorted(times), statistics.median(counts), status
+
+
+def summary(times, count):
+    return {'p50': round(percentile(times, 50), 2), 'p95': round(percentile(times, 95), 2),
+            'p99': round(percentile(times, 99), 2), 'queries': count}
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing routes slower (p95) or chattier than baseline"""
+
+    regressions = []
+    for name, modes in results.items():
+        for mode, now in modes.items():
+            then = baseline.get(name, {}).get(mode)
+            if then is None or mode == 'status':
+                continue
+            if now['p95'] > then['p95'] * (1 + tolerance):
+                regressions.append(f'{name} {mode}: p95 {then["p95"]} -> {now["p95"]} ms')
+            if now['queries'] > then['queries']:
+                regressions.append(f'{name} {mode}: queries {then["queries"]} -> {now["queries"]}')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--races', type=int, default=2000)
+    parser.add_argument('--board', type=int, default=5, help='races on each user\'s vision board')
+    parser.add_argument('--trainings', type=int, default=20, help='trainings per vision board race')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-seed', action='store_true', help='benchmark the data already in the database')
+    parser.add_argument('--samples', type=int, default=50)
+    parser.add_argument('--stub-latency', type=float, default=50, help='ms before the stub answers')
+    parser.add_argument('--only', nargs='*', help='route names to run')
+    parser.add_argument('--save', help='write results to this JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to check results against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 slowdown (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    database = make_url(os.environ.get('DATABASE_URL', '')).database or ''
+    if not args.no_seed and 'bench' not in database and 'test' not in database:
+        parser.error(f'refusing to drop and reseed {database!r}; use a *bench* or *test* database or --no-seed')
+
+    stub = Stub(args.stub_latency / 1000, args.seed)
+    scratch = tempfile.mkdtemp(prefix='runners_vision_bench')
+    # TESTING surfaces view errors; budgets and raiseload stay off as in production
+    app = create_app({'TESTING': True, 'WTF_CSRF_ENABLED': False, 'DEBUG_TB_ENABLED': False,
+                      'QUERY_BUDGET_MODE': 'off', 'RAISE_LAZY_LOADS': False,
+                      'RUNSIGNUP_BASE_URL': stub.url,
+                      'RACE_CACHE_PATH': os.path.join(scratch, 'races.sqlite3'),
+                      'PAGE_CACHE_PATH': os.path.join(scratch, 'pages.sqlite3'),
+                      'JINJA_BYTECODE_CACHE_DIR': os.path.join(scratch, 'jinja')})
+
+    with app.app_context():
+        if not args.no_seed:
+            started = time.perf_counter()
+            counts = seed(args.users, args.races, args.board, args.trainings, args.seed)
+            print('seeded {} users, {} races, {} users_races, {} trainings'.format(*counts),
+                  f'in {time.perf_counter() - started:.1f}s')
+        f = fixtures()
+        db.session.remove()
+
+        queries = [0]
+
+        def count(*args):
+            queries[0] += 1
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+
+    todo = [r for r in routes(f) if not args.only or r[0] in args.only]
+    covered = {(r[1], r[2]) for r in routes(f)}
+    skipped = sorted(f'{method} {rule.rule}' for rule in app.url_map.iter_rules() if rule.endpoint != 'static'
+                     for method in rule.methods - {'HEAD', 'OPTIONS'} if (rule.endpoint, method) not in covered)
+
+    results = {}
+    print(f'\n{"route":<22}{"status":>7}  {"cold p50/p95/p99 ms":>24} {"q":>4}  {"warm p50/p95/p99 ms":>24} {"q":>4}')
+    for route in todo:
+        cold = summary(*measure(app, route, f['user'], args.samples, True, queries)[:2])
+        times, count_, status = measure(app, route, f['user'], args.samples, False, queries)
+        warm = summary(times, count_)
+        results[route[0]] = {'status': status, 'cold': cold, 'warm': warm}
+        print(f'{route[0]:<22}{status:>7}  '
+              f'{cold["p50"]:>8.2f}{cold["p95"]:>8.2f}{cold["p99"]:>8.2f} {cold["queries"]:>4g}  '
+              f'{warm["p50"]:>8.2f}{warm["p95"]:>8.2f}{warm["p99"]:>8.2f} {warm["queries"]:>4g}')
+    print(f'\nstub calls: {stub.calls}')
+    if skipped:
+        print('not benchmarked (writes that would change the seeded data):', ', '.join(skipped))
+    stub.close()
+
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump({'meta': {'users': args.users, 'races': args.races, 'board': args.board,
+                                'trainings': args.trainings, 'samples': args.samples,
+                                'stub_latency_ms': args.stub_latency, 'python': sys.version.split()[0]},
+                       'routes': results}, out, indent=2)
+        print(f'baseline written to {args.save}')
+
+    if args.compare:
+        with open(args.compare) as base:
+            regressions = compare(results, json.load(base)['routes'], args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        if regressions:
+            sys.exit(1)
+        print(f'no regressions against {args.compare}')
+
+
+if __name__ == '__main__':
+    main()
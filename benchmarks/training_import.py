@@ -0,0 +1,85 @@
+"""Bulk training import throughput.
+
+Writes a CSV or NDJSON file of --rows generated trainings, imports it into a
+throwaway user's race, and reports rows/s and peak RSS growth. Everything is
+rolled back afterwards. 'parse rows/s' is parsing and validation alone, without
+Postgres; on a single core the two share the CPU, so rows/s is bounded by both.
+
+    DATABASE_URL=postgresql:///runners_vision python benchmarks/training_import.py --rows 100000 500000
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import app  # noqa: E402,F401
+from models import db, User, Race, User_Race  # noqa: E402
+from training_import import CopySource, import_trainings, parse_csv, parse_ndjson  # noqa: E402
+
+
+def write_rows(f, rows, format):
+    start = datetime(2020, 1, 1)
+    if format == 'csv':
+        f.write('title,body,time_spent,type,distance,units,created_at\n')
+    for i in range(rows):
+        row = {'title': f'run {i}', 'body': 'easy, "conversational" pace', 'time_spent': 30 + i % 60,
+               'type': 'run', 'distance': 3 + i % 10, 'units': 'miles',
+               'created_at': (start + timedelta(minutes=i)).isoformat()}
+        if format == 'csv':
+            f.write(f'{row["title"]},"easy, ""conversational"" pace",{row["time_spent"]},run,'
+                    f'{row["distance"]},miles,{row["created_at"]}\n')
+        else:
+            f.write(json.dumps(row) + '\n')
+
+
+def run(rows, format):
+    with tempfile.NamedTemporaryFile('w', suffix=f'.{format}') as f:
+        write_rows(f, rows, format)
+        f.flush()
+
+        u = User(username='import_bench', email='import_bench@example.com', password='x',
+                 first_name='import', last_name='bench')
+        u.races.append(Race(name='import_bench_race', start_date=''))
+        db.session.add(u)
+        db.session.flush()
+        u_r = db.session.execute(db.select(User_Race).filter_by(user_id=u.id)).scalar_one()
+
+        started = time.perf_counter()
+        with open(f.name, 'rb') as upload:
+            source = CopySource(u_r.id, (parse_csv if format == 'csv' else parse_ndjson)(upload))
+            while source.read():
+                pass
+        parsed = source.count / (time.perf_counter() - started)
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        with open(f.name, 'rb') as upload:
+            count = import_trainings(u_r.id, upload, format)
+        elapsed = time.perf_counter() - started
+        grew = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        db.session.rollback()
+
+    return {'format': format, 'rows': count, 'rows/s': round(count / elapsed), 'parse rows/s': round(parsed),
+            'peak RSS growth MB': round(grew / 1024, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000])
+    parser.add_argument('--format', choices=['csv', 'ndjson'], nargs='+', default=['csv', 'ndjson'])
+    args = parser.parse_args()
+
+    for format in args.format:
+        for rows in args.rows:
+            print(run(rows, format))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import IntegerField, DateField, FloatField, StringField, PasswordField, TextAreaField, BooleanField, SelectField
+from flask_wtf.file import FileAllowed, FileField
+from wtforms import IntegerField, DateField, FloatField, StringField, PasswordField, TextAreaField, BooleanField, SelectField, SelectMultipleField, HiddenField
 from wtforms.validators import InputRequired, DataRequired, Email, Length, Optional, URL
 
 
@@ -37,6 +38,7 @@ class TrainingForm(FlaskForm):
     type = SelectField('Select type of worout:', choices=WORKOUTS, default='run')
     distance = FloatField('Distance:', validators=[Optional()])
     units = SelectField('Units:', choices=UNITS, default='miles')
+    gpx = FileField('(Optional) GPX track, fills in distance and time:', validators=[FileAllowed(['gpx'], 'Upload a .gpx file')])
 
 
 class LoginForm(FlaskForm):
@@ -53,3 +55,5 @@ class SearchRacesForm(FlaskForm):
     state = StringField('State:', validators=[Optional()])
     max_distance = FloatField('Distance:', validators=[Optional()])
     distance_units =  SelectField('Units:', choices=RACEUNITS, validators=[Optional()])
+    event_types = SelectMultipleField('Race types:', choices=TYPE, default=['running_race'], validators=[Optional()])
+    cursor = HiddenField()
@@ -0,0 +1,95 @@
+"""Rendered race list entries, cached per worker.
+
+show.html used to render every race of a page through nested listing
+lookups and an inline form. Each entry is now rendered once from
+_race_item.html and kept under the race's identity plus the values it
+shows, so a later page with the same race reuses the HTML and the list is
+assembled from cached fragments. Entries whose listing changes get a new
+key; old ones age out of the LRU.
+"""
+
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+
+RACE_ITEM_TEMPLATE = '_race_item.html'
+
+
+class FragmentCache:
+    """Thread-safe LRU of rendered HTML fragments, cleared when the template they come from is reloaded."""
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._template = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Configures cache from app config."""
+
+        self.max_entries = app.config.get('FRAGMENT_CACHE_MAX_ENTRIES', self.max_entries)
+        self.clear()
+
+    def render(self, template, key, **context):
+        """template rendered with context, from cache when key was rendered before"""
+
+        with self._lock:
+            if template is not self._template:
+                # first use, or the template source changed and was reloaded
+                self._entries.clear()
+                self._template = template
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+
+        html = Markup(template.render(**context))
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = html
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return html
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._template = None
+            self.hits = self.misses = 0
+
+
+fragment_cache = FragmentCache()
+
+
+def race_items(jinja_env, races, user_id, fields):
+    """Rendered show.html entries for races in RunSignup listing shape.
+
+    fields maps the listing keys the template reads (LISTING_FIELDS)."""
+
+    template = jinja_env.get_template(RACE_ITEM_TEMPLATE)
+    items = []
+    for listing in races:
+        race = listing[fields['race']]
+        address = race.get(fields['address']) or {}
+        values = {
+            'race_id': race.get('race_id'),
+            'name': race[fields['name']],
+            'city': address.get(fields['city']),
+            'state': address.get(fields['state']),
+            'next_date': race.get(fields['date']),
+            'url': race.get(fields['link']),
+            'url_name': race.get('url_name'),
+        }
+        # identity first, then everything the entry shows
+        key = (values['race_id'] or values['name'], user_id, *values.values())
+        items.append(fragment_cache.render(template, key, user_id=user_id, **values))
+
+    return items
@@ -0,0 +1,16 @@
+"""gunicorn settings: build the app once in the master and fork workers from it.
+
+    gunicorn -c gunicorn.conf.py
+
+With preload_app the imports and create_app() run once, before forking, so
+each worker starts from an already built app (copy-on-write) instead of
+importing everything itself. create_app disposes inherited database pools in
+the child, so no connection is shared across processes.
+"""
+
+import os
+
+wsgi_app = 'app:create_app()'
+preload_app = True
+bind = os.environ.get('BIND', '0.0.0.0:' + os.environ.get('PORT', '8000'))
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
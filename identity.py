@@ -0,0 +1,126 @@
+"""Request identity without a users query per request.
+
+The signed session carries the logged in user's id plus a few claims
+(username, is_public) that the layout and access checks need. g.user is a
+CurrentUser built from them; the full User row is only loaded the first time
+a view touches anything beyond the claims.
+
+Claims are re-read from the row once they are older than IDENTITY_MAX_AGE
+seconds, so a rename made from another browser shows up eventually, and are
+rewritten immediately by the views that change them.
+"""
+
+import time
+
+from flask import abort, current_app, flash, redirect, session
+
+from models import db, User
+
+
+CURR_USER_KEY = "curr_user"
+CLAIMS_KEY = "curr_user_claims"
+CLAIMS = ('id', 'username', 'is_public')
+DEFAULT_MAX_AGE = 300
+
+
+def remember(user):
+    """Store user's id and claims in the session"""
+
+    session[CURR_USER_KEY] = user.id
+    session[CLAIMS_KEY] = {**{c: getattr(user, c) for c in CLAIMS}, 'at': time.time()}
+
+
+def forget():
+    """Drop the logged in user from the session"""
+
+    session.pop(CURR_USER_KEY, None)
+    session.pop(CLAIMS_KEY, None)
+
+
+class CurrentUser:
+    """The logged in user: claims from the session, everything else from a lazily loaded row.
+
+    Attribute writes go to the row, so views can keep treating g.user as the
+    User it used to be. Once the row is loaded it also answers the claims, so
+    a view sees its own edits."""
+
+    def __init__(self, claims, row=None):
+        object.__setattr__(self, '_claims', claims)
+        object.__setattr__(self, '_row', row)
+
+    @property
+    def row(self):
+        """The User row, loaded on first use"""
+
+        if self._row is None:
+            row = db.session.get(User, self._claims['id'])
+            if row is None:
+                # deleted since the claims were issued
+                forget()
+                flash("Access unauthorized.", "danger")
+                abort(redirect("/"))
+            object.__setattr__(self, '_row', row)
+
+        return self._row
+
+    @property
+    def loaded(self):
+        return self._row is not None
+
+    def __getattr__(self, name):
+        if name in CLAIMS and self._row is None:
+            return self._claims[name]
+
+        return getattr(self.row, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.row, name, value)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._claims['id']}: {self._claims['username']}>"
+
+
+def _fresh_claims():
+    """This request's claims, or None when they are missing, stale or for another user"""
+
+    claims = session.get(CLAIMS_KEY)
+    max_age = current_app.config.get('IDENTITY_MAX_AGE', DEFAULT_MAX_AGE)
+    if claims and claims.get('id') == session[CURR_USER_KEY] and time.time() - claims.get('at', 0) < max_age:
+        return claims
+
+
+def current_user():
+    """CurrentUser for this request's session, or None when logged out"""
+
+    if CURR_USER_KEY not in session:
+        return None
+
+    user_id = session[CURR_USER_KEY]
+    claims = _fresh_claims()
+    if claims:
+        return CurrentUser(claims)
+
+    # missing, stale or mismatched claims: load once and reissue them
+    row = db.session.get(User, user_id)
+    if row is None:
+        forget()
+        return None
+    remember(row)
+
+    return CurrentUser(session[CLAIMS_KEY], row)
+
+
+async def arefresh_claims(db_session):
+    """Reissues stale claims from a row read on an AsyncSession.
+
+    For the ASGI app, which calls this before the request hooks so
+    current_user() finds fresh claims and doesn't query from the event loop."""
+
+    if CURR_USER_KEY not in session or _fresh_claims():
+        return
+
+    row = await db_session.get(User, session[CURR_USER_KEY])
+    if row is None:
+        forget()
+    else:
+        remember(row)
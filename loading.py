@@ -0,0 +1,33 @@
+"""Per-view loading plans for the ORM object graph.
+
+A view that renders models declares everything its template reads up front:
+
+    user = db.session.execute(db.select(User).filter_by(id=user_id)
+                              .options(*load_plan(selectinload(User.races)))).scalar_one()
+
+so the graph is loaded in a fixed number of round trips before rendering,
+whatever the number of races or trainings. load_plan adds raiseload('*')
+when RAISE_LAZY_LOADS is on (the default in debug and under TESTING), both
+for the statement's entity and chained onto each option for the objects it
+loads, so an attribute the plan forgot raises instead of quietly lazy
+loading from inside the template. In production it lazy loads as before.
+
+Options only apply to objects the statement loads: one already in the
+session, such as g.user's row, keeps its own loaders.
+"""
+
+from flask import current_app
+from sqlalchemy.orm import raiseload
+
+
+def raise_lazy_loads(app):
+    return app.config.get('RAISE_LAZY_LOADS', app.debug or app.testing)
+
+
+def load_plan(*options):
+    """options, plus raiseload('*') for everything they leave out when lazy loads raise"""
+
+    if raise_lazy_loads(current_app):
+        return (*[option.raiseload('*') for option in options], raiseload('*'))
+
+    return options
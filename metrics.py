@@ -0,0 +1,383 @@
+"""Per-route request metrics in Prometheus text format.
+
+Every request gets a Sample that hooks fill in as it runs:
+
+- SQLAlchemy before/after_cursor_execute: statement count and DB time
+- render_template signals (and race_items fragments): template time
+- timing('upstream') around RunSignup calls: upstream time
+
+When the request is torn down the sample goes into per-route histograms
+(route is the URL rule, so labels stay bounded). A worker keeps its
+histograms in memory and every METRICS_FLUSH_SECONDS writes a snapshot to a
+SQLite file shared by the host's workers, like race_cache; /metrics sums the
+snapshots, so a scrape sees every worker, not just the one that answered.
+A heartbeat thread rewrites the snapshot of a worker serving no requests, so
+one not rewritten for METRICS_RETENTION_SECONDS (three flush intervals by
+default) belongs to an exited worker. Its counts are folded into a retained
+'exited' row before it is deleted, as prometheus_client's multiprocess mode
+does, so the summed counters never go down when a worker exits or restarts.
+Every series here is a counter or histogram; there are no gauges to drop.
+
+Hooks cost a perf_counter() and a ContextVar lookup each, so metrics can stay on.
+"""
+
+import asyncio
+import bisect
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import before_render_template, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'runners_vision_metrics.sqlite3')
+PREFIX = 'runners_vision_'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    worker TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    written_at REAL NOT NULL
+);
+"""
+
+# snapshot row holding the summed counts of every expired worker
+EXITED = 'exited'
+
+SECONDS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# name: (help, buckets)
+SERIES = {
+    'request_seconds': ('Request wall time.', SECONDS_BUCKETS),
+    'request_db_seconds': ('Time spent in SQL statements per request.', SECONDS_BUCKETS),
+    'request_queries': ('SQL statements per request.', QUERY_BUCKETS),
+    'request_upstream_seconds': ('Time spent waiting on RunSignup per request.', SECONDS_BUCKETS),
+    'request_template_seconds': ('Time spent rendering templates per request.', SECONDS_BUCKETS),
+}
+
+
+class Sample:
+    """Timings of the request in flight"""
+
+    __slots__ = ('started', 'db', 'queries', 'upstream', 'template', 'status', '_statement', '_render')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db = self.upstream = self.template = 0.0
+        self.queries = 0
+        self.status = None
+        self._statement = self._render = None
+
+
+_sample = ContextVar('metrics_sample', default=None)
+
+
+@contextmanager
+def timing(kind):
+    """Adds the time spent in the block to the current request's upstream or template time"""
+
+    sample = _sample.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if sample is not None:
+            setattr(sample, kind, getattr(sample, kind) + time.perf_counter() - started)
+
+
+def timed(kind, fn):
+    """fn, with its calls added to the current request's upstream or template time"""
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with timing(kind):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+
+    return True
+
+
+def _merge(total, data, sign=1):
+    """Adds (or with sign=-1 subtracts) snapshot data into snapshot total, in place"""
+
+    for name, histograms in data['series'].items():
+        series = total['series'].setdefault(name, {})
+        for key, h in histograms.items():
+            current = series.get(key)
+            series[key] = [sign * b for b in h] if current is None else [a + sign * b for a, b in zip(current, h)]
+    requests = total['requests']
+    for key, n in data['requests'].items():
+        requests[key] = requests.get(key, 0) + sign * n
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+class Metrics:
+    """This worker's per-route histograms and request counts, and the shared snapshots of all workers"""
+
+    def __init__(self, path=DEFAULT_PATH, flush_seconds=5, retention_seconds=None, enabled=True):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.retention_seconds = retention_seconds
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._heartbeat = None
+        self._reset()
+
+    def init_app(self, app):
+        """Configures metrics from app config and hooks them into app's requests and templates."""
+
+        self.path = app.config.get('METRICS_PATH', self.path)
+        self.flush_seconds = app.config.get('METRICS_FLUSH_SECONDS', self.flush_seconds)
+        self.retention_seconds = app.config.get('METRICS_RETENTION_SECONDS', self.retention_seconds)
+        self.enabled = app.config.get('METRICS_ENABLED', self.enabled)
+        self._local = threading.local()
+        if not self.enabled:
+            return
+
+        app.before_request(self._start)
+        app.after_request(self._status)
+        app.teardown_request(self._finish)
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+
+    def _reset(self):
+        # histograms: {name: {(route, method): [count per bucket..., +Inf count, sum, count]}}
+        self._series = {name: {} for name in SERIES}
+        self._requests = {}
+        self._pid = os.getpid()
+        self._worker = f'{self._pid}-{os.urandom(4).hex()}'
+        self._flushed_at = time.monotonic()
+        # what the last flush wrote, in case another worker folds it into EXITED
+        self._written = None
+
+    # request hooks
+
+    def _start(self):
+        _sample.set(Sample())
+
+    def _status(self, response):
+        sample = _sample.get()
+        if sample is not None:
+            sample.status = response.status_code
+
+        return response
+
+    def _finish(self, exc):
+        sample = _sample.get()
+        if sample is None:
+            return
+        _sample.set(None)
+
+        if self._heartbeat != os.getpid():
+            self._start_heartbeat()
+        rule = request.url_rule
+        self.observe(rule.rule if rule is not None else '<unmatched>', request.method,
+                     sample.status or 500, time.perf_counter() - sample.started, sample)
+
+    def _render_started(self, sender, template, context, **extra):
+        sample = _sample.get()
+        if sample is not None:
+            sample._render = time.perf_counter()
+
+    def _render_finished(self, sender, template, context, **extra):
+        sample = _sample.get()
+        if sample is not None and sample._render is not None:
+            sample.template += time.perf_counter() - sample._render
+            sample._render = None
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat == os.getpid():
+                return
+            self._heartbeat = os.getpid()
+        threading.Thread(target=self._beat, args=(self._heartbeat,), name='metrics-heartbeat', daemon=True).start()
+
+    def _beat(self, pid):
+        """Flushes whenever requests haven't for a flush interval, so a live worker's snapshot never expires"""
+
+        while self._heartbeat == pid:
+            time.sleep(self.flush_seconds)
+            if time.monotonic() - self._flushed_at >= self.flush_seconds:
+                try:
+                    self.flush()
+                except sqlite3.Error:
+                    pass
+
+    # aggregation
+
+    def observe(self, route, method, status, seconds, sample):
+        """Adds one finished request to the histograms, flushing a snapshot when one is due"""
+
+        values = {'request_seconds': seconds, 'request_db_seconds': sample.db, 'request_queries': sample.queries,
+                  'request_upstream_seconds': sample.upstream, 'request_template_seconds': sample.template}
+        key = (route, method)
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked from a process that already counted requests
+                self._reset()
+            for name, value in values.items():
+                buckets = SERIES[name][1]
+                h = self._series[name].get(key)
+                if h is None:
+                    h = self._series[name][key] = [0] * (len(buckets) + 3)
+                h[bisect.bisect_left(buckets, value)] += 1
+                h[-2] += value
+                h[-1] += 1
+            counter = (route, method, str(status))
+            self._requests[counter] = self._requests.get(counter, 0) + 1
+            due = time.monotonic() - self._flushed_at >= self.flush_seconds
+
+        # on an event loop the heartbeat thread flushes instead, so SQLite's lock can't stall it
+        if due and not _on_event_loop():
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            return {'series': {name: {'\0'.join(k): v[:] for k, v in h.items()} for name, h in self._series.items()},
+                    'requests': {'\0'.join(k): n for k, n in self._requests.items()}}
+
+    def _ttl(self):
+        return self.retention_seconds or 3 * self.flush_seconds
+
+    def _conn(self):
+        """One connection per thread (and per process, since forks get a fresh local)"""
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid() or self._local.path != self.path:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.path = self.path
+
+        return conn
+
+    def _forget(self, written):
+        """Subtracts counts already folded into EXITED from this worker's histograms"""
+
+        with self._lock:
+            for name, histograms in written['series'].items():
+                for key, h in histograms.items():
+                    current = self._series[name][tuple(key.split('\0'))]
+                    current[:] = [a - b for a, b in zip(current, h)]
+            for key, n in written['requests'].items():
+                self._requests[tuple(key.split('\0'))] -= n
+
+    def flush(self):
+        """Writes this worker's snapshot to the shared file, folding those of workers gone quiet into EXITED"""
+
+        data = self.snapshot()
+        self._flushed_at = time.monotonic()
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if (self._written is not None and
+                    conn.execute('SELECT 1 FROM snapshots WHERE worker = ?', (self._worker,)).fetchone() is None):
+                # this worker went quiet long enough to be folded: only write what came after
+                self._forget(self._written)
+                _merge(data, self._written, -1)
+
+            stale = conn.execute('SELECT worker, data FROM snapshots WHERE written_at < ? AND worker != ?',
+                                 (now - self._ttl(), EXITED)).fetchall()
+            if stale:
+                row = conn.execute('SELECT data FROM snapshots WHERE worker = ?', (EXITED,)).fetchone()
+                exited = json.loads(row[0]) if row else {'series': {}, 'requests': {}}
+                for _, snapshot in stale:
+                    _merge(exited, json.loads(snapshot))
+                conn.execute('INSERT OR REPLACE INTO snapshots (worker, data, written_at) VALUES (?, ?, ?)',
+                             (EXITED, json.dumps(exited, separators=(',', ':')), now))
+                conn.executemany('DELETE FROM snapshots WHERE worker = ?', [(worker,) for worker, _ in stale])
+
+            conn.execute('INSERT OR REPLACE INTO snapshots (worker, data, written_at) VALUES (?, ?, ?)',
+                         (self._worker, json.dumps(data, separators=(',', ':')), now))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._written = data
+
+    def collect(self):
+        """Histograms and request counts summed over every worker's latest snapshot and EXITED"""
+
+        self.flush()
+        total = {'series': {name: {} for name in SERIES}, 'requests': {}}
+        for (data,) in self._conn().execute('SELECT data FROM snapshots'):
+            _merge(total, json.loads(data))
+
+        return total['series'], total['requests']
+
+    def render(self):
+        """Prometheus text exposition of collect()"""
+
+        series, requests = self.collect()
+        lines = [f'# HELP {PREFIX}requests_total Requests by route, method and status.',
+                 f'# TYPE {PREFIX}requests_total counter']
+        for key, n in sorted(requests.items()):
+            route, method, status = key.split('\0')
+            lines.append(f'{PREFIX}requests_total{_labels(route=route, method=method, status=status)} {n}')
+
+        for name, (help, buckets) in SERIES.items():
+            lines += [f'# HELP {PREFIX}{name} {help}', f'# TYPE {PREFIX}{name} histogram']
+            for key, h in sorted(series.get(name, {}).items()):
+                route, method = key.split('\0')
+                cumulative = 0
+                for bound, n in zip([*buckets, '+Inf'], h[:-2]):
+                    cumulative += n
+                    lines.append(f'{PREFIX}{name}_bucket{_labels(route=route, method=method, le=bound)} {cumulative}')
+                lines.append(f'{PREFIX}{name}_sum{_labels(route=route, method=method)} {h[-2]:.6f}')
+                lines.append(f'{PREFIX}{name}_count{_labels(route=route, method=method)} {h[-1]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        """Drops every worker's metrics"""
+
+        with self._lock:
+            self._reset()
+        self._conn().execute('DELETE FROM snapshots')
+
+
+metrics = Metrics()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _statement_started(conn, cursor, statement, parameters, context, executemany):
+    sample = _sample.get()
+    if sample is not None:
+        sample._statement = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _statement_finished(conn, cursor, statement, parameters, context, executemany):
+    sample = _sample.get()
+    if sample is not None and sample._statement is not None:
+        sample.db += time.perf_counter() - sample._statement
+        sample.queries += 1
+        sample._statement = None
@@ -1,10 +1,12 @@
-from datetime import datetime
+from datetime import date, datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import backref
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR, ExcludeConstraint, insert
+from sqlalchemy.orm import Session, backref
+
+from passwords import passwords, HashingBusy
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 def connect_db(app):
@@ -13,6 +15,11 @@ def connect_db(app):
     db.app = app
     db.init_app(app)
 
+def escape_like(value):
+    """value with LIKE wildcards escaped, so it matches literally"""
+
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
 class User(db.Model):
     """Users."""
 
@@ -47,17 +54,24 @@ class User(db.Model):
                             default=datetime.utcnow,
                             nullable=False)
     
+    # passive_deletes: the users_races foreign keys cascade, so deleting a user or race
+    # doesn't load every race's trainees to remove the association rows one by one
     races = db.relationship('Race',
                             single_parent=True,
                             secondary="users_races",
                             cascade='all, delete, delete-orphan',
-                            backref="trainees")
+                            passive_deletes=True,
+                            backref=db.backref("trainees", passive_deletes=True))
+
+    __table_args__ = (
+        db.Index('ix_users_username_trgm', 'username', postgresql_using='gin', postgresql_ops={'username': 'gin_trgm_ops'}),
+    )
 
 
     @classmethod
     def signup(cls, username, email, password, first_name, last_name):
         """creates instance of user and password"""
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash(password)
 
         user = User(
                 username=username,
@@ -73,16 +87,41 @@ class User(db.Model):
 
     @classmethod
     def authenticate(cls, username, password):
-        """compares username and password provided with users in db"""
+        """compares username and password provided with users in db.
+
+        Hashes made at a lower cost than configured are upgraded in place; the caller commits."""
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    try:
+                        user.password = passwords.hash(password)
+                    except HashingBusy:
+                        # upgrade on a quieter login
+                        pass
                 return user
 
         return False
+
+    @classmethod
+    def public_races_query(cls, username):
+        """races on the vision boards of public users whose username contains `username`.
+
+        One joined query; the substring match is served by the username trigram
+        index. Returns (select, sort keys) for keyset pagination, soonest first."""
+
+        q = (db.select(cls.id.label('user_id'), cls.username, Race.name, Race.city, Race.state, Race.start_date,
+                       Race.next_date)
+             .join(User_Race, User_Race.user_id == cls.id)
+             .join(Race, Race.id == User_Race.race_id)
+             .filter(cls.is_public, cls.username.contains(username, autoescape=True)))
+        # races added before the catalog sync have no parsed date; they sort last
+        keys = [db.func.coalesce(Race.next_date, date.max), User_Race.id]
+
+        return q, keys
 # 
 # 
 
@@ -95,7 +134,8 @@ class Race(db.Model):
                     primary_key=True,
                     autoincrement=True)
     name = db.Column(db.String(80),
-                    nullable=False)
+                    nullable=False,
+                    index=True)
     city = db.Column(db.String)
     state = db.Column(db.String)
     info = db.Column(db.Text)
@@ -104,6 +144,109 @@ class Race(db.Model):
                                 default='https://encrypted-tbn0.gstatic.com/images?q=tbn:ANd9GcTdX_uUSvKmz2ITnpw8W5VVJQzqEdOxUrlW1Q&usqp=CAU')
     start_date = db.Column(db.String,
                             nullable=False)           
+    runsignup_id = db.Column(db.Integer,
+                            unique=True)
+    next_date = db.Column(db.Date,
+                            index=True)
+    url = db.Column(db.Text)
+    event_type = db.Column(db.String(20))
+    last_modified = db.Column(db.Integer)
+    search_vector = db.Column(TSVECTOR,
+                            db.Computed("setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+                                        "setweight(to_tsvector('simple', coalesce(city, '') || ' ' || coalesce(state, '')), 'B')",
+                                        persisted=True))
+
+    __table_args__ = (
+        db.Index('ix_races_search_vector', 'search_vector', postgresql_using='gin'),
+        db.Index('ix_races_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+        db.Index('ix_races_city_trgm', 'city', postgresql_using='gin', postgresql_ops={'city': 'gin_trgm_ops'}),
+        db.Index('ix_races_state_trgm', 'state', postgresql_using='gin', postgresql_ops={'state': 'gin_trgm_ops'}),
+    )
+
+    def as_listing(self):
+        """race in the same shape as a RunSignup listing entry"""
+
+        return {'race': {
+                    'race_id': self.runsignup_id,
+                    'name': self.name,
+                    'address': {
+                        'city': self.city,
+                        'state': self.state
+                    },
+                    'next_date': self.start_date,
+                    'sort_date': self.next_date,
+                    'url': self.url}}
+
+    @classmethod
+    def upsert_query(cls, values):
+        """INSERT of a race keyed on runsignup_id, returning its id whether it was new or already there.
+
+        An existing row is left as the catalog sync wrote it."""
+
+        stmt = insert(cls).values(values)
+
+        return stmt.on_conflict_do_update(
+            index_elements=[cls.runsignup_id],
+            # a no-op update, so RETURNING also yields the existing row
+            set_={'runsignup_id': stmt.excluded.runsignup_id},
+        ).returning(cls.id)
+
+    @classmethod
+    def search_query(cls, event_type=None, name=None, city=None, state=None, start_date=None):
+        """upcoming races in the local catalog.
+
+        A name is matched against the full-text index, or by trigram word
+        similarity so typos still match, and results are ranked by relevance.
+        Without a name, soonest races come first. event_type may be a list of
+        types. Returns (select, sort keys) for keyset pagination."""
+
+        q = db.select(cls).filter(cls.next_date >= (start_date or db.func.current_date()))
+        if isinstance(event_type, str):
+            q = q.filter(cls.event_type == event_type)
+        elif event_type:
+            q = q.filter(cls.event_type.in_(event_type))
+        if city:
+            q = q.filter(cls.city.ilike(escape_like(city), escape='\\'))
+        if state:
+            q = q.filter(cls.state.ilike(escape_like(state), escape='\\'))
+
+        if name:
+            query = db.func.websearch_to_tsquery('simple', name)
+            q = q.filter(db.or_(cls.search_vector.op('@@')(query),
+                                db.literal(name).op('<%')(cls.name)))
+            rank = db.func.ts_rank(cls.search_vector, query) + db.func.word_similarity(name, cls.name)
+            keys = [-rank, cls.next_date, cls.id]
+        else:
+            keys = [cls.next_date, cls.id]
+
+        return q.order_by(*keys), keys
+
+    @classmethod
+    def search(cls, limit=50, **filters):
+        """first `limit` results of search_query"""
+
+        q, keys = cls.search_query(**filters)
+
+        return db.session.execute(q.limit(limit)).scalars().all()
+
+
+event.listen(db.Model.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
+
+class SyncState(db.Model):
+    """High-water marks for background syncs."""
+
+    __tablename__ = "sync_state"
+
+    name = db.Column(db.String(50),
+                    primary_key=True)
+    high_water_mark = db.Column(db.Integer,
+                    nullable=False,
+                    default=0)
+    last_run_at = db.Column(db.DateTime)
+    last_count = db.Column(db.Integer,
+                    nullable=False,
+                    default=0)
 
 class User_Race(db.Model):
     """Users Races."""
@@ -125,9 +268,44 @@ class User_Race(db.Model):
     is_complete = db.Column(db.Boolean,
                         nullable=False,
                         default=False)
+
+    __table_args__ = (
+        db.Index('ix_users_races_user_id_race_id', 'user_id', 'race_id'),
+        # at most one active race per user; doubles as the index for the profile's active race lookup.
+        # a partial unique index would be checked row by row, failing activate() halfway through
+        # its single UPDATE, so this is a deferrable exclusion constraint checked at statement end
+        ExcludeConstraint(('user_id', '='),
+                          name='ex_users_races_one_active',
+                          using='btree',
+                          where=db.text('is_active'),
+                          deferrable=True,
+                          initially='IMMEDIATE'),
+    )
+
+    # trainings are removed by the foreign key cascade rather than one by one, which
+    # skips training_stats' per row events: rebuild_weekly after deleting a race
     trainings = db.relationship('Training',
                             cascade='all, delete, delete-orphan',
+                            passive_deletes=True,
                             backref='race')
+    # the race itself (Training.race is the users_races row); viewonly, as User.races writes race_id
+    race_info = db.relationship('Race', viewonly=True)
+
+    @classmethod
+    def activate(cls, user_id, race_id):
+        """Makes race_id the user's only active race with one UPDATE.
+
+        Returns the activated users_races id, or None (changing nothing) if
+        the user hasn't added that race."""
+
+        has_race = db.select(cls.id).filter_by(user_id=user_id, race_id=race_id).exists()
+        stmt = (db.update(cls)
+                .where(cls.user_id == user_id, has_race)
+                .values(is_active=(cls.race_id == race_id))
+                .returning(cls.id, cls.is_active)
+                .execution_options(synchronize_session='fetch'))
+
+        return next((id for id, is_active in db.session.execute(stmt) if is_active), None)
 
     def deactivate(cls):
             """"deactivate races in users races upon the activation of a new one"""
@@ -160,7 +338,147 @@ class Training(db.Model):
     units = db.Column(db.String(6))
     created_at = db.Column(db.DateTime,
                         nullable=False,
-                        default=datetime.utcnow())
+                        default=datetime.utcnow)
+
+    track = db.relationship('TrainingTrack',
+                            uselist=False,
+                            cascade='all, delete, delete-orphan',
+                            backref='training')
+
+    @property
+    def pace(self):
+        """'m:ss' per mile or km, when distance and time are both known"""
+
+        if not (self.distance and self.time_spent) or self.units not in ('miles', 'km'):
+            return None
+        seconds = round(self.time_spent * 60 / self.distance)
+
+        return f'{seconds // 60}:{seconds % 60:02}'
+
+
+class TrainingTrack(db.Model):
+    """GPS track of a training, one row per track with the simplified points packed into arrays.
+
+    lat_e7/lon_e7 are little-endian int32 degrees * 1e7, elevation float32
+    meters and seconds int32 offsets from started_at; see training_tracks."""
+
+    __tablename__ = "training_tracks"
+
+    training_id = db.Column(db.Integer,
+                        db.ForeignKey('trainings.id', ondelete="cascade"),
+                        primary_key=True)
+    started_at = db.Column(db.DateTime)
+    distance_m = db.Column(db.Float,
+                        nullable=False)
+    moving_seconds = db.Column(db.Integer)
+    elapsed_seconds = db.Column(db.Integer)
+    point_count = db.Column(db.Integer,
+                        nullable=False)
+    lat_e7 = db.Column(db.LargeBinary,
+                        nullable=False)
+    lon_e7 = db.Column(db.LargeBinary,
+                        nullable=False)
+    elevation = db.Column(db.LargeBinary)
+    seconds = db.Column(db.LargeBinary)
+
+    @property
+    def stored_count(self):
+        return len(self.lat_e7) // 4
+
+
+# {('users_races', id) or ('training', id): user_id} for the flush in progress
+OWNERS_KEY = 'training_owners'
+
+
+def training_owner(conn, orm_session, users_races_id=None, training_id=None):
+    """user_id owning a users_races row (or a training, by id), from the database once per flush.
+
+    Flush listeners (rollups, page cache) all need it for the same few rows;
+    users_races.user_id never changes, so the first answer serves the rest."""
+
+    owners = orm_session.info.setdefault(OWNERS_KEY, {}) if orm_session is not None else {}
+    key = ('users_races', users_races_id) if users_races_id is not None else ('training', training_id)
+    if key not in owners:
+        row = conn.execute(db.select(User_Race.user_id, User_Race.id)
+                           .filter(User_Race.id == users_races_id) if users_races_id is not None else
+                           db.select(User_Race.user_id, User_Race.id)
+                           .join(Training, Training.users_races_id == User_Race.id)
+                           .filter(Training.id == training_id)).first()
+        owners[key] = row[0] if row else None
+        if row:
+            owners[('users_races', row[1])] = row[0]
+    if training_id is not None and users_races_id is not None:
+        owners[('training', training_id)] = owners[key]
+
+    return owners[key]
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _forget_owners(orm_session, flush_context):
+    orm_session.info.pop(OWNERS_KEY, None)
+
+
+class TrainingTotal(db.Model):
+    """Per race, per workout type training totals, kept in step with trainings."""
+
+    __tablename__ = "training_totals"
+
+    users_races_id = db.Column(db.Integer,
+                        db.ForeignKey('users_races.id', ondelete="cascade"),
+                        primary_key=True)
+    type = db.Column(db.String(20),
+                    primary_key=True)
+    miles = db.Column(db.Numeric(12, 3),
+                    nullable=False,
+                    default=0)
+    minutes = db.Column(db.Integer,
+                    nullable=False,
+                    default=0)
+    sessions = db.Column(db.Integer,
+                    nullable=False,
+                    default=0)
+
+
+class WeeklyMileage(db.Model):
+    """Per user, per workout type, per ISO week training totals, kept in step with trainings."""
+
+    __tablename__ = "weekly_mileage"
+
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id', ondelete="cascade"),
+                        primary_key=True)
+    type = db.Column(db.String(20),
+                    primary_key=True)
+    week_start = db.Column(db.Date,
+                    primary_key=True)
+    miles = db.Column(db.Numeric(12, 3),
+                    nullable=False,
+                    default=0)
+    minutes = db.Column(db.Integer,
+                    nullable=False,
+                    default=0)
+    sessions = db.Column(db.Integer,
+                    nullable=False,
+                    default=0)
+
+    __table_args__ = (
+        # chart reads cover every type for a date range, so week before type
+        db.Index('ix_weekly_mileage_user_id_week_start', 'user_id', 'week_start'),
+    )
+
+    def serialize(self):
+        """JSON for the weekly mileage API"""
+
+        year, week, _ = self.week_start.isocalendar()
+
+        return {
+            'week': f'{year}-W{week:02}',
+            'week_start': self.week_start.isoformat(),
+            'type': self.type,
+            'miles': float(self.miles),
+            'minutes': self.minutes,
+            'sessions': self.sessions,
+        }
 
 #     songs = db.relationship("Song", 
 #                             secondary='playlist_songs',
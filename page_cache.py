@@ -0,0 +1,264 @@
+"""Rendered page cache for user profiles and vision boards.
+
+Every user has a version counter, bumped after any commit that wrote their
+User, User_Race, Training or TrainingTrack rows. A page is cached under its
+path, the owner's version and the viewer (id and version, since the nav bar
+shows the viewer's name). Its strong ETag is derived from the same parts,
+so a repeat visit is answered 304 from the counters alone, without running
+the view or touching Postgres.
+
+Counters and pages live in one SQLite file shared by every worker on the
+host, like race_cache. Writes that bypass the ORM (bulk UPDATEs, COPY,
+the catalog sync's race upserts) call touch() themselves.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, request, session
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import db, Training, TrainingTrack, User, User_Race, training_owner
+
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'runners_vision_page_cache.sqlite3')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    user_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    key TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    body BLOB NOT NULL,
+    mimetype TEXT NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_user_id ON pages (user_id);
+CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at);
+"""
+
+PENDING_KEY = 'page_cache_users'
+# users whose bumps wait for take_bumps()
+DEFERRED_KEY = 'page_cache_deferred'
+
+
+class PageCache:
+    """Per-user version counters and the pages cached under them, shared across processes."""
+
+    def __init__(self, path=DEFAULT_PATH, max_entries=2000, enabled=True):
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._local = threading.local()
+        self._salt = None
+
+    def init_app(self, app):
+        """Configures cache from app config."""
+
+        self.path = app.config.get('PAGE_CACHE_PATH', self.path)
+        self.max_entries = app.config.get('PAGE_CACHE_MAX_ENTRIES', self.max_entries)
+        self.enabled = app.config.get('PAGE_CACHE_ENABLED', self.enabled)
+        self._local = threading.local()
+        self._salt = self._templates_digest(app)
+
+    @staticmethod
+    def _templates_digest(app):
+        """Hash of the template sources, so a deploy that changes them changes every ETag"""
+
+        digest = hashlib.sha1()
+        folder = os.path.join(app.root_path, app.template_folder)
+        for root, dirs, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as f:
+                    digest.update(name.encode() + b'\0' + f.read())
+
+        return digest.hexdigest()[:12]
+
+    def _conn(self):
+        """One connection per thread (and per process, since forks get a fresh local)"""
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid() or self._local.path != self.path:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.path = self.path
+
+        return conn
+
+    def versions(self, *user_ids):
+        """Current version of each user id (0 if never bumped)"""
+
+        ids = [i for i in user_ids if i is not None]
+        rows = dict(self._conn().execute(
+            f'SELECT user_id, version FROM versions WHERE user_id IN ({",".join("?" * len(ids))})', ids).fetchall())
+
+        return [rows.get(i, 0) if i is not None else 0 for i in user_ids]
+
+    def bump(self, *user_ids):
+        """Moves each user to a new version and drops their cached pages"""
+
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for user_id in user_ids:
+                conn.execute('INSERT INTO versions (user_id, version) VALUES (?, 1) '
+                             'ON CONFLICT(user_id) DO UPDATE SET version = version + 1', (user_id,))
+                conn.execute('DELETE FROM pages WHERE user_id = ?', (user_id,))
+
+    def get(self, key):
+        """(body, mimetype) cached under key, or None"""
+
+        conn = self._conn()
+        row = conn.execute('SELECT body, mimetype FROM pages WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            conn.execute('UPDATE pages SET accessed_at = ? WHERE key = ?', (time.time(), key))
+
+        return row
+
+    def set(self, key, user_id, body, mimetype):
+        """Stores a page and evicts least recently read ones past max_entries"""
+
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO pages (key, user_id, body, mimetype, accessed_at) '
+                         'VALUES (?, ?, ?, ?, ?)', (key, user_id, body, mimetype, time.time()))
+            over = conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0] - self.max_entries
+            if over > 0:
+                conn.execute('DELETE FROM pages WHERE key IN '
+                             '(SELECT key FROM pages ORDER BY accessed_at ASC LIMIT ?)', (over,))
+
+    def key(self, user_id):
+        """Cache key (also the ETag) of the current request's page about user_id"""
+
+        viewer_id = g.user.id if g.get('user') else None
+        version, viewer_version = self.versions(user_id, viewer_id)
+        raw = f'{self._salt}|{request.full_path}|{user_id}:{version}|{viewer_id}:{viewer_version}'
+
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def clear(self):
+        """Removes all pages and versions"""
+
+        conn = self._conn()
+        conn.execute('DELETE FROM pages')
+        conn.execute('DELETE FROM versions')
+
+
+page_cache = PageCache()
+
+
+def cached_page(view):
+    """Serves a view's 200 responses from page_cache, with a strong ETag and 304s.
+
+    The view must take a user_id argument naming whose page it is. Requests
+    with flashed messages waiting skip the cache, since the page shows them."""
+
+    @wraps(view)
+    def wrapper(user_id, **kwargs):
+        if not page_cache.enabled or '_flashes' in session:
+            return view(user_id, **kwargs)
+
+        key = page_cache.key(user_id)
+        headers = {'ETag': f'"{key}"', 'Cache-Control': 'private, no-cache'}
+        if request.if_none_match.contains(key):
+            return current_app.response_class(status=304, headers=headers)
+
+        cached = page_cache.get(key)
+        if cached is not None:
+            body, mimetype = cached
+            return current_app.response_class(body, mimetype=mimetype, headers={**headers, 'X-Page-Cache': 'hit'})
+
+        response = current_app.make_response(view(user_id, **kwargs))
+        if response.status_code != 200 or '_flashes' in session:
+            return response
+
+        page_cache.set(key, user_id, response.get_data(), response.mimetype)
+        response.headers.update(headers)
+
+        return response
+
+    return wrapper
+
+
+def touch(user_id, orm_session=None):
+    """Bumps user_id's version when the current transaction commits.
+
+    For writes the mapper events below can't see, like bulk UPDATEs and COPY."""
+
+    (orm_session or db.session).info.setdefault(PENDING_KEY, set()).add(user_id)
+
+
+def _touch_from_flush(target, conn, user_id=None, **owner):
+    orm_session = inspect(target).session
+    if user_id is None and owner:
+        user_id = training_owner(conn, orm_session, **owner)
+    if user_id is not None and orm_session is not None:
+        touch(user_id, orm_session)
+
+
+def _user_written(mapper, conn, user):
+    _touch_from_flush(user, conn, user_id=user.id)
+
+
+def _users_race_written(mapper, conn, u_r):
+    _touch_from_flush(u_r, conn, user_id=u_r.user_id)
+
+
+def _training_written(mapper, conn, t):
+    _touch_from_flush(t, conn, users_races_id=t.users_races_id, training_id=t.id)
+
+
+def _track_written(mapper, conn, track):
+    _touch_from_flush(track, conn, training_id=track.training_id)
+
+
+for model, listener in ((User, _user_written), (User_Race, _users_race_written),
+                        (Training, _training_written), (TrainingTrack, _track_written)):
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, name, listener)
+
+
+def defer_bumps(orm_session):
+    """Has orm_session's commits set their bumps aside for take_bumps() instead of running them.
+
+    For an AsyncSession's sync_session, whose hooks run on the event loop."""
+
+    orm_session.info[DEFERRED_KEY] = set()
+
+
+def take_bumps(orm_session):
+    """User ids whose bumps orm_session's commits set aside since the last call"""
+
+    user_ids = orm_session.info.get(DEFERRED_KEY, set())
+    orm_session.info[DEFERRED_KEY] = set()
+
+    return user_ids
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_after_commit(orm_session):
+    # after the commit, so a page rendered from the old rows is never cached under the new version
+    user_ids = orm_session.info.pop(PENDING_KEY, None)
+    if user_ids and page_cache.enabled:
+        if DEFERRED_KEY in orm_session.info:
+            orm_session.info[DEFERRED_KEY] |= user_ids
+        else:
+            page_cache.bump(*user_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_after_rollback(orm_session):
+    orm_session.info.pop(PENDING_KEY, None)
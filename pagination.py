@@ -0,0 +1,165 @@
+"""Keyset pagination with opaque cursors.
+
+A page is read with `WHERE (k1, k2, ...) > (:last_k1, :last_k2, ...)` over an
+index-friendly ordering, so page 500 costs the same as page 1. Cursors carry
+the boundary keys, signed with the app secret so they can't be forged.
+
+Several result streams can be chained: the list continues into the next
+stream once the current one runs out, and a cursor records which stream it
+points into.
+
+Lists fetched from elsewhere can be merged into the pages: a merge cursor
+holds the keyset cursor, how far into each list the pages have got, and the
+positions earlier pages started at, for the way back.
+"""
+
+from collections import namedtuple
+from datetime import date
+
+from flask import current_app
+from itsdangerous import BadData, URLSafeSerializer
+from sqlalchemy import tuple_
+
+from models import db
+
+
+Page = namedtuple('Page', 'items next prev keys')
+EMPTY_PAGE = Page([], None, None, [])
+
+# cursor: keyset cursor (None for the start), done: the streams ran out, offsets: {list: items used}
+Position = namedtuple('Position', 'cursor done offsets')
+
+
+def _serializer(salt='page-cursor'):
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt=salt)
+
+
+def _dump(v):
+    return {'d': v.isoformat()} if isinstance(v, date) else v
+
+
+def _load(v):
+    return date.fromisoformat(v['d']) if isinstance(v, dict) else v
+
+
+def encode_cursor(stream, keys, backwards=False):
+    """Opaque token pointing just after (or before, if backwards) keys in stream"""
+
+    return _serializer().dumps([stream, [_dump(k) for k in keys], backwards])
+
+
+def decode_cursor(token):
+    """Returns (stream, keys, backwards), or None for a missing or tampered token"""
+
+    if not token:
+        return None
+    try:
+        stream, keys, backwards = _serializer().loads(token)
+    except (BadData, ValueError, TypeError):
+        return None
+
+    return stream, [_load(k) for k in keys], bool(backwards)
+
+
+def cursor_after(page, i):
+    """Cursor pointing just after the page's i-th item"""
+
+    return encode_cursor(*page.keys[i])
+
+
+def encode_merge_cursor(position, trail):
+    """Opaque token for a merged page starting at position, after pages starting at each of trail"""
+
+    return _serializer('merge-cursor').dumps([list(position), [list(p) for p in trail]])
+
+
+def decode_merge_cursor(token):
+    """Returns (Position, trail), or None for a missing, tampered or plain keyset token"""
+
+    if not token:
+        return None
+    try:
+        position, trail = _serializer('merge-cursor').loads(token)
+        return Position(*position), [Position(*p) for p in trail]
+    except (BadData, ValueError, TypeError):
+        return None
+
+
+def _fetch_stmt(stmt, keys, boundary, backwards, limit):
+    stmt = stmt.add_columns(*[k.label(f'_key{i}') for i, k in enumerate(keys)])
+    if boundary is not None:
+        row_keys = tuple_(*keys)
+        stmt = stmt.filter(row_keys < tuple(boundary) if backwards else row_keys > tuple(boundary))
+
+    return stmt.order_by(None).order_by(*[k.desc() if backwards else k.asc() for k in keys]).limit(limit)
+
+
+def _plan(streams, cursor, per_page):
+    """Generator doing the paging; yields statements, is sent their rows and returns the Page.
+
+    Keeps the logic independent of how statements run, so the sync and async
+    entry points share it."""
+
+    position = decode_cursor(cursor)
+    if position and not 0 <= position[0] < len(streams):
+        position = None
+    stream, boundary, backwards = position or (0, None, False)
+
+    found = []
+    step = -1 if backwards else 1
+    while 0 <= stream < len(streams) and len(found) <= per_page:
+        stmt, keys = streams[stream]
+        n = len(keys)
+        rows = yield _fetch_stmt(stmt, keys, boundary, backwards, per_page + 1 - len(found))
+        found += [(stream, row, tuple(row[-n:])) for row in rows]
+        stream += step
+        boundary = None
+
+    more = len(found) > per_page
+    found = found[:per_page]
+    if backwards:
+        found.reverse()
+    if not found:
+        return EMPTY_PAGE
+
+    first, last = found[0], found[-1]
+    has_next = backwards or more
+    has_prev = (more if backwards else position is not None)
+
+    return Page(
+        # single-entity selects yield the entity, others the row (with its extra _key columns)
+        items=[(s, row[0] if len(row) - len(row_keys) == 1 else row) for s, row, row_keys in found],
+        next=encode_cursor(last[0], last[2]) if has_next else None,
+        prev=encode_cursor(first[0], first[2], backwards=True) if has_prev else None,
+        keys=[(s, row_keys) for s, _, row_keys in found],
+    )
+
+
+def paginate(streams, cursor=None, per_page=50):
+    """Reads one page from a chain of (select, keys) streams.
+
+    keys are the ascending sort expressions of each select; the last must be
+    unique. Returns Page(items, next, prev, keys) where items are (stream index,
+    row) pairs, next/prev are cursor tokens, or None at either end, and keys
+    are each item's (stream index, sort keys), for cursor_after.
+    """
+
+    plan = _plan(streams, cursor, per_page)
+    try:
+        stmt = next(plan)
+        while True:
+            stmt = plan.send(db.session.execute(stmt).all())
+    except StopIteration as done:
+        return done.value
+
+
+async def apaginate(session, streams, cursor=None, per_page=50):
+    """paginate() on an AsyncSession"""
+
+    plan = _plan(streams, cursor, per_page)
+    try:
+        stmt = next(plan)
+        while True:
+            stmt = plan.send((await session.execute(stmt)).all())
+    except StopIteration as done:
+        return done.value
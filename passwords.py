@@ -0,0 +1,112 @@
+"""Password hashing with back pressure across the whole host.
+
+bcrypt is deliberately slow, and a burst of logins hashed by every web
+worker at once would fight over the same cores and tie them all up. A hash
+or check first takes one of PASSWORD_MAX_PENDING slots (one per CPU by
+default) shared by every process on the host: flock()ed files next to the
+other caches, which the kernel releases even if a worker dies mid-hash.
+When every slot is taken callers get HashingBusy straight away, so views
+can answer 503 instead of piling up. bcrypt releases the GIL, so the hash
+runs in the calling thread.
+
+The cost factor comes from BCRYPT_LOG_ROUNDS. Hashes made at a lower cost
+are reported by needs_rehash so they can be upgraded on the next login.
+"""
+
+import fcntl
+import os
+import tempfile
+from contextlib import contextmanager
+
+import bcrypt
+
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'runners_vision_password_slot')
+
+# bcrypt only looks at the first 72 bytes; older releases truncated silently, newer ones raise
+MAX_PASSWORD_BYTES = 72
+
+
+class HashingBusy(Exception):
+    """Every hashing slot on the host is taken"""
+
+
+def _encode(password):
+    return password.encode('utf-8')[:MAX_PASSWORD_BYTES]
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(_encode(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    try:
+        return bcrypt.checkpw(_encode(password), hashed.encode('utf-8'))
+    except ValueError:
+        # not a bcrypt hash
+        return False
+
+
+def cost(hashed):
+    """Log rounds a bcrypt hash was made with, or None if it isn't one"""
+
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Runs bcrypt in the calling thread once it holds one of the host's hashing slots"""
+
+    def __init__(self, rounds=12, max_pending=None, path=DEFAULT_PATH):
+        self.rounds = rounds
+        self.max_pending = max_pending or os.cpu_count()
+        self.path = path
+
+    def init_app(self, app):
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', int(os.environ.get('BCRYPT_LOG_ROUNDS', self.rounds)))
+        self.max_pending = app.config.get('PASSWORD_MAX_PENDING', self.max_pending)
+        self.path = app.config.get('PASSWORD_SLOTS_PATH', self.path)
+
+    @contextmanager
+    def slot(self):
+        """Holds a free slot file for the block, or raises HashingBusy when all are held"""
+
+        for i in range(self.max_pending):
+            fd = os.open(f'{self.path}.{i}', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            try:
+                yield
+            finally:
+                # closing the file releases the lock
+                os.close(fd)
+            return
+
+        raise HashingBusy()
+
+    def _run(self, fn, *args):
+        with self.slot():
+            return fn(*args)
+
+    def hash(self, password):
+        """bcrypt hash of password at the configured cost"""
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Whether password matches hashed"""
+
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Whether hashed was made at less than the configured cost"""
+
+        return (cost(hashed) or 0) < self.rounds
+
+
+passwords = PasswordHasher()
@@ -0,0 +1,138 @@
+"""Per-view SQL query budgets.
+
+Views declare the most statements one request may run:
+
+    @bp.route('/user/<int:user_id>')
+    @query_budget(4)
+    def user_profile(user_id): ...
+
+A budget is a constant, so a view whose queries grow with the data (an N+1
+over a relationship, a query per race in a loop) goes over it as soon as the
+fixtures are big enough. QUERY_BUDGET_MODE decides what happens then:
+'raise' (the default under TESTING) fails the request with
+QueryBudgetExceeded, 'warn' logs the same report, 'off' (the default
+otherwise) doesn't count at all. The report groups the statements by the
+line of app code, model or template that ran them.
+
+Statements run by a streamed response body, after the view has returned,
+aren't counted.
+"""
+
+import os
+import sys
+from collections import Counter
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + os.sep
+MODES = ('off', 'warn', 'raise')
+SHOWN_SITES = 10
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request ran more SQL statements than its view's budget"""
+
+
+class QueryRecorder:
+    """Statements run while active, with the app code line that ran each one"""
+
+    def __init__(self):
+        self.statements = []
+        self._token = None
+
+    def __enter__(self):
+        self._token = _recorder.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _recorder.reset(self._token)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def by_site(self):
+        """[(call site, count, first statement)] most frequent first"""
+
+        counts = Counter(site for site, _ in self.statements)
+        first = {}
+        for site, statement in self.statements:
+            first.setdefault(site, statement)
+
+        return [(site, n, first[site]) for site, n in counts.most_common()]
+
+    def report(self, limit, label):
+        lines = [f'{label} ran {self.count} queries, budget is {limit}:']
+        sites = self.by_site()
+        for site, n, statement in sites[:SHOWN_SITES]:
+            lines.append(f'  {n:>4} x {site}')
+            lines.append(f'         {" ".join(statement.split())[:160]}')
+        if len(sites) > SHOWN_SITES:
+            lines.append(f'  ... and {len(sites) - SHOWN_SITES} more call sites')
+
+        return '\n'.join(lines)
+
+
+_recorder = ContextVar('query_recorder', default=None)
+
+
+def call_site():
+    """'file:line function' of the innermost app frame (template line for templates)"""
+
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(ROOT) and 'site-packages' not in filename and filename != __file__:
+            template = frame.f_globals.get('__jinja_template__')
+            if template is not None:
+                return f'{template.name}:{template.get_corresponding_lineno(frame.f_lineno)}'
+            return f'{filename[len(ROOT):]}:{frame.f_lineno} {frame.f_code.co_name}'
+        frame = frame.f_back
+
+    return '<unknown>'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _record(conn, cursor, statement, parameters, context, executemany):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.statements.append((call_site(), statement))
+
+
+def budget_mode(app):
+    mode = app.config.get('QUERY_BUDGET_MODE') or ('raise' if app.testing else 'off')
+    if mode not in MODES:
+        raise ValueError(f'QUERY_BUDGET_MODE must be one of {", ".join(MODES)}')
+
+    return mode
+
+
+def query_budget(limit):
+    """Decorator declaring the most SQL statements one request to the view may run"""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            mode = budget_mode(current_app)
+            if mode == 'off':
+                return view(*args, **kwargs)
+
+            with QueryRecorder() as recorder:
+                response = view(*args, **kwargs)
+            if recorder.count > limit:
+                report = recorder.report(limit, f'{request.method} {request.path}')
+                if mode == 'raise':
+                    raise QueryBudgetExceeded(report)
+                current_app.logger.warning(report)
+
+            return response
+
+        wrapper.query_budget = limit
+        return wrapper
+
+    return decorator
@@ -0,0 +1,300 @@
+"""Shared cache for RunSignup race listings.
+
+Entries are kept in a single SQLite file so that every gunicorn worker on the
+host reads and writes the same cache instead of each holding its own copy.
+
+A hit is a single read: hit and miss counters are kept in process and added
+to the file every `flush_seconds`, and an entry's LRU timestamp is only
+rewritten once it is older than TOUCH_FRACTION of the TTL, so hot entries
+don't queue every worker behind SQLite's write lock.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'runners_vision_race_cache.sqlite3')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    fresh_until REAL NOT NULL,
+    stale_until REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    refreshing_until REAL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+COUNTERS = ('hits', 'stale_hits', 'misses', 'evictions', 'refreshes', 'refresh_errors')
+
+# share of the TTL an entry's accessed_at may lag behind its last read
+TOUCH_FRACTION = .1
+
+
+def normalize_params(params):
+    """Returns a canonical form of a RunSignup query so equivalent searches share an entry"""
+
+    normalized = {}
+    for k, v in (params or {}).items():
+        if v is None or v == '':
+            continue
+        v = ' '.join(str(v).split()).lower()
+        if v:
+            normalized[str(k).lower()] = v
+
+    return sorted(normalized.items())
+
+
+def cache_key(params):
+    """Hashes the normalized query into a fixed length key"""
+
+    raw = json.dumps(normalize_params(params), separators=(',', ':'))
+    return hashlib.sha1(raw.encode('UTF-8')).hexdigest()
+
+
+class RaceCache:
+    """TTL cache with stale-while-revalidate and LRU eviction, shared across processes.
+
+    An entry is fresh for `ttl` seconds. After that it is served for another
+    `stale_ttl` seconds while a single background refresh replaces it. Once
+    the cache holds more than `max_entries` rows the least recently read
+    ones are evicted.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl=300, stale_ttl=3600, max_entries=500, refresh_timeout=30,
+                 flush_seconds=5):
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.refresh_timeout = refresh_timeout
+        self.flush_seconds = flush_seconds
+        self._local = threading.local()
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self._reset_counts()
+
+    def init_app(self, app):
+        """Configures cache from app config."""
+
+        self.path = app.config.get('RACE_CACHE_PATH', self.path)
+        self.ttl = app.config.get('RACE_CACHE_TTL', self.ttl)
+        self.stale_ttl = app.config.get('RACE_CACHE_STALE_TTL', self.stale_ttl)
+        self.max_entries = app.config.get('RACE_CACHE_MAX_ENTRIES', self.max_entries)
+        self.flush_seconds = app.config.get('RACE_CACHE_FLUSH_SECONDS', self.flush_seconds)
+        self._local = threading.local()
+
+    def _conn(self):
+        """One connection per thread (and per process, since forks get a fresh local)"""
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid() or self._local.path != self.path:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.path = self.path
+
+        return conn
+
+    def _reset_counts(self):
+        self._counts = {}
+        self._pid = os.getpid()
+        self._flushed_at = time.monotonic()
+
+    def _add(self, name, n=1):
+        """Adds to a counter in process; True when the counters are due a flush"""
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked from a process with counts of its own
+                self._reset_counts()
+            self._counts[name] = self._counts.get(name, 0) + n
+
+            return time.monotonic() - self._flushed_at >= self.flush_seconds
+
+    def _count(self, name, n=1):
+        if self._add(name, n):
+            self.flush()
+
+    async def _acount(self, name, n=1):
+        if self._add(name, n):
+            await asyncio.to_thread(self.flush)
+
+    def flush(self):
+        """Adds this process's counts to the shared counters"""
+
+        with self._lock:
+            counts = self._counts if self._pid == os.getpid() else {}
+            self._reset_counts()
+        if counts:
+            self._conn().executemany('INSERT INTO counters (name, value) VALUES (?, ?) '
+                                     'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                                     list(counts.items()))
+
+    def get(self, params):
+        """Returns (value, state) where state is 'fresh', 'stale' or None on a miss"""
+
+        key = cache_key(params)
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute('SELECT value, fresh_until, stale_until, accessed_at FROM entries WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None or row[2] <= now:
+            return None, None
+
+        if row[3] < now - self.ttl * TOUCH_FRACTION:
+            conn.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (now, key))
+        state = 'fresh' if row[1] > now else 'stale'
+
+        return json.loads(row[0]), state
+
+    def set(self, params, value):
+        """Stores value for params and evicts least recently used entries past max_entries"""
+
+        key = cache_key(params)
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO entries (key, value, fresh_until, stale_until, accessed_at, refreshing_until) '
+                         'VALUES (?, ?, ?, ?, ?, NULL)',
+                         (key, json.dumps(value), now + self.ttl, now + self.ttl + self.stale_ttl, now))
+            over = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0] - self.max_entries
+            if over > 0:
+                conn.execute('DELETE FROM entries WHERE key IN '
+                             '(SELECT key FROM entries ORDER BY accessed_at ASC LIMIT ?)', (over,))
+                self._count('evictions', over)
+
+    def get_or_fetch(self, params, fetch):
+        """Serves params from cache, calling fetch(params) on a miss.
+
+        Stale entries are returned immediately while one worker refreshes them
+        in the background.
+        """
+
+        value, state = self.get(params)
+
+        if state == 'fresh':
+            self._count('hits')
+            return value
+
+        if state == 'stale':
+            self._count('stale_hits')
+            if self._claim_refresh(params):
+                threading.Thread(target=self._refresh, args=(params, fetch), daemon=True).start()
+            return value
+
+        self._count('misses')
+        value = fetch(params)
+        self.set(params, value)
+
+        return value
+
+    async def aget_or_fetch(self, params, fetch):
+        """get_or_fetch for a coroutine fetch, refreshing stale entries in a task on the running loop.
+
+        SQLite calls run on threads: one waiting out another worker's write
+        lock must not stall every coroutine on the loop."""
+
+        value, state = await asyncio.to_thread(self.get, params)
+
+        if state == 'fresh':
+            await self._acount('hits')
+            return value
+
+        if state == 'stale':
+            await self._acount('stale_hits')
+            if await asyncio.to_thread(self._claim_refresh, params):
+                task = asyncio.create_task(self._arefresh(params, fetch))
+                # the loop only keeps weak references to tasks
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            return value
+
+        await self._acount('misses')
+        value = await fetch(params)
+        await asyncio.to_thread(self.set, params, value)
+
+        return value
+
+    def peek(self, params):
+        """Returns whatever is stored for params, however old, without touching the counters"""
+
+        row = self._conn().execute('SELECT value FROM entries WHERE key = ?', (cache_key(params),)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def _claim_refresh(self, params):
+        """Only one worker refreshes a stale entry at a time"""
+
+        now = time.time()
+        cur = self._conn().execute('UPDATE entries SET refreshing_until = ? WHERE key = ? '
+                                   'AND (refreshing_until IS NULL OR refreshing_until < ?)',
+                                   (now + self.refresh_timeout, cache_key(params), now))
+
+        return cur.rowcount == 1
+
+    def _refresh(self, params, fetch):
+        try:
+            value = fetch(params)
+        except Exception:
+            self._count('refresh_errors')
+            self._release_refresh(params)
+            return
+
+        self.set(params, value)
+        self._count('refreshes')
+
+    def _release_refresh(self, params):
+        self._conn().execute('UPDATE entries SET refreshing_until = NULL WHERE key = ?', (cache_key(params),))
+
+    async def _arefresh(self, params, fetch):
+        try:
+            value = await fetch(params)
+        except Exception:
+            await self._acount('refresh_errors')
+            await asyncio.to_thread(self._release_refresh, params)
+            return
+
+        await asyncio.to_thread(self.set, params, value)
+        await self._acount('refreshes')
+
+    def stats(self):
+        """Returns hit/miss counters and the current number of entries"""
+
+        self.flush()
+        conn = self._conn()
+        stats = dict.fromkeys(COUNTERS, 0)
+        stats.update(conn.execute('SELECT name, value FROM counters').fetchall())
+        stats['entries'] = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits'] + stats['stale_hits']) / lookups, 3) if lookups else 0.0
+
+        return stats
+
+    def clear(self):
+        """Removes all entries and resets counters"""
+
+        with self._lock:
+            self._reset_counts()
+        conn = self._conn()
+        conn.execute('DELETE FROM entries')
+        conn.execute('DELETE FROM counters')
+
+
+race_cache = RaceCache()
@@ -0,0 +1,156 @@
+"""Background sync of the RunSignup race catalog into the local races table.
+
+Each run pages through upcoming races for every event type and upserts them
+on runsignup_id. Only races modified since the stored high-water mark are
+requested, so after the first full load a run only fetches what changed.
+"""
+
+import time
+from datetime import date, datetime
+
+from sqlalchemy.dialects.postgresql import insert
+
+from forms import TYPE
+from models import db, Race, SyncState, User_Race
+from page_cache import touch
+from runsignup import runsignup
+
+
+SYNC_NAME = 'races'
+PER_PAGE = 1000
+UPSERT_COLUMNS = ('name', 'city', 'state', 'start_date', 'next_date', 'url', 'last_modified')
+
+_ready = False
+
+
+def parse_date(value):
+    """RunSignup dates are MM/DD/YYYY"""
+
+    try:
+        return datetime.strptime(value, '%m/%d/%Y').date()
+    except (TypeError, ValueError):
+        return None
+
+
+def race_from_listing(race, event_type=None):
+    """Column values for a RunSignup listing entry"""
+
+    address = race.get('address') or {}
+
+    return {
+        'runsignup_id': int(race['race_id']),
+        'name': race['name'][:80],
+        'city': address.get('city'),
+        'state': address.get('state'),
+        'start_date': race.get('next_date') or '',
+        'next_date': parse_date(race.get('next_date')),
+        'url': race.get('url'),
+        'event_type': event_type,
+        'last_modified': int(race.get('last_modified') or 0),
+    }
+
+
+def upsert_races(rows):
+    """Inserts or updates rows keyed on runsignup_id. Returns the upserted ids.
+
+    Cached pages of users with one of the races on their board are invalidated on commit."""
+
+    # ON CONFLICT can't touch the same row twice in one statement
+    rows = list({r['runsignup_id']: r for r in rows}.values())
+    if not rows:
+        return []
+
+    stmt = insert(Race).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Race.runsignup_id],
+        set_={c: stmt.excluded[c] for c in UPSERT_COLUMNS} | {
+            # a race listed under several event types keeps the first one it was synced under
+            'event_type': db.func.coalesce(Race.event_type, stmt.excluded.event_type)},
+    ).returning(Race.id)
+    ids = db.session.execute(stmt).scalars().all()
+
+    # profiles and vision boards show race names and dates, so cached pages of
+    # users with an updated race on their board are stale after this commits
+    for user_id in db.session.execute(db.select(User_Race.user_id).filter(User_Race.race_id.in_(ids))
+                                      .distinct()).scalars():
+        touch(user_id)
+
+    return ids
+
+
+def sync_races(client=runsignup, event_types=None, per_page=PER_PAGE, max_pages=None):
+    """Pages through the catalog and upserts races changed since the last run.
+
+    Each page is committed on its own so a failed run keeps its progress; the
+    high-water mark only moves once every page of every event type has been
+    read. Returns the number of races upserted.
+    """
+
+    state = db.session.get(SyncState, SYNC_NAME) or SyncState(name=SYNC_NAME, high_water_mark=0, last_count=0)
+    since = state.high_water_mark
+    mark = since
+    count = 0
+
+    for event_type in event_types or [t for t, _ in TYPE]:
+        page = 1
+        while max_pages is None or page <= max_pages:
+            params = {'format': 'json', 'event_type': event_type, 'start_date': date.today().isoformat(),
+                      'sort': 'date ASC', 'results_per_page': per_page, 'page': page}
+            if since:
+                params['modified_since'] = since
+
+            listing = client.races(params, deadline=client.deadline(30)).get('races') or []
+            rows = [race_from_listing(r['race'], event_type) for r in listing]
+            # upstream may ignore modified_since; skip what we already have
+            rows = [r for r in rows if not since or r['last_modified'] > since]
+            upsert_races(rows)
+            db.session.commit()
+
+            count += len(rows)
+            mark = max([mark] + [r['last_modified'] for r in rows])
+            if len(listing) < per_page:
+                break
+            page += 1
+
+    state.high_water_mark = mark
+    state.last_run_at = datetime.utcnow()
+    state.last_count = count
+    db.session.add(state)
+    db.session.commit()
+
+    return count
+
+
+def catalog_ready():
+    """Whether a sync has completed, i.e. views can be served from the races table"""
+
+    global _ready
+    if not _ready:
+        state = db.session.get(SyncState, SYNC_NAME)
+        _ready = bool(state and state.last_run_at)
+
+    return _ready
+
+
+async def acatalog_ready(session):
+    """catalog_ready() on an AsyncSession"""
+
+    global _ready
+    if not _ready:
+        state = await session.get(SyncState, SYNC_NAME)
+        _ready = bool(state and state.last_run_at)
+
+    return _ready
+
+
+def run_forever(interval, log=print):
+    """Sync every `interval` seconds, surviving upstream failures"""
+
+    while True:
+        started = time.monotonic()
+        try:
+            log(f'synced {sync_races()} races')
+        except Exception as e:
+            db.session.rollback()
+            log(f'race sync failed: {e}')
+        time.sleep(max(0, interval - (time.monotonic() - started)))
@@ -0,0 +1,279 @@
+"""RunSignup API client.
+
+One pooled keep-alive session per process, a deadline per call, bounded
+retries with jittered backoff and a circuit breaker so a hanging upstream
+can't tie up request workers.
+
+The httpx-based async client for the ASGI app is in runsignup_async, so
+WSGI workers don't import httpx.
+"""
+
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class UpstreamError(Exception):
+    """RunSignup could not answer within the deadline."""
+
+
+class CircuitOpen(UpstreamError):
+    """RunSignup has been failing; calls are short-circuited until the breaker resets."""
+
+
+class Rejected(UpstreamError):
+    """RunSignup answered with a 4xx, so the request isn't retried."""
+
+
+# RunSignupClient.retry_policy steps
+FETCH = 'fetch'
+SLEEP = 'sleep'
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and lets one trial call
+    through every `reset_timeout` seconds until a call succeeds again."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """Whether a call may go upstream right now"""
+
+        with self._lock:
+            state = self.state
+            if state == 'half_open':
+                # let a single trial call through, hold the rest until it reports back
+                self.opened_at = time.monotonic()
+                return True
+            return state == 'closed'
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class LatencyStats:
+    """Per-endpoint call counts and latency percentiles over a sliding window"""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, elapsed, ok=True):
+        with self._lock:
+            e = self._endpoints.get(endpoint)
+            if e is None:
+                e = self._endpoints[endpoint] = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0,
+                                                 'recent': deque(maxlen=self.window)}
+            e['count'] += 1
+            e['total'] += elapsed
+            e['max'] = max(e['max'], elapsed)
+            e['recent'].append(elapsed)
+            if not ok:
+                e['errors'] += 1
+
+    def snapshot(self):
+        """Returns {endpoint: stats} with latencies in milliseconds"""
+
+        out = {}
+        with self._lock:
+            for endpoint, e in self._endpoints.items():
+                recent = sorted(e['recent'])
+                out[endpoint] = {
+                    'count': e['count'],
+                    'errors': e['errors'],
+                    'avg_ms': round(e['total'] / e['count'] * 1000, 1),
+                    'p50_ms': round(percentile(recent, 50) * 1000, 1),
+                    'p95_ms': round(percentile(recent, 95) * 1000, 1),
+                    'p99_ms': round(percentile(recent, 99) * 1000, 1),
+                    'max_ms': round(e['max'] * 1000, 1),
+                }
+
+        return out
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list"""
+
+    if not ordered:
+        return 0.0
+    i = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+
+    return ordered[min(i, len(ordered) - 1)]
+
+
+class RunSignupClient:
+    """Client for the RunSignup REST api."""
+
+    def __init__(self, base_url='https://runsignup.com/rest', timeout=5.0, connect_timeout=2.0,
+                 retries=2, backoff=.2, max_backoff=2.0, pool_size=10,
+                 failure_threshold=5, reset_timeout=30):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latency = LatencyStats()
+        self._session = None
+        self._pid = None
+
+    def init_app(self, app):
+        """Configures client from app config."""
+
+        self.base_url = app.config.get('RUNSIGNUP_BASE_URL', self.base_url)
+        self.timeout = app.config.get('RUNSIGNUP_TIMEOUT', self.timeout)
+        self.connect_timeout = app.config.get('RUNSIGNUP_CONNECT_TIMEOUT', self.connect_timeout)
+        self.retries = app.config.get('RUNSIGNUP_RETRIES', self.retries)
+        self.pool_size = app.config.get('RUNSIGNUP_POOL_SIZE', self.pool_size)
+        self.breaker.failure_threshold = app.config.get('RUNSIGNUP_FAILURE_THRESHOLD', self.breaker.failure_threshold)
+        self.breaker.reset_timeout = app.config.get('RUNSIGNUP_RESET_TIMEOUT', self.breaker.reset_timeout)
+        self._session = None
+
+    @property
+    def session(self):
+        """Keep-alive session, created lazily so forked workers don't share sockets"""
+
+        if self._session is None or self._pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session = session
+            self._pid = os.getpid()
+
+        return self._session
+
+    def deadline(self, seconds=None):
+        """Absolute deadline `seconds` (default: the configured timeout) from now"""
+
+        return time.monotonic() + (self.timeout if seconds is None else seconds)
+
+    def retry_policy(self, endpoint, deadline=None):
+        """get()'s deadline, retries, backoff and circuit breaker, without the I/O.
+
+        A generator shared by this client and the async one so the two can't
+        drift apart. It yields (FETCH, seconds left) for each attempt, to be
+        answered with send(decoded json) or throw(UpstreamError), and
+        (SLEEP, seconds) between attempts. It returns the json, or raises
+        UpstreamError once retries or time run out, Rejected as soon as
+        upstream rejects the request and CircuitOpen without any attempt
+        while the breaker is open.
+        """
+
+        if deadline is None:
+            deadline = self.deadline()
+        if not self.breaker.allow():
+            raise CircuitOpen(f'RunSignup circuit open for {endpoint}')
+
+        last = None
+        for attempt in range(self.retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            start = time.monotonic()
+            try:
+                data = yield FETCH, remaining
+            except Rejected:
+                # the request itself is bad; retrying won't help and upstream is healthy
+                self.latency.record(endpoint, time.monotonic() - start, ok=False)
+                self.breaker.record_success()
+                raise
+            except UpstreamError as e:
+                self.latency.record(endpoint, time.monotonic() - start, ok=False)
+                last = e
+            else:
+                self.latency.record(endpoint, time.monotonic() - start)
+                self.breaker.record_success()
+                return data
+
+            pause = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if attempt == self.retries or time.monotonic() + pause >= deadline:
+                break
+            yield SLEEP, pause
+
+        self.breaker.record_failure()
+        raise UpstreamError(f'RunSignup {endpoint} failed: {last or "deadline exceeded"}') from last
+
+    def fetch(self, endpoint, params, remaining):
+        """One attempt: decoded json, Rejected for a 4xx, UpstreamError for anything worth retrying"""
+
+        try:
+            resp = self.session.get(self.base_url + endpoint, params=params,
+                                    timeout=(min(self.connect_timeout, remaining), remaining))
+            if resp.status_code == 429 or resp.status_code >= 500:
+                raise UpstreamError(f'RunSignup {endpoint} returned {resp.status_code}')
+            resp.raise_for_status()
+            return resp.json()
+        except requests.HTTPError as e:
+            raise Rejected(f'RunSignup {endpoint} rejected request: {e}') from e
+        except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+            raise UpstreamError(f'RunSignup {endpoint}: {e}') from e
+
+    def get(self, endpoint, params=None, deadline=None):
+        """GETs endpoint and returns decoded json.
+
+        Connection errors, timeouts and 5xx/429 responses are retried with
+        full-jitter backoff for as long as the deadline allows (see
+        retry_policy).
+        """
+
+        policy = self.retry_policy(endpoint, deadline)
+        try:
+            step, seconds = next(policy)
+            while True:
+                if step == SLEEP:
+                    time.sleep(seconds)
+                    step, seconds = next(policy)
+                    continue
+                try:
+                    data = self.fetch(endpoint, params, seconds)
+                except UpstreamError as e:
+                    step, seconds = policy.throw(e)
+                else:
+                    step, seconds = policy.send(data)
+        except StopIteration as done:
+            return done.value
+
+    def races(self, params, deadline=None):
+        """Race listing search"""
+
+        return self.get('/races', params, deadline)
+
+    def stats(self):
+        """Latency per endpoint plus breaker state"""
+
+        return {'circuit': self.breaker.state, 'endpoints': self.latency.snapshot()}
+
+
+runsignup = RunSignupClient()
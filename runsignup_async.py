@@ -0,0 +1,92 @@
+"""Async RunSignup client for the ASGI app.
+
+AsyncRunSignupClient is RunSignupClient on httpx, for a worker that keeps
+many upstream calls in flight. It lives apart from runsignup so the WSGI
+app never imports httpx.
+"""
+
+import asyncio
+
+import httpx
+
+from runsignup import SLEEP, Rejected, RunSignupClient, UpstreamError, runsignup
+
+
+class AsyncRunSignupClient(RunSignupClient):
+    """RunSignupClient whose get and races are coroutines.
+
+    Pass the sync client as `shares` to use its circuit breaker and latency
+    stats, so both report one view of upstream health."""
+
+    def __init__(self, shares=None, **kw):
+        super().__init__(**kw)
+        if shares is not None:
+            self.breaker = shares.breaker
+            self.latency = shares.latency
+        self._client = None
+        self._loop = None
+
+    def init_app(self, app):
+        super().init_app(app)
+        self._client = None
+
+    @property
+    def client(self):
+        """Keep-alive httpx client for the running event loop"""
+
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size))
+            self._loop = loop
+
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def fetch(self, endpoint, params, remaining):
+        """RunSignupClient.fetch over httpx"""
+
+        try:
+            resp = await self.client.get(endpoint, params=params,
+                                         timeout=httpx.Timeout(remaining, connect=min(self.connect_timeout, remaining)))
+            if resp.status_code == 429 or resp.status_code >= 500:
+                raise UpstreamError(f'RunSignup {endpoint} returned {resp.status_code}')
+            resp.raise_for_status()
+            return resp.json()
+        except httpx.HTTPStatusError as e:
+            raise Rejected(f'RunSignup {endpoint} rejected request: {e}') from e
+        except (httpx.TransportError, ValueError) as e:
+            raise UpstreamError(f'RunSignup {endpoint}: {e}') from e
+
+    async def get(self, endpoint, params=None, deadline=None):
+        """RunSignupClient.get, awaiting the response and backoff instead of blocking"""
+
+        policy = self.retry_policy(endpoint, deadline)
+        try:
+            step, seconds = next(policy)
+            while True:
+                if step == SLEEP:
+                    await asyncio.sleep(seconds)
+                    step, seconds = next(policy)
+                    continue
+                try:
+                    data = await self.fetch(endpoint, params, seconds)
+                except UpstreamError as e:
+                    step, seconds = policy.throw(e)
+                else:
+                    step, seconds = policy.send(data)
+        except StopIteration as done:
+            return done.value
+
+    async def races(self, params, deadline=None):
+        """Race listing search"""
+
+        return await self.get('/races', params, deadline)
+
+
+async_runsignup = AsyncRunSignupClient(shares=runsignup)
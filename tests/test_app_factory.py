@@ -0,0 +1,75 @@
+"""App factory tests."""
+
+import json
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, create_app
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class AppFactoryTestCase(TestCase):
+    """Test create_app."""
+
+    def test_config_overrides(self):
+        """Does config passed to create_app win over the environment defaults"""
+        built = create_app({'RACE_SEARCH_PAGES': 7, 'TESTING': True})
+        self.assertEqual(built.config['RACE_SEARCH_PAGES'], 7)
+        self.assertIsNot(built, app)
+
+        with built.test_client() as client:
+            self.assertEqual(client.get('/login').status_code, 200)
+
+    def test_debug_toolbar_only_when_enabled(self):
+        """Is the debug toolbar only set up when DEBUG_TB_ENABLED"""
+        self.assertNotIn('debugtoolbar', create_app({'DEBUG_TB_ENABLED': False}).blueprints)
+        self.assertIn('debugtoolbar', create_app({'DEBUG_TB_ENABLED': True}).blueprints)
+
+    def test_startup_reported(self):
+        """Are import and create_app times reported in /api/stats"""
+        with app.test_client() as client:
+            startup = client.get('/api/stats').get_json()['startup']
+        self.assertGreater(startup['import_ms'], 0)
+        self.assertGreater(startup['create_app_ms'], 0)
+
+    def test_lazy_imports(self):
+        """Does a fresh worker start without the debug toolbar, numpy or httpx"""
+        probe = ("import json, sys; from app import create_app; create_app(); "
+                 "print(json.dumps([m for m in ('flask_debugtoolbar', 'numpy', 'httpx') if m in sys.modules]))")
+        out = subprocess.run([sys.executable, '-c', probe], cwd=ROOT, check=True, capture_output=True, text=True,
+                             env={**os.environ, 'FLASK_DEBUG': '0'})
+        self.assertEqual(json.loads(out.stdout.splitlines()[-1]), [])
+
+    def test_fork_hook_once(self):
+        """Are forked children's pools dropped for every app without a fork hook per app"""
+        registered = []
+        register_at_fork = os.register_at_fork
+        os.register_at_fork = lambda **kw: registered.append(kw)
+        try:
+            built = [create_app({'TESTING': True}) for _ in range(3)]
+        finally:
+            os.register_at_fork = register_at_fork
+        self.assertEqual(registered, [])
+
+        with built[-1].app_context():
+            engine = db.engine
+        pool = engine.pool
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if engine.pool is not pool else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertIs(engine.pool, pool)
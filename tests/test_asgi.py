@@ -0,0 +1,207 @@
+"""ASGI serving mode tests."""
+
+import asyncio
+import os
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+from unittest import IsolatedAsyncioTestCase
+
+import httpx
+from sqlalchemy import event
+
+from models import db, User, Race, User_Race, Training, SyncState
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+import race_sync
+from asgi import app, application, async_runsignup, async_db
+from metrics import metrics
+from page_cache import page_cache
+from race_cache import race_cache
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.app_context().push()
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def listing(race_id, name, next_date='01/01/2030'):
+    return {'race': {'race_id': race_id, 'name': name, 'next_date': next_date,
+                     'address': {'city': 'Boston', 'state': 'MA'}, 'url': f'https://runsignup.com/Race/{race_id}'}}
+
+
+class AsgiTestCase(IsolatedAsyncioTestCase):
+    """Test the async race views and the sync fallback."""
+
+    def setUp(self):
+        """Clear data and cache, create a user."""
+
+        User.query.delete()
+        Race.query.delete()
+        User_Race.query.delete()
+        Training.query.delete()
+        SyncState.query.delete()
+        db.session.commit()
+        race_sync._ready = False
+        race_cache.clear()
+
+        User.signup('testuser1', 'test1@test.com', 'HASHED_PASSWORD', 'test1_first', 'test1_last')
+        db.session.commit()
+
+        self.upstream_calls = []
+        self.upstream_delay = 0
+        self.upstream_pages = None
+
+    async def asyncSetUp(self):
+        async def upstream(request):
+            self.upstream_calls.append(dict(request.url.params))
+            await asyncio.sleep(self.upstream_delay)
+            if self.upstream_pages is not None:
+                key = (request.url.params['event_type'], int(request.url.params['page']))
+                return httpx.Response(200, json={'races': self.upstream_pages.get(key, [])})
+            name = request.url.params.get('name', 'upstream_race')
+            return httpx.Response(200, json={'races': [listing(99, name)]})
+
+        async_runsignup._client = httpx.AsyncClient(transport=httpx.MockTransport(upstream),
+                                                    base_url='https://runsignup.test/rest')
+        async_runsignup._loop = asyncio.get_running_loop()
+        async_runsignup.breaker.record_success()
+        self.client = httpx.AsyncClient(app=application, base_url='http://test')
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        await async_runsignup.aclose()
+        await async_db.dispose()
+
+    async def test_races_from_upstream(self):
+        """Does /races call RunSignup asynchronously before the first sync"""
+        resp = await self.client.get('/races')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('upstream_race', resp.text)
+        self.assertEqual(len(self.upstream_calls), 1)
+
+    async def test_races_from_catalog(self):
+        """Does /races read the synced catalog over the async session"""
+        db.session.add(Race(name='local_race', start_date='', event_type='running_race',
+                            next_date=date.today() + timedelta(days=3)))
+        db.session.add(SyncState(name='races', high_water_mark=0, last_count=1, last_run_at=datetime.utcnow()))
+        db.session.commit()
+
+        resp = await self.client.get('/races')
+
+        self.assertIn('local_race', resp.text)
+        self.assertEqual(self.upstream_calls, [])
+
+    async def test_concurrent_upstream_calls(self):
+        """Are concurrent upstream waits overlapped in one worker"""
+        self.upstream_delay = .3
+
+        started = time.monotonic()
+        responses = await asyncio.gather(*[self.client.post('/races/search', data={'name': f'race {i}'})
+                                           for i in range(20)])
+
+        self.assertTrue(all(r.status_code == 200 for r in responses))
+        # two result pages each
+        self.assertEqual(len(self.upstream_calls), 40)
+        self.assertLess(time.monotonic() - started, 3)
+
+    async def test_search_fans_out(self):
+        """Are event types and pages fetched at once and merged by date"""
+        self.upstream_delay = .3
+        self.upstream_pages = {
+            ('running_race', 1): [listing(1, 'run_a', '02/01/2030'), listing(2, 'run_b', '04/01/2030')],
+            ('running_race', 2): [listing(3, 'run_c', '06/01/2030')],
+            ('triathlon', 1): [listing(4, 'tri_a', '03/01/2030'), listing(2, 'run_b', '04/01/2030')],
+            ('triathlon', 2): [listing(5, 'tri_b', '05/01/2030')],
+        }
+
+        started = time.monotonic()
+        resp = await self.client.post('/races/search', data={'city': 'Boston',
+                                                             'event_types': ['running_race', 'triathlon']})
+
+        self.assertLess(time.monotonic() - started, .6)
+        self.assertEqual(len(self.upstream_calls), 4)
+        positions = [resp.text.find(f'value="{n}"') for n in ('run_a', 'tri_a', 'run_b', 'tri_b', 'run_c')]
+        self.assertNotIn(-1, positions)
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(resp.text.count('value="run_b"'), 1)
+
+    async def test_add_race_with_login(self):
+        """Does a session from the sync login work for the async add_race"""
+        resp = await self.client.post('/login', data={'username': 'testuser1', 'password': 'HASHED_PASSWORD'})
+        self.assertEqual(resp.status_code, 302)
+
+        user_id = db.session.execute(db.select(User.id).filter_by(username='testuser1')).scalar_one()
+        resp = await self.client.post(f'/user/{user_id}/races/add', data={'name': 'Boston Marathon'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Would you like this to be your active race?', resp.text)
+        db.session.expire_all()
+        self.assertEqual([r.name for r in db.session.get(User, user_id).races], ['Boston Marathon'])
+        self.assertEqual(db.session.get(User, user_id).races[0].runsignup_id, 99)
+
+        resp = await self.client.post(f'/user/{user_id}/races/add', data={'name': 'Boston Marathon', 'race_id': 99})
+        self.assertEqual(resp.headers['location'], '/races')
+        self.assertEqual(len(self.upstream_calls), 1)
+
+        resp = await self.client.post(f'/user/{user_id + 1}/races/add', data={'name': 'Boston Marathon'})
+        self.assertEqual(resp.headers['location'], '/')
+
+    async def test_stale_identity_reloaded_async(self):
+        """Are expired identity claims reloaded without a blocking query on the event loop"""
+        resp = await self.client.post('/login', data={'username': 'testuser1', 'password': 'HASHED_PASSWORD'})
+        user_id = db.session.execute(db.select(User.id).filter_by(username='testuser1')).scalar_one()
+
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        # the login's claims are stale by the next request
+        app.config['IDENTITY_MAX_AGE'] = .5
+        time.sleep(.6)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            resp = await self.client.post(f'/user/{user_id}/races/add', data={'name': 'Boston Marathon'})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+            del app.config['IDENTITY_MAX_AGE']
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Would you like this to be your active race?', resp.text)
+        self.assertEqual(statements, [])
+
+    async def test_sqlite_lock_off_loop(self):
+        """Does a request waiting on another worker's SQLite write lock leave the event loop running"""
+        resp = await self.client.post('/login', data={'username': 'testuser1', 'password': 'HASHED_PASSWORD'})
+        user_id = db.session.execute(db.select(User.id).filter_by(username='testuser1')).scalar_one()
+        version = page_cache.versions(user_id)[0]
+
+        locks = []
+        for path in (race_cache.path, page_cache.path, metrics.path):
+            lock = sqlite3.connect(path, isolation_level=None)
+            lock.execute('BEGIN IMMEDIATE')
+            locks.append(lock)
+
+        gaps = []
+
+        async def tick():
+            last = time.monotonic()
+            while True:
+                await asyncio.sleep(.01)
+                gaps.append(time.monotonic() - last)
+                last = time.monotonic()
+
+        ticker = asyncio.create_task(tick())
+        request = asyncio.create_task(self.client.post(f'/user/{user_id}/races/add', data={'name': 'Boston Marathon'}))
+        await asyncio.sleep(.5)
+        for lock in locks:
+            lock.execute('ROLLBACK')
+            lock.close()
+        resp = await request
+        ticker.cancel()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertLess(max(gaps), .2)
+        self.assertEqual(page_cache.versions(user_id)[0], version + 1)
@@ -0,0 +1,68 @@
+"""Race list fragment cache tests."""
+
+import os
+from unittest import TestCase
+
+from jinja2 import FileSystemBytecodeCache
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, LISTING_FIELDS
+from fragment_cache import fragment_cache, race_items
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def listing(race_id, name, next_date='01/01/2030', **extra):
+    return {'race': {'race_id': race_id, 'name': name, 'next_date': next_date, 'description': 'long ' * 100,
+                     'address': {'city': 'Boston', 'state': 'MA'}, 'url': f'https://runsignup.com/Race/{race_id}',
+                     **extra}}
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test per race fragments."""
+
+    def setUp(self):
+        fragment_cache.clear()
+
+    def render(self, races, user_id=0):
+        return [str(html) for html in race_items(app.jinja_env, races, user_id, LISTING_FIELDS)]
+
+    def test_reuses_fragments(self):
+        """Is a race rendered once and reused while its listing is unchanged"""
+        first = self.render([listing(1, 'run_a'), listing(2, 'run_b')])
+        again = self.render([listing(2, 'run_b', description='changed'), listing(1, 'run_a')])
+
+        self.assertEqual(again, first[::-1])
+        self.assertEqual(fragment_cache.stats(), {'hits': 2, 'misses': 2, 'entries': 2})
+        self.assertIn('<input type="hidden" name="race_id" value="1">', first[0])
+        self.assertIn('<input type="hidden" name="next_date" value="01/01/2030">', first[0])
+
+    def test_key_includes_content_and_user(self):
+        """Do a changed date and another user's add form get their own fragments"""
+        self.render([listing(1, 'run_a')])
+        moved = self.render([listing(1, 'run_a', next_date='02/01/2030')])
+        other_user = self.render([listing(1, 'run_a')], user_id=7)
+
+        self.assertIn('02/01/2030', moved[0])
+        self.assertIn('action="/user/7/races/add"', other_user[0])
+        self.assertEqual(fragment_cache.stats()['misses'], 3)
+
+    def test_board_listing_and_escaping(self):
+        """Are vision board entries without a race id linked by username, and names escaped"""
+        html, = self.render([{'race': {'name': '<b>Boston</b>', 'address': {'city': None, 'state': None},
+                                       'next_date': None, 'url': '/user/3', 'url_name': 'testuser3'}}])
+
+        self.assertNotIn('name="race_id"', html)
+        self.assertIn('&lt;b&gt;Boston&lt;/b&gt;', html)
+        self.assertIn('testuser3', html)
+
+    def test_bytecode_cache(self):
+        """Are compiled templates persisted"""
+        self.assertIsInstance(app.jinja_env.bytecode_cache, FileSystemBytecodeCache)
@@ -0,0 +1,113 @@
+"""Loading plan tests."""
+
+import os
+from unittest import TestCase
+
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, User, Race, User_Race, Training
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, CURR_USER_KEY
+from loading import load_plan
+from page_cache import page_cache
+from query_budget import QueryRecorder
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LoadPlanTestCase(TestCase):
+    """Test views load their object graph before rendering."""
+
+    def setUp(self):
+        User.query.delete()
+        Race.query.delete()
+        User_Race.query.delete()
+        Training.query.delete()
+        db.session.commit()
+        page_cache.clear()
+
+        user = User(username='testuser1', email='test1@test.com', password='HASHED_PASSWORD',
+                    first_name='test1_first', last_name='test1_last')
+        for i in range(3):
+            user.races.append(Race(name=f'test race {i}', start_date='1-1-2030'))
+        db.session.add(user)
+        db.session.commit()
+
+        u_race = db.session.execute(db.select(User_Race).filter_by(user_id=user.id)).scalars().first()
+        u_race.is_active = True
+        for i in range(3):
+            db.session.add(Training(users_races_id=u_race.id, title=f'training {i}', type='run', distance=3,
+                                    units='miles'))
+        db.session.commit()
+
+        self.user_id = user.id
+        db.session.remove()
+
+        self.client = app.test_client()
+
+    def test_lazy_load_raises(self):
+        """Does an attribute left out of the plan raise instead of lazy loading?"""
+
+        with app.test_request_context():
+            user = db.session.execute(db.select(User).filter_by(id=self.user_id)
+                                      .options(*load_plan())).scalar_one()
+            with self.assertRaises(InvalidRequestError):
+                user.races
+            db.session.remove()
+
+    def test_nested_lazy_load_raises(self):
+        """Do objects loaded through a plan's options raise on attributes the plan left out?"""
+
+        with app.test_request_context():
+            u_races = db.session.execute(db.select(User_Race).filter_by(user_id=self.user_id)
+                                         .options(*load_plan(joinedload(User_Race.race_info),
+                                                             selectinload(User_Race.trainings)))
+                                         ).scalars().unique().all()
+            training = [t for u_race in u_races for t in u_race.trainings][0]
+            self.assertEqual(training.title, 'training 0')
+            with self.assertRaises(InvalidRequestError):
+                training.track
+            with self.assertRaises(InvalidRequestError):
+                training.race
+            with self.assertRaises(InvalidRequestError):
+                u_races[0].race_info.trainees
+            db.session.remove()
+
+    def test_lazy_load_allowed(self):
+        """Does an attribute left out of the plan lazy load with RAISE_LAZY_LOADS off?"""
+
+        app.config['RAISE_LAZY_LOADS'] = False
+        try:
+            with app.test_request_context():
+                user = db.session.execute(db.select(User).filter_by(id=self.user_id)
+                                          .options(*load_plan())).scalar_one()
+                self.assertEqual(len(user.races), 3)
+                db.session.remove()
+        finally:
+            del app.config['RAISE_LAZY_LOADS']
+
+    def test_no_queries_from_templates(self):
+        """Do the profile and race list render without querying from their templates?"""
+
+        app.config['QUERY_BUDGET_MODE'] = 'off'
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                for path, expected in [(f'/user/{self.user_id}', 'training 2'),
+                                       (f'/user/{self.user_id}/races', 'test race 2')]:
+                    with QueryRecorder() as recorder:
+                        resp = c.get(path)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn(expected, resp.get_data(as_text=True))
+                    self.assertEqual([site for site, _, _ in recorder.by_site() if '.html:' in site], [])
+        finally:
+            del app.config['QUERY_BUDGET_MODE']
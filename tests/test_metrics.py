@@ -0,0 +1,131 @@
+"""Request metrics tests."""
+
+import os
+import re
+import time
+from unittest import TestCase
+
+from models import db, User, Race, User_Race, Training
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, CURR_USER_KEY
+from metrics import Metrics, Sample, metrics, timing, _sample
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def value(text, line):
+    """Number on the exposition line starting with line"""
+
+    match = re.search('^' + re.escape(line) + r' (\S+)$', text, re.M)
+    return float(match.group(1)) if match else None
+
+
+class MetricsTestCase(TestCase):
+    """Test per-route metrics and /metrics."""
+
+    def setUp(self):
+        User.query.delete()
+        Race.query.delete()
+        User_Race.query.delete()
+        Training.query.delete()
+        db.session.commit()
+        metrics.clear()
+
+        self.client = app.test_client()
+
+    def test_route_histograms(self):
+        """Are requests counted per route and status with template time"""
+        self.client.get('/login')
+        self.client.get('/login')
+        self.client.get('/no/such/page')
+
+        text = self.client.get('/metrics').text
+        self.assertEqual(value(text, 'runners_vision_requests_total{route="/login",method="GET",status="200"}'), 2)
+        self.assertEqual(value(text, 'runners_vision_requests_total{route="<unmatched>",method="GET",status="404"}'), 1)
+        self.assertEqual(value(text, 'runners_vision_request_seconds_count{route="/login",method="GET"}'), 2)
+        self.assertEqual(
+            value(text, 'runners_vision_request_seconds_bucket{route="/login",method="GET",le="+Inf"}'), 2)
+        self.assertGreater(value(text, 'runners_vision_request_template_seconds_sum{route="/login",method="GET"}'), 0)
+        self.assertEqual(value(text, 'runners_vision_request_queries_sum{route="/login",method="GET"}'), 0)
+
+    def test_query_counts(self):
+        """Are SQL statements and their time counted per route"""
+        user = User(username="testuser", email="test@test.com", password="HASHED_PASSWORD",
+                    first_name='test_first', last_name='test_last')
+        db.session.add(user)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+            c.get(f'/api/users/{user.id}/weekly')
+
+        text = self.client.get('/metrics').text
+        route = 'route="/api/users/<int:user_id>/weekly",method="GET"'
+        self.assertGreaterEqual(value(text, f'runners_vision_request_queries_sum{{{route}}}'), 1)
+        self.assertGreater(value(text, f'runners_vision_request_db_seconds_sum{{{route}}}'), 0)
+
+    def test_timing(self):
+        """Does timing add to the request in flight, and do nothing outside one"""
+        with timing('upstream'):
+            time.sleep(.001)
+
+        sample = Sample()
+        token = _sample.set(sample)
+        try:
+            with timing('upstream'):
+                time.sleep(.01)
+        finally:
+            _sample.reset(token)
+        self.assertGreaterEqual(sample.upstream, .01)
+        self.assertEqual(sample.template, 0)
+
+    def test_workers_summed(self):
+        """Does /metrics sum every worker's snapshot"""
+        other = Metrics(path=metrics.path)
+        sample = Sample()
+        sample.queries = 3
+        other.observe('/races', 'GET', 200, .2, sample)
+        other.flush()
+        metrics.observe('/races', 'GET', 200, .002, Sample())
+
+        text = metrics.render()
+        self.assertEqual(value(text, 'runners_vision_request_seconds_count{route="/races",method="GET"}'), 2)
+        self.assertEqual(value(text, 'runners_vision_request_seconds_bucket{route="/races",method="GET",le="0.0025"}'), 1)
+        self.assertEqual(value(text, 'runners_vision_request_seconds_bucket{route="/races",method="GET",le="0.25"}'), 2)
+        self.assertEqual(value(text, 'runners_vision_request_queries_sum{route="/races",method="GET"}'), 3)
+
+    def test_exited_workers_folded(self):
+        """Do totals stay put when a worker that stopped flushing is expired"""
+        total = 'runners_vision_requests_total{route="/races",method="GET",status="200"}'
+        count = 'runners_vision_request_seconds_count{route="/races",method="GET"}'
+        gone = Metrics(path=metrics.path)
+        gone.observe('/races', 'GET', 200, .2, Sample())
+        gone.flush()
+        metrics.observe('/races', 'GET', 200, .002, Sample())
+        text = metrics.render()
+        self.assertEqual(value(text, total), 2)
+
+        # last written four flush intervals ago
+        conn = metrics._conn()
+        conn.execute('UPDATE snapshots SET written_at = written_at - ? WHERE worker = ?',
+                     (4 * metrics.flush_seconds, gone._worker))
+        text = metrics.render()
+        self.assertEqual(value(text, total), 2)
+        self.assertEqual(value(text, count), 2)
+        workers = [w for (w,) in conn.execute('SELECT worker FROM snapshots')]
+        self.assertNotIn(gone._worker, workers)
+        self.assertIn('exited', workers)
+
+        # a worker folded while still alive only adds what came after
+        gone.observe('/races', 'GET', 200, .2, Sample())
+        gone.flush()
+        text = metrics.render()
+        self.assertEqual(value(text, total), 3)
+        self.assertEqual(value(text, count), 3)
@@ -0,0 +1,150 @@
+"""Rendered page cache tests."""
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Race, User_Race, Training
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, CURR_USER_KEY
+from page_cache import page_cache
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PageCacheTestCase(TestCase):
+    """Test profile and vision board caching."""
+
+    def setUp(self):
+        """Create a public user with two races and a viewer."""
+
+        User.query.delete()
+        Race.query.delete()
+        User_Race.query.delete()
+        Training.query.delete()
+        db.session.commit()
+        page_cache.clear()
+
+        self.client = app.test_client()
+
+        owner = User(username="testuser1", email="test1@test.com", password="HASHED_PASSWORD",
+                     first_name='test1_first', last_name='test1_last')
+        owner.races.append(Race(name='race_one', start_date='1-1-2024'))
+        owner.races.append(Race(name='race_two', start_date='1-1-2024'))
+        viewer = User(username="testuser2", email="test2@test.com", password="HASHED_PASSWORD",
+                      first_name='test2_first', last_name='test2_last')
+        db.session.add_all([owner, viewer])
+        db.session.commit()
+
+        self.owner_id, self.viewer_id = owner.id, viewer.id
+        self.u_r = db.session.execute(db.select(User_Race).join(Race).filter(Race.name == 'race_one')).scalar_one()
+        self.race_id = self.u_r.race_id
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        # first request loads the user and issues the session claims
+        c.get('/api/stats')
+
+    def queries(self, fn):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            return fn(), statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+    def test_etag_and_304(self):
+        """Are repeat views served from cache and revalidated with no queries"""
+        with self.client as c:
+            self.login(c, self.viewer_id)
+
+            resp = c.get(f'/user/{self.owner_id}/races')
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(etag.startswith('W/'))
+            self.assertIn('race_one', resp.text)
+
+            resp, statements = self.queries(lambda: c.get(f'/user/{self.owner_id}/races'))
+            self.assertEqual(resp.headers['X-Page-Cache'], 'hit')
+            self.assertIn('race_one', resp.text)
+            self.assertEqual(statements, [])
+
+            resp, statements = self.queries(lambda: c.get(f'/user/{self.owner_id}/races',
+                                                          headers={'If-None-Match': etag}))
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(statements, [])
+
+    def test_writes_bump_version(self):
+        """Do training and race writes, including the bulk activate, change the page"""
+        with self.client as c:
+            self.login(c, self.owner_id)
+
+            etags = [c.get(f'/user/{self.owner_id}').headers['ETag']]
+
+            c.post(f'/races/{self.owner_id}/{self.race_id}/activate')
+            resp = c.get(f'/user/{self.owner_id}')
+            self.assertIn('race_one', resp.text)
+            etags.append(resp.headers['ETag'])
+
+            c.post(f'/race/{self.u_r.id}/trainings', data={'title': 'tempo', 'type': 'run', 'units': 'miles'})
+            resp = c.get(f'/user/{self.owner_id}')
+            self.assertIn('tempo', resp.text)
+            etags.append(resp.headers['ETag'])
+
+            t = db.session.execute(db.select(Training)).scalar_one()
+            c.post(f'/trainings/{t.id}/delete')
+            resp = c.get(f'/user/{self.owner_id}')
+            self.assertNotIn('tempo', resp.text)
+            etags.append(resp.headers['ETag'])
+
+            c.post(f'/races/{self.owner_id}/{self.race_id}/inactivate')
+            etags.append(c.get(f'/user/{self.owner_id}').headers['ETag'])
+
+            c.post(f'/races/{self.owner_id}/{self.race_id}/delete')
+            resp = c.get(f'/user/{self.owner_id}/races')
+            self.assertNotIn('race_one', resp.text)
+            etags.append(resp.headers['ETag'])
+
+        self.assertEqual(len(set(etags)), len(etags))
+
+    def test_viewer_and_privacy(self):
+        """Is each viewer keyed separately, and a profile gone private no longer served"""
+        with self.client as c:
+            self.login(c, self.viewer_id)
+            first = c.get(f'/user/{self.owner_id}').headers['ETag']
+
+            viewer = db.session.get(User, self.viewer_id)
+            viewer.username = 'renamed'
+            db.session.commit()
+            self.assertNotEqual(c.get(f'/user/{self.owner_id}').headers['ETag'], first)
+
+            db.session.get(User, self.owner_id).is_public = False
+            db.session.commit()
+            resp = c.get(f'/user/{self.owner_id}', headers={'If-None-Match': first})
+            self.assertEqual(resp.status_code, 302)
+
+    def test_flashes_skip_cache(self):
+        """Are pages with pending flashes rendered fresh and not cached"""
+        with self.client as c:
+            self.login(c, self.viewer_id)
+            c.get(f'/user/{self.owner_id}')
+
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [('success', 'hello there')]
+            resp = c.get(f'/user/{self.owner_id}')
+            self.assertIn('hello there', resp.text)
+            self.assertNotIn('ETag', resp.headers)
+
+            resp = c.get(f'/user/{self.owner_id}')
+            self.assertNotIn('hello there', resp.text)
+            self.assertEqual(resp.headers['X-Page-Cache'], 'hit')
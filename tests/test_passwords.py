@@ -0,0 +1,83 @@
+"""Password hashing tests."""
+
+import fcntl
+import os
+import tempfile
+from contextlib import contextmanager
+from unittest import TestCase
+
+from passwords import PasswordHasher, HashingBusy, cost
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test bcrypt hashing under host-wide slots."""
+
+    def setUp(self):
+        """Create a hasher with two slots at a cheap cost."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.hasher = PasswordHasher(rounds=4, max_pending=2, path=os.path.join(self.tmp.name, 'slot'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @contextmanager
+    def hold(self, i):
+        """Holds slot i as another worker would"""
+
+        fd = os.open(f'{self.hasher.path}.{i}', os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            yield
+        finally:
+            os.close(fd)
+
+    def test_hash_and_check(self):
+        """Do pooled hashes verify and record their cost"""
+        hashed = self.hasher.hash('correct horse')
+
+        self.assertEqual(cost(hashed), 4)
+        self.assertTrue(self.hasher.check(hashed, 'correct horse'))
+        self.assertFalse(self.hasher.check(hashed, 'wrong horse'))
+        self.assertFalse(self.hasher.check('HASHED_PASSWORD', 'correct horse'))
+
+    def test_long_passwords(self):
+        """Are passwords past bcrypt's 72 byte limit accepted"""
+        hashed = self.hasher.hash('x' * 100)
+
+        self.assertTrue(self.hasher.check(hashed, 'x' * 100))
+
+    def test_back_pressure(self):
+        """Do slots held by other workers on the host refuse work instead of waiting"""
+        with self.hold(0):
+            self.assertTrue(self.hasher.hash('correct horse'))
+
+            with self.hold(1):
+                with self.assertRaises(HashingBusy):
+                    self.hasher.hash('correct horse')
+
+            self.assertTrue(self.hasher.hash('correct horse'))
+
+    def test_slots_shared(self):
+        """Does a hasher in another process see the slots this one holds"""
+        other = PasswordHasher(rounds=4, max_pending=2, path=self.hasher.path)
+        with self.hasher.slot(), self.hasher.slot():
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    other.hash('correct horse')
+                except HashingBusy:
+                    os._exit(0)
+                os._exit(1)
+            _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+        self.assertTrue(other.hash('correct horse'))
+
+    def test_needs_rehash(self):
+        """Are hashes below the configured cost flagged"""
+        hashed = self.hasher.hash('correct horse')
+
+        self.assertFalse(self.hasher.needs_rehash(hashed))
+        self.hasher.rounds = 5
+        self.assertTrue(self.hasher.needs_rehash(hashed))
@@ -0,0 +1,129 @@
+"""Query budget tests."""
+
+import os
+from unittest import TestCase
+
+from models import db, User, Race, User_Race, Training
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, CURR_USER_KEY
+from page_cache import page_cache
+from query_budget import QueryBudgetExceeded, QueryRecorder, query_budget
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# big enough that a query per race, training or user blows every budget
+N = 20
+
+
+class QueryBudgetTestCase(TestCase):
+    """Test that views stay within their query budgets as the data grows."""
+
+    def setUp(self):
+        User.query.delete()
+        Race.query.delete()
+        User_Race.query.delete()
+        Training.query.delete()
+        db.session.commit()
+        page_cache.clear()
+
+        owner = User(username='owner', email='owner@test.com', password='HASHED_PASSWORD',
+                     first_name='owner_first', last_name='owner_last')
+        db.session.add(owner)
+        for i in range(N):
+            owner.races.append(Race(name=f'test race {i}', start_date='1-1-2030', city='Boston', state='MA'))
+            runner = User(username=f'runner{i}', email=f'runner{i}@test.com', password='HASHED_PASSWORD',
+                          first_name='runner_first', last_name='runner_last')
+            runner.races.append(Race(name=f'other race {i}', start_date='1-1-2030'))
+            db.session.add(runner)
+        db.session.commit()
+
+        u_races = db.session.execute(db.select(User_Race).filter_by(user_id=owner.id)).scalars().all()
+        for u_race in u_races:
+            for j in range(N):
+                db.session.add(Training(users_races_id=u_race.id, title=f'training {j}', type='run',
+                                        distance=3, units='miles', time_spent=30))
+        db.session.commit()
+
+        self.owner_id = owner.id
+        self.u_race_id = u_races[0].id
+        self.race_id = u_races[0].race_id
+        self.training_id = u_races[0].trainings[0].id
+        db.session.remove()
+
+        self.client = app.test_client()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.owner_id
+
+    def test_reads_within_budget(self):
+        """Do list and profile views stay within budget with many races, trainings and users?"""
+
+        paths = [f'/user/{self.owner_id}', f'/user/{self.owner_id}/races', '/races',
+                 f'/api/users/{self.owner_id}/weekly', f'/race/{self.u_race_id}/trainings',
+                 f'/trainings/{self.training_id}/edit', f'/user/{self.owner_id}/trainings/export.csv']
+        with self.client as c:
+            self.login(c)
+            for path in paths:
+                resp = c.get(path)
+                self.assertEqual(resp.status_code, 200, path)
+                # export streams its body
+                resp.get_data()
+                resp.close()
+
+            resp = c.post('/races/search', data={'username': 'runner'})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_deletes_within_budget(self):
+        """Do deleting a race and deleting a user stay within budget however many trainings they have?"""
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post(f'/races/{self.owner_id}/{self.race_id}/delete')
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNone(db.session.get(User_Race, self.u_race_id))
+            self.assertEqual(Training.query.filter_by(users_races_id=self.u_race_id).count(), 0)
+
+            resp = c.post('/user/delete')
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNone(db.session.get(User, self.owner_id))
+            self.assertEqual(User_Race.query.filter_by(user_id=self.owner_id).count(), 0)
+
+    def test_every_view_budgeted(self):
+        """Does every view declare a query budget?"""
+
+        for endpoint, view in app.view_functions.items():
+            if endpoint == 'static' or endpoint.startswith('debugtoolbar'):
+                continue
+            self.assertTrue(hasattr(view, 'query_budget'), endpoint)
+
+    def test_over_budget(self):
+        """Does a view over budget fail with a report grouped by call site?"""
+
+        @query_budget(1)
+        def view():
+            for _ in range(3):
+                db.session.execute(db.select(User.id)).all()
+            return 'ok'
+
+        with app.test_request_context('/over'):
+            with self.assertRaises(QueryBudgetExceeded) as raised:
+                view()
+
+            report = str(raised.exception)
+            self.assertIn('GET /over ran 3 queries, budget is 1', report)
+            self.assertIn('3 x tests/test_query_budgets.py:', report)
+
+            app.config['QUERY_BUDGET_MODE'] = 'off'
+            try:
+                with QueryRecorder() as recorder:
+                    self.assertEqual(view(), 'ok')
+                self.assertEqual(recorder.count, 3)
+            finally:
+                del app.config['QUERY_BUDGET_MODE']
@@ -0,0 +1,117 @@
+"""Race cache tests."""
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from race_cache import RaceCache, cache_key
+
+
+class RaceCacheTestCase(TestCase):
+    """Test shared race listing cache."""
+
+    def setUp(self):
+        """Create cache in a temp file."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'cache.sqlite3')
+        self.cache = RaceCache(path=self.path, ttl=60, stale_ttl=60, max_entries=3)
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fetch(self, params):
+        self.calls.append(params)
+        return {'races': [{'race': {'name': params.get('name', 'any')}}]}
+
+    def test_key_normalization(self):
+        """Do equivalent queries share a key"""
+        a = cache_key({'format': 'json', 'name': ' Boston  Marathon', 'city': ''})
+        b = cache_key({'name': 'boston marathon', 'format': 'JSON', 'state': None})
+
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, cache_key({'format': 'json', 'name': 'boston'}))
+
+    def test_miss_then_hit(self):
+        """Does second lookup skip the fetch"""
+        params = {'format': 'json', 'name': 'boston'}
+        first = self.cache.get_or_fetch(params, self.fetch)
+        second = self.cache.get_or_fetch(params, self.fetch)
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.calls), 1)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_shared_between_instances(self):
+        """Do separate cache objects (workers) see the same entries"""
+        params = {'format': 'json', 'name': 'boston'}
+        self.cache.get_or_fetch(params, self.fetch)
+
+        other = RaceCache(path=self.path, ttl=60, stale_ttl=60)
+        other.get_or_fetch(params, self.fetch)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(other.stats()['hits'], 1)
+
+    def test_stale_while_revalidate(self):
+        """Is a stale entry served while it is refreshed in the background"""
+        self.cache.ttl = 0
+        params = {'format': 'json', 'name': 'boston'}
+        self.cache.set(params, {'races': []})
+
+        value = self.cache.get_or_fetch(params, self.fetch)
+        self.assertEqual(value, {'races': []})
+
+        for _ in range(50):
+            if self.cache.peek(params) != {'races': []}:
+                break
+            time.sleep(.05)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.cache.peek(params), self.fetch(params))
+        self.assertEqual(self.cache.stats()['stale_hits'], 1)
+
+    def test_expired_entry_is_a_miss(self):
+        """Are entries past their stale window fetched again"""
+        self.cache.ttl = 0
+        self.cache.stale_ttl = 0
+        params = {'format': 'json', 'name': 'boston'}
+        self.cache.set(params, {'races': []})
+
+        self.cache.get_or_fetch(params, self.fetch)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_lru_eviction(self):
+        """Are least recently read entries evicted past max_entries"""
+        for n in ('a', 'b', 'c'):
+            self.cache.set({'name': n}, n)
+            time.sleep(.01)
+        # last read longer ago than the touch threshold
+        self.cache._conn().execute('UPDATE entries SET accessed_at = accessed_at - 3600')
+        self.cache.get({'name': 'a'})
+        self.cache.set({'name': 'd'}, 'd')
+
+        self.assertEqual(self.cache.peek({'name': 'a'}), 'a')
+        self.assertIsNone(self.cache.peek({'name': 'b'}))
+        self.assertEqual(self.cache.stats()['entries'], 3)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_hit_does_not_write(self):
+        """Does a hit on a recently read entry leave the file untouched until counters are flushed"""
+        params = {'format': 'json', 'name': 'boston'}
+        self.cache.get_or_fetch(params, self.fetch)
+        conn = self.cache._conn()
+        changes = conn.total_changes
+
+        for _ in range(10):
+            self.cache.get_or_fetch(params, self.fetch)
+        self.assertEqual(conn.total_changes, changes)
+
+        self.assertEqual(self.cache.stats()['hits'], 10)
@@ -2,6 +2,7 @@
 
 import os
 from unittest import TestCase
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
 from models import db, User, Race, User_Race, Training
@@ -138,3 +139,41 @@ class RaceModelTestCase(TestCase):
         u_r.deactivate()     
 
         self.assertFalse(u_r.is_active) 
+
+
+    def test_race_activate(self):
+        """Does activate leave exactly one active race per user"""
+
+        u = db.one_or_404(db.select(User).filter_by(username='testuser1'))
+        u.races.append(db.one_or_404(db.select(Race).filter_by(name='test_race')))
+        u.races.append(Race(name='test_race2', start_date='1-2-2024'))
+        db.session.commit()
+        r1, r2 = [r.id for r in u.races]
+
+        def active():
+            return db.session.execute(db.select(User_Race.race_id).filter_by(user_id=u.id, is_active=True)).scalars().all()
+
+        self.assertIsNotNone(User_Race.activate(u.id, r1))
+        db.session.commit()
+        self.assertEqual(active(), [r1])
+
+        User_Race.activate(u.id, r2)
+        db.session.commit()
+        self.assertEqual(active(), [r2])
+
+        self.assertIsNone(User_Race.activate(u.id, -1))
+        db.session.commit()
+        self.assertEqual(active(), [r2])
+
+
+    def test_one_active_race(self):
+        """Does the database reject a second active race for a user"""
+
+        u = db.one_or_404(db.select(User).filter_by(username='testuser1'))
+        u.races.append(db.one_or_404(db.select(Race).filter_by(name='test_race')))
+        u.races.append(Race(name='test_race2', start_date='1-2-2024'))
+        db.session.commit()
+
+        with self.assertRaises(IntegrityError):
+            db.session.execute(db.update(User_Race).filter_by(user_id=u.id).values(is_active=True))
+        db.session.rollback()
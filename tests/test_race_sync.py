@@ -0,0 +1,282 @@
+"""Race catalog sync tests."""
+
+import os
+import re
+import threading
+import time
+from datetime import date, timedelta
+from unittest import TestCase
+
+from models import db, User, Race, User_Race, Training, SyncState
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, CURR_USER_KEY
+import race_sync
+from page_cache import page_cache
+from race_cache import race_cache
+from race_sync import sync_races
+from runsignup import runsignup
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def listing(race_id, name, days=30, modified=1000):
+    next_date = (date.today() + timedelta(days=days)).strftime('%m/%d/%Y')
+    return {'race': {'race_id': race_id, 'name': name, 'next_date': next_date,
+                     'address': {'city': 'Boston', 'state': 'MA'},
+                     'url': f'https://runsignup.com/Race/{race_id}', 'last_modified': modified}}
+
+
+class FakeClient:
+    """Serves canned catalog pages per event type"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def deadline(self, seconds=None):
+        return time.monotonic() + (seconds or 5)
+
+    def races(self, params, deadline=None):
+        self.calls.append(params)
+        pages = self.pages.get(params['event_type'], [])
+        i = params['page'] - 1
+        return {'races': pages[i] if i < len(pages) else []}
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    """Answers RunSignup race searches per (event_type, page), slowly, from any thread"""
+
+    def __init__(self, pages, delay=0):
+        self.pages = pages
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None, timeout=None):
+        with self.lock:
+            self.calls.append(params)
+        time.sleep(self.delay)
+        return FakeResponse({'races': self.pages.get((params['event_type'], params['page']), [])})
+
+
+class RaceSyncTestCase(TestCase):
+    """Test background race catalog sync."""
+
+    def setUp(self):
+        """Clear races and sync state."""
+
+        User_Race.query.delete()
+        Training.query.delete()
+        Race.query.delete()
+        SyncState.query.delete()
+        db.session.commit()
+        race_sync._ready = False
+
+    def test_pages_and_upserts(self):
+        """Does sync page through the catalog and insert races"""
+        client = FakeClient({'running_race': [[listing(1, 'a'), listing(2, 'b')], [listing(3, 'c')]]})
+
+        count = sync_races(client, event_types=['running_race'], per_page=2)
+
+        self.assertEqual(count, 3)
+        self.assertEqual(len(client.calls), 2)
+        r = db.session.execute(db.select(Race).filter_by(runsignup_id=3)).scalar_one()
+        self.assertEqual(r.name, 'c')
+        self.assertEqual(r.next_date, date.today() + timedelta(days=30))
+        self.assertEqual(r.event_type, 'running_race')
+
+    def test_incremental(self):
+        """Does a second run only request and apply changes past the high-water mark"""
+        sync_races(FakeClient({'running_race': [[listing(1, 'a', modified=1000)]]}), event_types=['running_race'])
+
+        client = FakeClient({'running_race': [[listing(1, 'a', modified=1000), listing(1, 'renamed', modified=2000)]]})
+        count = sync_races(client, event_types=['running_race'])
+
+        self.assertEqual(client.calls[0]['modified_since'], 1000)
+        self.assertEqual(count, 1)
+        self.assertEqual(db.session.get(SyncState, 'races').high_water_mark, 2000)
+        self.assertEqual(db.session.execute(db.select(Race.name).filter_by(runsignup_id=1)).scalar_one(), 'renamed')
+        self.assertEqual(Race.query.count(), 1)
+
+    def test_sync_invalidates_pages(self):
+        """Does a synced rename show on cached vision boards of users with the race"""
+        sync_races(FakeClient({'running_race': [[listing(1, 'old_name', modified=1000)]]}), event_types=['running_race'])
+        User.query.delete()
+        user = User(username='testuser1', email='test1@test.com', password='HASHED_PASSWORD',
+                    first_name='test1_first', last_name='test1_last')
+        user.races.append(db.session.execute(db.select(Race).filter_by(runsignup_id=1)).scalar_one())
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        page_cache.clear()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            self.assertIn('old_name', c.get(f'/user/{user_id}/races').get_data(as_text=True))
+            self.assertEqual(c.get(f'/user/{user_id}/races').headers['X-Page-Cache'], 'hit')
+
+            sync_races(FakeClient({'running_race': [[listing(1, 'new_name', modified=2000)]]}),
+                       event_types=['running_race'])
+            resp = c.get(f'/user/{user_id}/races')
+
+        self.assertNotIn('X-Page-Cache', resp.headers)
+        self.assertIn('new_name', resp.get_data(as_text=True))
+
+    def test_races_served_locally(self):
+        """Does /races use the synced catalog once a sync has run"""
+        sync_races(FakeClient({'running_race': [[listing(1, 'local_race', days=3), listing(2, 'past_race', days=-3)]]}),
+                   event_types=['running_race'])
+
+        with app.test_client() as c:
+            resp = c.get('/races')
+            html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('local_race', html)
+        self.assertNotIn('past_race', html)
+
+    def test_search_served_locally(self):
+        """Does search filter the synced catalog"""
+        sync_races(FakeClient({'running_race': [[listing(1, 'Boston Marathon'), listing(2, 'Chicago 10K')]]}),
+                   event_types=['running_race'])
+
+        with app.test_client() as c:
+            resp = c.post('/races/search', data={'name': 'marathon'})
+            html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Boston Marathon', html)
+        self.assertNotIn('Chicago 10K', html)
+
+    def test_search_typo_tolerant(self):
+        """Does name search match misspellings and rank the best match first"""
+        sync_races(FakeClient({'running_race': [[listing(1, 'Boston Marathon'), listing(2, 'Boston Marathon Expo 5K'),
+                                                 listing(3, 'Chicago 10K')]]}),
+                   event_types=['running_race'])
+
+        names = [r.name for r in Race.search(name='bostn maraton')]
+        self.assertEqual(names, ['Boston Marathon', 'Boston Marathon Expo 5K'])
+
+        self.assertEqual([r.name for r in Race.search(name='10k', city='boston')], ['Chicago 10K'])
+        self.assertEqual(Race.search(name='10k', state='NY'), [])
+
+    def test_search_location_literal(self):
+        """Are wildcards in the city and state filters matched literally"""
+        sync_races(FakeClient({'running_race': [[listing(1, 'Boston Marathon')]]}), event_types=['running_race'])
+
+        self.assertEqual([r.name for r in Race.search(city='BOSTON')], ['Boston Marathon'])
+        self.assertEqual(Race.search(city='%'), [])
+        self.assertEqual(Race.search(city='B_ston'), [])
+        self.assertEqual(Race.search(state='_A'), [])
+
+    def test_races_keyset_pages(self):
+        """Does /races page through the catalog with next/prev cursors"""
+        sync_races(FakeClient({'running_race': [[listing(i, f'race_{i:02}', days=i + 1) for i in range(53)]]}),
+                   event_types=['running_race'])
+
+        with app.test_client() as c:
+            html = c.get('/races').get_data(as_text=True)
+            self.assertEqual(html.count('<button class="add-sm"'), 50)
+            self.assertNotIn('>Previous</a>', html)
+
+            next_cursor = re.search(r'href="/races\?cursor=([^"]+)"[^>]*>Next', html).group(1)
+            html = c.get(f'/races?cursor={next_cursor}').get_data(as_text=True)
+            self.assertEqual(html.count('<button class="add-sm"'), 3)
+            self.assertIn('race_52', html)
+            self.assertNotIn('>Next</a>', html)
+
+            resp = c.get('/races?cursor=forged')
+            self.assertIn('race_00', resp.get_data(as_text=True))
+
+    def test_search_upstream_fan_out(self):
+        """Does a thin local result get every event type and page from RunSignup at once, merged by date"""
+        sync_races(FakeClient({'running_race': [[listing(1, 'Boston Marathon', days=20)]]}),
+                   event_types=['running_race'])
+        session = FakeSession({('running_race', 1): [listing(2, 'Boston 5K', days=10),
+                                                     listing(1, 'Boston Marathon', days=20)],
+                               ('running_race', 2): [listing(3, 'Boston 10K', days=40)],
+                               ('trail_race', 1): [listing(4, 'Boston Trail', days=30)]}, delay=.3)
+        runsignup._session, runsignup._pid = session, os.getpid()
+        race_cache.clear()
+
+        try:
+            started = time.monotonic()
+            with app.test_client() as c:
+                html = c.post('/races/search', data={'name': 'boston', 'event_types': ['running_race', 'trail_race']}
+                              ).get_data(as_text=True)
+            elapsed = time.monotonic() - started
+        finally:
+            runsignup._session = None
+
+        self.assertEqual(len(session.calls), 4)
+        self.assertLess(elapsed, .6)
+        positions = [html.find(f'value="{n}"') for n in ('Boston 5K', 'Boston Marathon', 'Boston Trail', 'Boston 10K')]
+        self.assertNotIn(-1, positions)
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(html.count('value="Boston Marathon"'), 1)
+
+    def test_search_upstream_paged(self):
+        """Are merged search results cut at RACES_PER_PAGE, with every RunSignup listing reachable by Next and Previous"""
+        sync_races(FakeClient({'running_race': [[listing(1, 'Boston Marathon', days=20),
+                                                 listing(2, 'Boston Half', days=90)]]}),
+                   event_types=['running_race'])
+        session = FakeSession({('running_race', 1): [listing(100 + i, f'Boston Road {i:02}', days=i + 1)
+                                                     for i in range(50)],
+                               ('running_race', 2): [listing(150 + i, f'Boston Road {50 + i:02}', days=51 + i)
+                                                     for i in range(30)],
+                               ('trail_race', 1): [listing(1, 'Boston Marathon', days=20)] +
+                                                  [listing(200 + i, f'Boston Trail {i:02}', days=2 * i + 1)
+                                                   for i in range(19)]})
+        runsignup._session, runsignup._pid = session, os.getpid()
+        race_cache.clear()
+
+        def names(html):
+            return re.findall(r'name="name" id="name" value="([^"]+)"', html)
+
+        def cursor(html, label):
+            match = re.search(r'name="cursor" value="([^"]+)">\s*<button[^>]*>' + label, html)
+            return match and match.group(1)
+
+        data = {'name': 'boston', 'event_types': ['running_race', 'trail_race']}
+        try:
+            with app.test_client() as c:
+                pages = [c.post('/races/search', data=data).get_data(as_text=True)]
+                while cursor(pages[-1], 'Next'):
+                    pages.append(c.post('/races/search', data={**data, 'cursor': cursor(pages[-1], 'Next')}
+                                        ).get_data(as_text=True))
+                back = c.post('/races/search', data={**data, 'cursor': cursor(pages[-1], 'Previous')}
+                              ).get_data(as_text=True)
+        finally:
+            runsignup._session = None
+
+        self.assertEqual([len(names(html)) for html in pages], [50, 50, 1])
+        shown = [n for html in pages for n in names(html)]
+        self.assertEqual(len(shown), 101)
+        self.assertEqual(len(set(shown)), 101)
+        self.assertIn('Boston Road 79', shown)
+        self.assertIn('Boston Trail 18', shown)
+        self.assertEqual(shown[-1], 'Boston Half')
+        self.assertIsNone(cursor(pages[0], 'Previous'))
+        self.assertEqual(names(back), names(pages[1]))
+        # later pages merge from the cached listings
+        self.assertEqual(len(session.calls), 4)
@@ -1,6 +1,7 @@
 """User view tests."""
 
 import os
+import re
 from unittest import TestCase
 
 from models import db, User, Race, User_Race, Training
@@ -170,3 +171,81 @@ class RaceViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<button class="add-sm"', html)
             self.assertIn('Access unauthorized.', html)
+
+
+    def test_search_username(self):
+        """Does username search list races of matching public users only"""
+
+        with self.client as c:
+            t1 = db.one_or_404(db.select(User).filter_by(username='testuser1'))
+            t2 = db.one_or_404(db.select(User).filter_by(username='testuser2'))
+            t1.races.append(db.one_or_404(db.select(Race).filter_by(name='test_race')))
+            t2.races.append(Race(name='private_race', start_date='1-1-2024'))
+            db.session.commit()
+
+            resp = c.post('/races/search', data={'username': 'testuser'})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('test_race', html)
+            self.assertIn('testuser1</', html.replace(' ', '').replace('\n', ''))
+            self.assertNotIn('private_race', html)
+            self.assertNotIn('>Next</button>', html)
+
+
+    def test_search_username_paginated(self):
+        """Are username search results paged with next/prev cursors"""
+
+        t1 = db.one_or_404(db.select(User).filter_by(username='testuser1'))
+        for i in range(52):
+            t1.races.append(Race(name=f'race_{i:02}', start_date='1-1-2024'))
+        db.session.commit()
+
+        def cursor(html, label):
+            m = re.search(r'name="cursor" value="([^"]+)">\s*<button[^>]*>' + label, html)
+            return m and m.group(1)
+
+        with self.client as c:
+            resp = c.post('/races/search', data={'username': 'testuser1'})
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count('<button class="add-sm"'), 50)
+            self.assertIsNone(cursor(html, 'Previous'))
+
+            resp = c.post('/races/search', data={'username': 'testuser1', 'cursor': cursor(html, 'Next')})
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count('<button class="add-sm"'), 2)
+            self.assertIsNone(cursor(html, 'Next'))
+
+            resp = c.post('/races/search', data={'username': 'testuser1', 'cursor': cursor(html, 'Previous')})
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count('<button class="add-sm"'), 50)
+            self.assertIn('race_00', html)
+            self.assertIsNone(cursor(html, 'Previous'))
+
+
+    def test_add_race_by_runsignup_id(self):
+        """Is a posted listing upserted on its RunSignup id without calling upstream"""
+        listing = {'race_id': 4242, 'name': 'Listed Marathon', 'city': 'Boston', 'state': 'MA',
+                   'next_date': '04/20/2030', 'url': 'https://runsignup.com/Race/4242'}
+
+        with self.client as c:
+            t1 = db.one_or_404(db.select(User).filter_by(username='testuser1'))
+            t2 = db.one_or_404(db.select(User).filter_by(username='testuser2'))
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = t1.id
+
+            resp = c.post(f'/user/{t1.id}/races/add', data=listing)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Listed Marathon', resp.get_data(as_text=True))
+
+            resp = c.post(f'/user/{t1.id}/races/add', data=listing)
+            self.assertEqual(resp.headers['location'], '/races')
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = t2.id
+            c.post(f'/user/{t2.id}/races/add', data={**listing, 'name': 'Renamed'})
+
+        race = db.session.execute(db.select(Race).filter_by(runsignup_id=4242)).scalar_one()
+        self.assertEqual((race.name, race.city, str(race.next_date)), ('Listed Marathon', 'Boston', '2030-04-20'))
+        self.assertEqual(db.session.execute(db.select(db.func.count()).select_from(User_Race)
+                                            .filter_by(race_id=race.id)).scalar(), 2)
@@ -0,0 +1,116 @@
+"""RunSignup client tests."""
+
+from unittest import TestCase
+
+import requests
+
+from runsignup import RunSignupClient, UpstreamError, CircuitOpen
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, data=None):
+        self.status_code = status_code
+        self.data = data if data is not None else {'races': []}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} error')
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    """Replays a list of responses/exceptions and records call timeouts"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None):
+        self.calls.append((url, params, timeout))
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class RunSignupClientTestCase(TestCase):
+    """Test pooled RunSignup client."""
+
+    def setUp(self):
+        """Create client with fast backoff."""
+
+        self.client = RunSignupClient(base_url='http://stub/rest', retries=2, backoff=.001,
+                                      failure_threshold=2, reset_timeout=60)
+
+    def use(self, *results):
+        self.client._session = FakeSession(*results)
+        self.client._pid = __import__('os').getpid()
+        return self.client._session
+
+    def test_get_races(self):
+        """Does client decode races and pass a bounded timeout"""
+        session = self.use(FakeResponse(data={'races': [1]}))
+
+        self.assertEqual(self.client.races({'format': 'json'}), {'races': [1]})
+        url, params, timeout = session.calls[0]
+        self.assertEqual(url, 'http://stub/rest/races')
+        self.assertLessEqual(timeout[1], self.client.timeout)
+
+    def test_retries_then_succeeds(self):
+        """Are connection errors and 5xx retried"""
+        session = self.use(requests.ConnectionError('boom'), FakeResponse(503), FakeResponse(data={'races': [2]}))
+
+        self.assertEqual(self.client.races({}), {'races': [2]})
+        self.assertEqual(len(session.calls), 3)
+        self.assertEqual(self.client.stats()['endpoints']['/races']['errors'], 2)
+
+    def test_bounded_retries(self):
+        """Does client give up after the configured retries"""
+        session = self.use(*[requests.Timeout('slow')] * 5)
+
+        with self.assertRaises(UpstreamError):
+            self.client.races({})
+        self.assertEqual(len(session.calls), 3)
+
+    def test_client_error_not_retried(self):
+        """Are 4xx responses surfaced without retrying"""
+        session = self.use(FakeResponse(400), FakeResponse())
+
+        with self.assertRaises(UpstreamError):
+            self.client.races({})
+        self.assertEqual(len(session.calls), 1)
+        self.assertEqual(self.client.breaker.state, 'closed')
+
+    def test_deadline(self):
+        """Does an expired deadline stop the call"""
+        session = self.use(FakeResponse())
+
+        with self.assertRaises(UpstreamError):
+            self.client.races({}, deadline=self.client.deadline(0))
+        self.assertEqual(session.calls, [])
+
+    def test_circuit_breaker(self):
+        """Does the breaker fail fast after repeated failures"""
+        session = self.use(*[requests.ConnectionError('down')] * 6)
+
+        for _ in range(2):
+            with self.assertRaises(UpstreamError):
+                self.client.races({})
+        calls = len(session.calls)
+
+        with self.assertRaises(CircuitOpen):
+            self.client.races({})
+        self.assertEqual(len(session.calls), calls)
+        self.assertEqual(self.client.stats()['circuit'], 'open')
+
+    def test_breaker_half_open(self):
+        """Does one trial call close the breaker again"""
+        self.use(FakeResponse(data={'races': [3]}))
+        self.client.breaker.failures = 2
+        self.client.breaker.opened_at = 0
+
+        self.assertEqual(self.client.breaker.state, 'half_open')
+        self.assertEqual(self.client.races({}), {'races': [3]})
+        self.assertEqual(self.client.breaker.state, 'closed')
@@ -0,0 +1,144 @@
+"""Training export tests."""
+
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Race, User_Race, Training
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, CURR_USER_KEY
+from training_export import COLUMNS, export_batches
+from training_import import TrainingImportError, import_trainings
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TrainingExportTestCase(TestCase):
+    """Test CSV and NDJSON exports."""
+
+    def setUp(self):
+        """Create a private user with two races, one with trainings, and another user."""
+
+        User.query.delete()
+        Race.query.delete()
+        User_Race.query.delete()
+        Training.query.delete()
+
+        self.client = app.test_client()
+
+        u = User(username="testuser1", email="test1@test.com", password="HASHED_PASSWORD",
+                 first_name='test1_first', last_name='test1_last', is_public=False)
+        u.races.append(Race(name='race_with_trainings', start_date='1-1-2024'))
+        u.races.append(Race(name='empty_race', start_date='1-1-2024'))
+        other = User(username="testuser2", email="test2@test.com", password="HASHED_PASSWORD",
+                     first_name='test2_first', last_name='test2_last')
+        db.session.add_all([u, other])
+        db.session.commit()
+
+        self.user_id, self.other_id = u.id, other.id
+        self.u_r_id = db.session.execute(db.select(User_Race.id).join(Race)
+                                         .filter(Race.name == 'race_with_trainings')).scalar_one()
+        for i in range(5):
+            db.session.add(Training(users_races_id=self.u_r_id, title=f'run {i}', body='easy, "slow"\nday',
+                                    type='run', distance=3.5, units='miles', time_spent=30,
+                                    created_at=datetime(2024, 1, 1 + i)))
+        db.session.commit()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_batches(self):
+        """Are rows read in batches, including races without trainings"""
+        batches = list(export_batches(self.user_id, batch=2))
+
+        self.assertEqual([len(b) for b in batches], [2, 2, 2])
+        rows = [dict(zip(COLUMNS, r)) for b in batches for r in b]
+        self.assertEqual([r['title'] for r in rows if r['race'] == 'race_with_trainings'],
+                         [f'run {i}' for i in range(5)])
+        self.assertEqual([r['title'] for r in rows if r['race'] == 'empty_race'], [None])
+
+    def test_export_csv(self):
+        """Does the owner get a streamed CSV"""
+        with self.client as c:
+            self.login(c, self.user_id)
+            resp = c.get(f'/user/{self.user_id}/trainings/export.csv')
+
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.mimetype, 'text/csv')
+            self.assertIn('testuser1-trainings.csv', resp.headers['Content-Disposition'])
+            rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+
+        self.assertEqual(len(rows), 6)
+        first = next(r for r in rows if r['title'] == 'run 0')
+        self.assertEqual(first['body'], 'easy, "slow"\nday')
+        self.assertEqual(first['created_at'], '2024-01-01 00:00:00')
+
+        # as is, the empty race's row fails the import
+        with self.assertRaisesRegex(TrainingImportError, 'title is required'):
+            import_trainings(self.u_r_id, io.BytesIO(resp.get_data()), 'csv')
+        db.session.rollback()
+
+    def test_reimport_race(self):
+        """Do one race's rows of an export import into another race with the same trainings"""
+        with self.client as c:
+            self.login(c, self.user_id)
+            exported = c.get(f'/user/{self.user_id}/trainings/export.csv').get_data(as_text=True)
+
+        target = Race(name='target_race', start_date='1-1-2025')
+        other = db.session.get(User, self.other_id)
+        other.races.append(target)
+        db.session.commit()
+        target_id = db.session.execute(db.select(User_Race.id).filter_by(race_id=target.id)).scalar_one()
+
+        out = io.StringIO()
+        writer = csv.DictWriter(out, COLUMNS)
+        writer.writeheader()
+        writer.writerows(r for r in csv.DictReader(io.StringIO(exported))
+                         if r['users_races_id'] == str(self.u_r_id) and r['title'])
+        self.assertEqual(import_trainings(target_id, io.BytesIO(out.getvalue().encode()), 'csv'), 5)
+        db.session.commit()
+
+        fields = lambda t: (t.title, t.body, t.time_spent, t.type, t.distance, t.units, t.created_at)
+        trainings = lambda id: [fields(t) for t in db.session.execute(
+            db.select(Training).filter_by(users_races_id=id).order_by(Training.created_at)).scalars()]
+        self.assertEqual(trainings(target_id), trainings(self.u_r_id))
+
+    def test_export_ndjson(self):
+        """Is every row a JSON object"""
+        with self.client as c:
+            self.login(c, self.user_id)
+            resp = c.get(f'/user/{self.user_id}/trainings/export.ndjson')
+
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), 6)
+        last = next(r for r in rows if r['title'] == 'run 4')
+        self.assertEqual(last, {'users_races_id': self.u_r_id, 'race': 'race_with_trainings', 'is_active': False,
+                                   'training_id': last['training_id'], 'title': 'run 4', 'body': 'easy, "slow"\nday',
+                                   'time_spent': 30, 'type': 'run', 'distance': 3.5, 'units': 'miles',
+                                   'created_at': '2024-01-05T00:00:00'})
+
+    def test_export_private(self):
+        """Are private users' exports refused to others, and public ones allowed"""
+        with self.client as c:
+            self.login(c, self.other_id)
+            resp = c.get(f'/user/{self.user_id}/trainings/export.csv')
+            self.assertEqual(resp.status_code, 302)
+
+            db.session.get(User, self.user_id).is_public = True
+            db.session.commit()
+            resp = c.get(f'/user/{self.user_id}/trainings/export.ndjson')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 6)
+
+            self.assertEqual(c.get(f'/user/{self.user_id}/trainings/export.xml').status_code, 404)
@@ -0,0 +1,134 @@
+"""Bulk training import tests."""
+
+import io
+import os
+from datetime import date
+from decimal import Decimal
+from unittest import TestCase
+
+from models import db, User, Race, User_Race, Training, WeeklyMileage
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, CURR_USER_KEY
+from training_import import TrainingImportError, import_trainings
+from training_stats import training_totals, week_start
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+CSV = b"""title,body,time_spent,type,distance,units,created_at
+easy run,"tabs\tand
+newlines",30,run,3,miles,2024-01-02
+long ride,,90,bicycle,20,km,2024-01-03T07:30:00
+back\\slash,,,,,,
+"""
+
+NDJSON = b"""{"title": "easy run", "time_spent": 30, "type": "run", "distance": 3, "units": "miles", "created_at": "2024-01-02"}
+
+{"title": "walk", "type": "walk", "distance": 1.5}
+"""
+
+
+class TrainingImportTestCase(TestCase):
+    """Test CSV and NDJSON training imports."""
+
+    def setUp(self):
+        """Create user with a race."""
+
+        User.query.delete()
+        Race.query.delete()
+        User_Race.query.delete()
+        Training.query.delete()
+
+        self.client = app.test_client()
+
+        u = User(username="testuser1", email="test1@test.com", password="HASHED_PASSWORD",
+                 first_name='test1_first', last_name='test1_last')
+        u.races.append(Race(name='test_race', start_date='1-1-2024'))
+        db.session.add(u)
+        db.session.commit()
+
+        self.user_id = u.id
+        self.u_r_id = db.one_or_404(db.select(User_Race).filter_by(user_id=u.id)).id
+
+    def trainings(self):
+        return db.session.execute(db.select(Training).order_by(Training.id)).scalars().all()
+
+    def test_import_csv(self):
+        """Are CSV rows copied in with form defaults and rollups rebuilt"""
+        count = import_trainings(self.u_r_id, io.BytesIO(CSV), 'csv')
+        db.session.commit()
+
+        self.assertEqual(count, 3)
+        first, ride, bare = self.trainings()
+        self.assertEqual(first.body, 'tabs\tand\nnewlines')
+        self.assertEqual(ride.created_at.hour, 7)
+        self.assertEqual(bare.title, 'back\\slash')
+        self.assertEqual((bare.type, bare.units, bare.distance, bare.time_spent), ('run', 'miles', None, None))
+
+        totals = training_totals(self.u_r_id)
+        self.assertEqual(totals['run'].sessions, 2)
+        self.assertEqual(totals['run'].miles, Decimal('3.000'))
+        week = db.session.get(WeeklyMileage, (self.user_id, 'bicycle', week_start(date(2024, 1, 3))))
+        self.assertEqual(week.miles, Decimal('12.430'))
+
+    def test_import_ndjson(self):
+        """Are NDJSON rows imported, skipping blank lines"""
+        count = import_trainings(self.u_r_id, io.BytesIO(NDJSON), 'ndjson')
+        db.session.commit()
+
+        self.assertEqual(count, 2)
+        self.assertEqual([t.title for t in self.trainings()], ['easy run', 'walk'])
+        self.assertEqual(training_totals(self.u_r_id)['walk'].miles, Decimal('1.500'))
+
+    def test_invalid_row(self):
+        """Does a bad row report its line and import nothing"""
+        rows = b'title,type\n' + b'ok,run\n' * 5000 + b'bad,yoga\n'
+
+        with self.assertRaises(TrainingImportError) as cm:
+            import_trainings(self.u_r_id, io.BytesIO(rows), 'csv')
+        db.session.rollback()
+
+        self.assertEqual(cm.exception.line, 5002)
+        self.assertIn('type must be one of', str(cm.exception))
+        self.assertEqual(self.trainings(), [])
+
+        for body, message in [(b'title\n' + b'x' * 31 + b'\n', 'title is longer than 30'),
+                              (b'title,time_spent\nok,ten\n', 'time_spent must be a whole number'),
+                              (b'body\nno title\n', 'title is required'),
+                              (b'title,distance\nok,nan\n', 'distance must be a finite number'),
+                              (b'title,distance\nok,-inf\n', 'distance must be a finite number'),
+                              (b'title,time_spent\nok,2147483648\n', 'time_spent is out of range')]:
+            with self.assertRaisesRegex(TrainingImportError, f'line 2: {message}'):
+                import_trainings(self.u_r_id, io.BytesIO(body), 'csv')
+            db.session.rollback()
+
+        with self.assertRaisesRegex(TrainingImportError, 'line 1: distance must be a finite number'):
+            import_trainings(self.u_r_id, io.BytesIO(b'{"title": "ok", "distance": NaN}\n'), 'ndjson')
+        db.session.rollback()
+
+    def test_import_view(self):
+        """Can the race's owner upload a file, and nobody else"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post(f'/race/{self.u_r_id}/trainings/import',
+                          data={'file': (io.BytesIO(CSV), 'log.csv')}, follow_redirects=True)
+            self.assertIn('Imported 3 trainings', resp.text)
+
+            resp = c.post(f'/race/{self.u_r_id}/trainings/import', data=b'{"type": "run"}\n',
+                          content_type='application/x-ndjson', follow_redirects=True)
+            self.assertIn('Nothing imported, line 1: title is required', resp.text)
+            self.assertEqual(len(self.trainings()), 3)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id + 1
+            resp = c.post(f'/race/{self.u_r_id}/trainings/import', data=NDJSON,
+                          content_type='application/x-ndjson', follow_redirects=True)
+            self.assertIn('Access unauthorized', resp.text)
+            self.assertEqual(len(self.trainings()), 3)
@@ -0,0 +1,185 @@
+"""Training rollup tests."""
+
+import os
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest import TestCase
+
+from models import db, User, Race, User_Race, Training, TrainingTotal, WeeklyMileage
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, CURR_USER_KEY
+from query_budget import QueryRecorder
+from training_stats import training_totals, rebuild_totals, rebuild_weekly, week_start
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TrainingStatsTestCase(TestCase):
+    """Test per race training totals."""
+
+    def setUp(self):
+        """Create user with an active race."""
+
+        User.query.delete()
+        Race.query.delete()
+        User_Race.query.delete()
+        Training.query.delete()
+
+        self.client = app.test_client()
+
+        u = User(username="testuser1", email="test1@test.com", password="HASHED_PASSWORD",
+                 first_name='test1_first', last_name='test1_last')
+        u.races.append(Race(name='test_race', start_date='1-1-2024'))
+        db.session.add(u)
+        db.session.commit()
+
+        self.user_id = u.id
+        self.u_r = db.one_or_404(db.select(User_Race).filter_by(user_id=u.id))
+        self.u_r.is_active = True
+        db.session.commit()
+
+    def add(self, **kw):
+        t = Training(users_races_id=self.u_r.id, title='t', **kw)
+        db.session.add(t)
+        db.session.commit()
+        return t
+
+    def test_insert_updates_totals(self):
+        """Are trainings added to totals in miles"""
+        self.add(type='run', distance=3, units='miles', time_spent=30)
+        self.add(type='run', distance=5, units='km', time_spent=25)
+        self.add(type='bicycle', distance=1609, units='meters')
+
+        totals = training_totals(self.u_r.id)
+        self.assertEqual(totals['run'].miles, Decimal('6.108'))
+        self.assertEqual(totals['run'].minutes, 55)
+        self.assertEqual(totals['run'].sessions, 2)
+        self.assertEqual(totals['bicycle'].miles, Decimal('1.000'))
+
+    def test_edit_and_delete(self):
+        """Do edits move totals and deletes remove them"""
+        t = self.add(type='run', distance=3, units='miles', time_spent=30)
+
+        t.type = 'walk'
+        t.distance = 2
+        db.session.commit()
+        totals = training_totals(self.u_r.id)
+        self.assertEqual(totals['run'].sessions, 0)
+        self.assertEqual(totals['run'].miles, 0)
+        self.assertEqual(totals['walk'].miles, Decimal('2.000'))
+
+        db.session.delete(t)
+        db.session.commit()
+        totals = training_totals(self.u_r.id)
+        self.assertEqual(totals['walk'].sessions, 0)
+        self.assertEqual(totals['walk'].miles, 0)
+
+    def test_untracked_edit(self):
+        """Does an edit leaving distance, time, type and dates alone skip both rollups"""
+        t = self.add(type='run', distance=3, units='miles', time_spent=30)
+        t.title = 'renamed'
+        t.body = 'easy'
+        t.distance = 3
+
+        with QueryRecorder() as recorder:
+            db.session.commit()
+        self.assertEqual([site for site, _, _ in recorder.by_site() if 'training_stats' in site], [])
+
+        self.assertEqual(training_totals(self.u_r.id)['run'].sessions, 1)
+
+    def test_rolled_back_with_training(self):
+        """Do totals roll back with a failed training write"""
+        self.add(type='run', distance=3, units='miles')
+
+        db.session.add(Training(users_races_id=self.u_r.id, title='t', type='run', distance=1))
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(training_totals(self.u_r.id)['run'].miles, Decimal('3.000'))
+
+    def test_rebuild(self):
+        """Does rebuild reproduce incrementally maintained totals"""
+        self.add(type='run', distance=3.3333, units='km', time_spent=20)
+        self.add(type='run', distance=1234, units='meters', time_spent=10)
+        before = {k: (t.miles, t.minutes, t.sessions) for k, t in training_totals(self.u_r.id).items()}
+
+        db.session.execute(db.delete(TrainingTotal))
+        rebuild_totals()
+        db.session.commit()
+        after = {k: (t.miles, t.minutes, t.sessions) for k, t in training_totals(self.u_r.id).items()}
+
+        self.assertEqual(before, after)
+
+    def test_profile_totals(self):
+        """Does profile show totals from the rollup"""
+        self.add(type='run', distance=3.26, units='miles')
+        self.add(type='walk', distance=2, units='km')
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            html = c.get(f'/user/{self.user_id}').get_data(as_text=True)
+
+        self.assertIn('Run:3.3 miles', html)
+        self.assertIn('Walk:1.2 miles', html)
+        self.assertIn('Bike:0 miles', html)
+
+    def test_weekly_buckets(self):
+        """Are trainings bucketed per ISO week and moved when edited"""
+        monday = datetime(2024, 3, 4, 8)
+        self.add(type='run', distance=3, units='miles', time_spent=30, created_at=monday)
+        self.add(type='run', distance=2, units='miles', time_spent=20, created_at=monday + timedelta(days=6, hours=15))
+        t = self.add(type='run', distance=5, units='km', created_at=monday + timedelta(days=7))
+
+        rows = db.session.execute(db.select(WeeklyMileage).order_by(WeeklyMileage.week_start)).scalars().all()
+        self.assertEqual([(w.week_start, w.miles, w.sessions) for w in rows],
+                         [(date(2024, 3, 4), Decimal('5.000'), 2), (date(2024, 3, 11), Decimal('3.108'), 1)])
+        self.assertEqual(rows[0].serialize()['week'], '2024-W10')
+
+        t.created_at = monday
+        db.session.commit()
+        self.assertEqual(db.session.get(WeeklyMileage, (self.user_id, 'run', date(2024, 3, 4))).sessions, 3)
+        self.assertEqual(db.session.get(WeeklyMileage, (self.user_id, 'run', date(2024, 3, 11))).sessions, 0)
+
+        before = {(w.type, w.week_start): (w.miles, w.minutes) for w in WeeklyMileage.query if w.sessions}
+        db.session.execute(db.delete(WeeklyMileage))
+        rebuild_weekly()
+        db.session.commit()
+        self.assertEqual(before, {(w.type, w.week_start): (w.miles, w.minutes) for w in WeeklyMileage.query})
+
+    def test_weekly_api(self):
+        """Does the weekly API answer range and type queries and respect privacy"""
+        monday = week_start(date.today())
+        self.add(type='run', distance=3, units='miles', created_at=datetime.combine(monday, datetime.min.time()))
+        self.add(type='walk', distance=1, units='miles')
+        self.add(type='run', distance=4, units='miles', created_at=datetime(2020, 1, 1))
+
+        with self.client as c:
+            resp = c.get(f'/api/users/{self.user_id}/weekly')
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            weeks = c.get(f'/api/users/{self.user_id}/weekly').json['weeks']
+            self.assertEqual([(w['type'], w['miles']) for w in weeks], [('run', 3.0), ('walk', 1.0)])
+
+            weeks = c.get(f'/api/users/{self.user_id}/weekly?from=2019-12-30&to=2020-01-31&type=run').json['weeks']
+            self.assertEqual(weeks, [{'week': '2020-W01', 'week_start': '2019-12-30', 'type': 'run',
+                                      'miles': 4.0, 'minutes': 0, 'sessions': 1}])
+
+            self.assertEqual(c.get(f'/api/users/{self.user_id}/weekly?type=yoga').status_code, 400)
+            self.assertEqual(c.get(f'/api/users/{self.user_id}/weekly?from=soon').status_code, 400)
+
+            other = User(username="testuser2", email="test2@test.com", password="HASHED_PASSWORD",
+                         first_name='test2_first', last_name='test2_last', is_public=False)
+            db.session.add(other)
+            db.session.commit()
+            self.assertEqual(c.get(f'/api/users/{other.id}/weekly').status_code, 403)
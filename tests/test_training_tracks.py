@@ -0,0 +1,145 @@
+"""GPX track ingest tests."""
+
+import io
+import os
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Race, User_Race, Training, TrainingTrack
+
+os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
+
+from app import app, CURR_USER_KEY
+from training_tracks import TrackError, build_track, douglas_peucker, haversine, parse_gpx, track_points
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+START = datetime(2024, 3, 2, 8, 0, 0)
+
+
+def gpx(points):
+    """GPX 1.1 document for (lat, lon, seconds) points"""
+
+    trkpts = ''.join(f'<trkpt lat="{lat}" lon="{lon}"><ele>10.5</ele>'
+                     f'<time>{(START + timedelta(seconds=s)).isoformat()}Z</time></trkpt>'
+                     for lat, lon, s in points)
+    return (f'<?xml version="1.0" encoding="UTF-8"?><gpx version="1.1" creator="test" '
+            f'xmlns="http://www.topografix.com/GPX/1/1"><trk><name>run</name><trkseg>{trkpts}'
+            f'</trkseg></trk></gpx>').encode()
+
+
+def out_and_east(steps=100):
+    """North steps * ~111 m at 30 s each, a 5 minute stop, then east the same number of steps"""
+
+    points = [(42 + i * .001, -71, i * 30) for i in range(steps + 1)]
+    stop = points[-1][2] + 300
+    points.append((42 + steps * .001, -71, stop))
+    points += [(42 + steps * .001, -71 + i * .001, stop + i * 30) for i in range(1, steps + 1)]
+    return points
+
+
+class TrainingTrackTestCase(TestCase):
+    """Test track parsing, simplification and upload."""
+
+    def setUp(self):
+        """Create user with a race."""
+
+        User.query.delete()
+        Race.query.delete()
+        User_Race.query.delete()
+        Training.query.delete()
+
+        self.client = app.test_client()
+
+        u = User(username="testuser1", email="test1@test.com", password="HASHED_PASSWORD",
+                 first_name='test1_first', last_name='test1_last')
+        u.races.append(Race(name='test_race', start_date='1-1-2024'))
+        db.session.add(u)
+        db.session.commit()
+
+        self.user_id = u.id
+        self.u_r_id = db.one_or_404(db.select(User_Race).filter_by(user_id=u.id)).id
+
+    def test_haversine(self):
+        """Is a degree of latitude about 111.2 km"""
+        self.assertAlmostEqual(haversine(np.array([0., 1.]), np.array([0., 0.]))[0], 111195, delta=1)
+
+    def test_build_track(self):
+        """Are distance and moving time taken from every point and the corner kept"""
+        track = build_track(io.BytesIO(gpx(out_and_east())))
+
+        north = haversine(np.array([42., 42.1]), np.array([-71., -71.]))[0]
+        east = haversine(np.array([42.1, 42.1]), np.array([-71., -70.9]))[0]
+        self.assertAlmostEqual(track.distance_m, north + east, delta=1)
+        self.assertEqual(track.moving_seconds, 200 * 30)
+        self.assertEqual(track.elapsed_seconds, 200 * 30 + 300)
+        self.assertEqual(track.started_at, START)
+        self.assertEqual(track.point_count, 202)
+
+        lat, lon, ele, seconds = track_points(track)
+        self.assertEqual(track.stored_count, 3)
+        np.testing.assert_allclose(lat, [42, 42.1, 42.1])
+        np.testing.assert_allclose(lon, [-71, -71, -70.9])
+        np.testing.assert_allclose(ele, [10.5] * 3)
+        self.assertEqual(list(seconds), [0, 3000, 6300])
+
+    def test_douglas_peucker(self):
+        """Are points within tolerance dropped and wider ones kept"""
+        lat = np.array([42, 42.001, 42.002, 42.003, 42.004])
+        lon = np.array([-71, -71.00003, -71, -71.00003, -71])
+
+        self.assertEqual(list(douglas_peucker(lat, lon, 5)), [True, False, False, False, True])
+        self.assertTrue(douglas_peucker(lat, lon, 1).all())
+
+    def test_bad_files(self):
+        """Are unusable files reported"""
+        for body in (b'not xml', gpx([(42, -71, 0)]), b'<gpx><trk><trkseg><trkpt lat="x" lon="1"/></trkseg></trk></gpx>'):
+            with self.assertRaises(TrackError):
+                build_track(io.BytesIO(body))
+
+    def test_loose_points(self):
+        """Are points outside a trkseg parsed, without picking up waypoint or metadata times"""
+        body = (b'<gpx><metadata><time>2020-01-01T00:00:00Z</time></metadata>'
+                b'<wpt lat="1" lon="1"><ele>99</ele><time>2021-01-01T00:00:00Z</time></wpt>'
+                b'<trk><trkpt lat="42" lon="-71"/><trkpt lat="42.001" lon="-71">'
+                b'<time>2024-03-02T09:00:00+01:00</time></trkpt></trk></gpx>')
+        lat, lon, ele, t = parse_gpx(io.BytesIO(body))
+
+        self.assertEqual(list(lat), [42, 42.001])
+        self.assertTrue(np.isnan(ele).all())
+        self.assertTrue(np.isnan(t[0]))
+        self.assertEqual(t[1], datetime(2024, 3, 2, 8, tzinfo=timezone.utc).timestamp())
+
+    def test_upload(self):
+        """Does a GPX upload fill in distance, time and date, and replace the track on edit"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post(f'/race/{self.u_r_id}/trainings', follow_redirects=True,
+                          data={'title': 'tempo', 'type': 'run', 'units': 'km',
+                                'gpx': (io.BytesIO(gpx(out_and_east())), 'run.gpx')})
+            self.assertIn('Track: 19.37 km from 202 points', resp.text)
+
+            t = db.session.execute(db.select(Training)).scalar_one()
+            self.assertEqual((t.distance, t.time_spent, t.created_at), (19.37, 100, START))
+            self.assertEqual(t.track.point_count, 202)
+
+            resp = c.post(f'/trainings/{t.id}/edit', follow_redirects=True,
+                          data={'title': 'tempo', 'type': 'run', 'units': 'miles',
+                                'gpx': (io.BytesIO(gpx(out_and_east(10))), 'short.gpx')})
+            self.assertIn('Track: 1.2 miles from 22 points', resp.text)
+            db.session.expire_all()
+            self.assertEqual(db.session.execute(db.select(TrainingTrack)).scalar_one().point_count, 22)
+
+            resp = c.post(f'/trainings/{t.id}/edit', data={'title': 'tempo', 'type': 'run', 'units': 'miles',
+                                                           'gpx': (io.BytesIO(b'nope'), 'bad.gpx')})
+            self.assertIn('not a GPX file', resp.text)
+            db.session.expire_all()
+            self.assertEqual(db.session.get(Training, t.id).distance, 1.2)
@@ -104,7 +104,7 @@ class TrainingViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('<form class="form-horizontal" id="training-form" method="POST">', html)
+            self.assertIn('<form class="form-horizontal" id="training-form" method="POST" enctype="multipart/form-data">', html)
 
     def test_add_training(self):
         """Does app allow user to add training"""
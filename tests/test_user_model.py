@@ -4,6 +4,7 @@ import os
 from unittest import TestCase
 
 from models import db, User, Race, User_Race, Training
+from passwords import passwords, cost
 
 
 os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
@@ -147,4 +148,20 @@ class UserModelTestCase(TestCase):
     
 
 
-        
\ No newline at end of file
+        
+
+    def test_authenticate_rehashes(self):
+        """Is a password hashed at an old cost upgraded on login"""
+        rounds = passwords.rounds
+        passwords.rounds = 4
+        try:
+            u = User.signup('testuser3', "test@test.com", "HASHED_PASSWORD", 'test3_first', 'test3_last')
+            db.session.commit()
+            self.assertEqual(cost(u.password), 4)
+
+            passwords.rounds = 5
+            self.assertTrue(User.authenticate('testuser3', "HASHED_PASSWORD"))
+            self.assertEqual(cost(u.password), 5)
+            self.assertTrue(User.authenticate('testuser3', "HASHED_PASSWORD"))
+        finally:
+            passwords.rounds = rounds
@@ -7,8 +7,11 @@ from models import db, User, Race, User_Race, Training
 
 os.environ['DATABASE_URL'] = "postgresql:///runners_vision-test"
 
+from sqlalchemy import event
+
 from app import app
 from app import app, CURR_USER_KEY
+from identity import CLAIMS_KEY, remember, current_user
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
@@ -173,4 +176,45 @@ class UserViewTestCase(TestCase):
             self.assertNotIn('action="/user/edit"', html)
 
 
-            
\ No newline at end of file
+            
+
+
+    def test_identity_from_claims(self):
+        """Is the user row only queried when a view needs more than the claims"""
+        t1 = db.one_or_404(db.select(User).filter_by(username='testuser1'))
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.test_request_context():
+            remember(t1)
+            db.session.expunge_all()
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                user = current_user()
+                self.assertEqual((user.id, user.username, user.is_public), (t1.id, 'testuser1', True))
+                self.assertEqual(statements, [])
+
+                self.assertEqual(user.email, 'test1@test.com')
+                self.assertEqual(len(statements), 1)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+
+    def test_edit_refreshes_claims(self):
+        """Do edits reissue the session claims and deletes drop them"""
+        with self.client as c:
+            c.post('/login', data={'username': 'testuser1', 'password': 'HASHED_PASSWORD'})
+
+            c.post('/user/edit', data={'username': 'renamed', 'password': 'HASHED_PASSWORD',
+                                       'first_name': 'a', 'last_name': 'b', 'email': 'a@test.com'})
+            with c.session_transaction() as sess:
+                self.assertEqual(sess[CLAIMS_KEY]['username'], 'renamed')
+                self.assertFalse(sess[CLAIMS_KEY]['is_public'])
+
+            c.post('/user/delete')
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+                self.assertNotIn(CLAIMS_KEY, sess)
+            self.assertIsNone(db.session.execute(db.select(User).filter_by(username='renamed')).scalar())
@@ -0,0 +1,80 @@
+"""Streaming export of a user's races and trainings as CSV or NDJSON.
+
+Rows come off a server-side cursor (yield_per) a batch at a time and are
+encoded batch by batch into the response, so a long history is never held
+in memory. One line per training, plus one with empty training columns for
+each race without any.
+
+An export is not an import file as is: it covers all of the user's races,
+while an import goes into a single race, and the empty rows of races
+without trainings fail its "title is required" check. The training columns
+do match what training_import reads, so a race's trainings are re-imported
+by keeping the rows with its users_races_id and a title, and importing
+them into the target race (POST /race/<users_races_id>/trainings/import or
+`flask import-trainings`).
+"""
+
+import csv
+import io
+import json
+
+from models import db, Race, Training, User_Race
+
+
+COLUMNS = ('users_races_id', 'race', 'is_active', 'training_id', 'title', 'body', 'time_spent',
+           'type', 'distance', 'units', 'created_at')
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+BATCH = 1000
+
+
+def export_query(user_id):
+    """Every users_races row of user_id with its race name and trainings, oldest first"""
+
+    return (db.select(User_Race.id, Race.name, User_Race.is_active, Training.id, Training.title,
+                      Training.body, Training.time_spent, Training.type, Training.distance,
+                      Training.units, Training.created_at)
+            .join(Race, Race.id == User_Race.race_id)
+            .outerjoin(Training, Training.users_races_id == User_Race.id)
+            .where(User_Race.user_id == user_id)
+            .order_by(User_Race.id, Training.created_at, Training.id))
+
+
+def export_batches(user_id, batch=BATCH):
+    """Lists of up to batch export rows, read through a server-side cursor"""
+
+    result = db.session.execute(export_query(user_id).execution_options(yield_per=batch))
+    try:
+        yield from result.partitions()
+    finally:
+        # also reached when the client goes away mid-download
+        result.close()
+
+
+def csv_chunks(user_id):
+    """CSV text of the export, a header then one chunk per batch"""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue()
+
+    for rows in export_batches(user_id):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+# one encoder for every row; json.dumps(default=...) would build a new one per call
+_encoder = json.JSONEncoder(default=lambda value: value.isoformat())
+
+
+def ndjson_chunks(user_id):
+    """NDJSON text of the export, one chunk per batch"""
+
+    for rows in export_batches(user_id):
+        yield ''.join(_encoder.encode(dict(zip(COLUMNS, row))) + '\n' for row in rows)
+
+
+def export_chunks(user_id, format):
+    return csv_chunks(user_id) if format == 'csv' else ndjson_chunks(user_id)
@@ -0,0 +1,242 @@
+"""Bulk import of training history from CSV or NDJSON.
+
+Rows are parsed lazily from the upload, checked against TrainingForm's rules
+(and the trainings column sizes), and fed straight into a single
+`COPY trainings FROM STDIN`, so memory stays flat however large the file is.
+COPY skips the ORM, so the race's rollups are rebuilt afterwards in the same
+transaction; a bad row rolls the whole import back.
+
+Columns: title, body, time_spent, type, distance, units and optionally
+created_at (ISO date or datetime). Only title is required.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from math import isfinite
+
+from wtforms.validators import DataRequired, InputRequired, Length
+
+from forms import TrainingForm
+from models import db, Training, User_Race
+from page_cache import touch
+from training_stats import rebuild_totals, rebuild_weekly
+
+
+COLUMNS = ('users_races_id', 'title', 'body', 'time_spent', 'type', 'distance', 'units', 'created_at')
+FORMATS = ('csv', 'ndjson')
+# bytes handed to COPY per read()
+COPY_CHUNK = 1 << 16
+# COPY text format escapes
+ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+class TrainingImportError(ValueError):
+    """A row that TrainingForm would reject"""
+
+    def __init__(self, line, message):
+        super().__init__(f'line {line}: {message}')
+        self.line = line
+
+
+NULL = '\\N'
+# Postgres integer
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+NUMBER_FIELDS = ('IntegerField', 'FloatField')
+
+
+def _escape(value):
+    """value in COPY text format; most values have nothing to escape, and isprintable() is cheaper than translate()"""
+
+    if '\\' in value or not value.isprintable():
+        return value.translate(ESCAPES)
+    return value
+
+
+def _checker(name, kind, required, max_length, choices, default):
+    """Function turning one raw value of a TrainingForm field into its COPY text"""
+
+    missing = NULL if default is None else _escape(str(default))
+
+    # picked once per field, so a row costs one call per column
+    if kind == 'IntegerField':
+        def convert(value, line):
+            try:
+                number = int(value)
+            except (TypeError, ValueError):
+                raise TrainingImportError(line, f'{name} must be a whole number')
+            if not INT_MIN <= number <= INT_MAX:
+                raise TrainingImportError(line, f'{name} is out of range')
+            return str(number)
+    elif kind == 'FloatField':
+        def convert(value, line):
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                raise TrainingImportError(line, f'{name} must be a number')
+            # nan would turn every rollup it is summed into nan
+            if not isfinite(number):
+                raise TrainingImportError(line, f'{name} must be a finite number')
+            return repr(number)
+    elif choices is not None:
+        def convert(value, line):
+            # choices are plain words, nothing to escape
+            if value not in choices:
+                raise TrainingImportError(line, f'{name} must be one of {", ".join(sorted(choices))}')
+            return value
+    else:
+        def convert(value, line):
+            if max_length and len(value) > max_length:
+                raise TrainingImportError(line, f'{name} is longer than {max_length} characters')
+            return _escape(value)
+
+    def check(value, line):
+        if value.__class__ is str:
+            value = value.strip()
+        elif value is not None and kind not in NUMBER_FIELDS:
+            value = str(value)
+        if value is None or value == '':
+            if required:
+                raise TrainingImportError(line, f'{name} is required')
+            return missing
+
+        return convert(value, line)
+
+    return check
+
+
+def _check_created_at(value, line):
+    if not value:
+        return datetime.utcnow().isoformat()
+    try:
+        return datetime.fromisoformat(str(value).strip()).isoformat()
+    except ValueError:
+        raise TrainingImportError(line, 'created_at must be an ISO date')
+
+
+def _checks():
+    """(column, checker) per imported column, with the rules read off TrainingForm's fields"""
+
+    checks = []
+    for name in COLUMNS[1:-1]:
+        field = getattr(TrainingForm, name)
+        validators = field.kwargs.get('validators', [])
+        lengths = [v.max for v in validators if isinstance(v, Length) and v.max != -1]
+        column = Training.__table__.c[name].type
+        lengths += [column.length] if getattr(column, 'length', None) else []
+        checks.append((name, _checker(name,
+                                      field.field_class.__name__,
+                                      any(isinstance(v, (DataRequired, InputRequired)) for v in validators),
+                                      min(lengths) if lengths else None,
+                                      frozenset(field.kwargs['choices']) if 'choices' in field.kwargs else None,
+                                      field.kwargs.get('default'))))
+    checks.append(('created_at', _check_created_at))
+
+    return checks
+
+
+CHECKS = _checks()
+
+
+def copy_line(users_races_id, row, line):
+    """A parsed row as a line of COPY text, raising TrainingImportError where the form would fail"""
+
+    get = row.get
+    return f'{users_races_id}\t' + '\t'.join([check(get(name), line) for name, check in CHECKS]) + '\n'
+
+
+def parse_csv(stream):
+    """Rows of a CSV upload (binary stream with a header line), with line numbers"""
+
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    header = [name.strip() for name in next(reader, [])]
+    for values in reader:
+        if values:
+            yield reader.line_num, dict(zip(header, values))
+
+
+def parse_ndjson(stream):
+    """Rows of an NDJSON upload (one object per line), with line numbers"""
+
+    for line, text in enumerate(io.TextIOWrapper(stream, encoding='utf-8-sig'), 1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError:
+            raise TrainingImportError(line, 'not valid JSON')
+        if not isinstance(row, dict):
+            raise TrainingImportError(line, 'expected an object')
+        yield line, row
+
+
+class CopySource:
+    """File-like view of validated rows in COPY text format, read by psycopg2 in chunks"""
+
+    def __init__(self, users_races_id, rows):
+        self.lines = (copy_line(users_races_id, row, line) for line, row in rows)
+        self.buffer = ''
+        self.count = 0
+        self.error = None
+
+    def read(self, size=COPY_CHUNK):
+        try:
+            parts = [self.buffer]
+            length = len(self.buffer)
+            for copy_line in self.lines:
+                parts.append(copy_line)
+                length += len(copy_line)
+                self.count += 1
+                if length >= size:
+                    break
+        except TrainingImportError as e:
+            # psycopg2 only reports that read() failed; keep the real reason
+            self.error = e
+            raise
+        data = ''.join(parts)
+        self.buffer = data[size:]
+
+        return data[:size]
+
+    readline = read
+
+
+def import_trainings(users_races_id, stream, format):
+    """Imports a CSV or NDJSON stream of trainings into one race. Returns the number of rows.
+
+    Runs in the current transaction; the caller commits. Raises
+    TrainingImportError for the first invalid row."""
+
+    u_r = db.session.get(User_Race, users_races_id)
+    rows = parse_csv(stream) if format == 'csv' else parse_ndjson(stream)
+    source = CopySource(users_races_id, rows)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY trainings ({', '.join(COLUMNS)}) FROM STDIN", source, COPY_CHUNK)
+    except Exception:
+        if source.error:
+            raise source.error
+        raise
+    finally:
+        cursor.close()
+
+    rebuild_totals(users_races_id)
+    rebuild_weekly(u_r.user_id)
+    touch(u_r.user_id)
+
+    return source.count
+
+
+def format_for(filename, content_type=None):
+    """'csv' or 'ndjson' from an upload's name or content type, else None"""
+
+    name = (filename or '').lower()
+    content_type = (content_type or '').lower()
+    if name.endswith('.csv') or 'csv' in content_type:
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl')) or 'ndjson' in content_type or 'jsonl' in content_type:
+        return 'ndjson'
+
+    return None
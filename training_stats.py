@@ -0,0 +1,191 @@
+"""Training rollups.
+
+training_totals holds one row per (users_races_id, type) and weekly_mileage
+one row per (user_id, type, ISO week), each with distance in miles, minutes
+and session count. Mapper events apply each training insert, edit and delete
+to both inside the same flush, so they commit or roll back together with the
+training itself and readers get a handful of indexed rows instead of
+aggregating every training.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Training, TrainingTotal, User_Race, WeeklyMileage, training_owner
+
+
+METERS_PER_MILE = 1609
+KM_PER_MILE = 1.609
+
+
+def week_start(when):
+    """Monday of the ISO week when falls in"""
+
+    day = when.date() if isinstance(when, datetime) else when
+
+    return day - timedelta(days=day.weekday())
+
+
+def miles_expr(distance, units):
+    """SQL expression converting distance in units to miles, rounded to 3 places.
+
+    Used both for single trainings and for rebuilds so the two always agree."""
+
+    d = db.cast(db.func.coalesce(distance, 0), db.Numeric)
+
+    return db.func.round(db.case((units == 'meters', d / METERS_PER_MILE),
+                                 (units == 'km', d / KM_PER_MILE),
+                                 else_=d), 3)
+
+
+def _apply_total(conn, t, sign):
+    """Adds (sign=1) or removes (sign=-1) one training from its race totals row"""
+
+    miles = miles_expr(db.literal(t['distance'], db.Float), db.literal(t['units'], db.String))
+    stmt = insert(TrainingTotal).values(users_races_id=t['users_races_id'], type=t['type'],
+                                        miles=sign * miles,
+                                        minutes=sign * (t['time_spent'] or 0),
+                                        sessions=sign)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TrainingTotal.users_races_id, TrainingTotal.type],
+        set_={'miles': TrainingTotal.miles + stmt.excluded.miles,
+              'minutes': TrainingTotal.minutes + stmt.excluded.minutes,
+              'sessions': TrainingTotal.sessions + stmt.excluded.sessions})
+    conn.execute(stmt)
+
+
+def _apply_weekly(conn, t, sign, user_id):
+    """Adds (sign=1) or removes (sign=-1) one training from its user's weekly bucket"""
+
+    if user_id is None:
+        return
+
+    miles = miles_expr(db.literal(t['distance'], db.Float), db.literal(t['units'], db.String))
+    stmt = insert(WeeklyMileage).values(user_id=user_id, type=t['type'], week_start=week_start(t['created_at']),
+                                        miles=sign * miles,
+                                        minutes=sign * (t['time_spent'] or 0),
+                                        sessions=sign)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[WeeklyMileage.user_id, WeeklyMileage.type, WeeklyMileage.week_start],
+        set_={'miles': WeeklyMileage.miles + stmt.excluded.miles,
+              'minutes': WeeklyMileage.minutes + stmt.excluded.minutes,
+              'sessions': WeeklyMileage.sessions + stmt.excluded.sessions})
+    conn.execute(stmt)
+
+
+def _apply(conn, t, sign, user_id):
+    _apply_total(conn, t, sign)
+    _apply_weekly(conn, t, sign, user_id)
+
+
+TRACKED = ('users_races_id', 'type', 'distance', 'units', 'time_spent', 'created_at')
+
+
+def _values(t, previous=False):
+    """Fields of a training, as they were before the pending update if previous"""
+
+    if not previous:
+        return {f: getattr(t, f) for f in TRACKED}
+
+    state = inspect(t)
+    values = {}
+    for f in TRACKED:
+        history = state.attrs[f].history
+        values[f] = history.deleted[0] if history.deleted else getattr(t, f)
+
+    return values
+
+
+def _keep_previous(target, value, oldvalue, initiator):
+    pass
+
+
+# make assignments load the old value, even on an expired instance, so updates can retract it
+for f in TRACKED:
+    event.listen(getattr(Training, f), 'set', _keep_previous, active_history=True)
+
+
+@event.listens_for(Training, 'after_insert')
+def training_inserted(mapper, conn, t):
+    values = _values(t)
+    _apply(conn, values, 1, training_owner(conn, inspect(t).session, values['users_races_id'], t.id))
+
+
+@event.listens_for(Training, 'after_update')
+def training_updated(mapper, conn, t):
+    state = inspect(t)
+    if not any(state.attrs[f].history.has_changes() for f in TRACKED):
+        # a title or notes edit leaves both rollups as they are
+        return
+
+    previous, values = _values(t, previous=True), _values(t)
+    _apply(conn, previous, -1, training_owner(conn, state.session, previous['users_races_id']))
+    _apply(conn, values, 1, training_owner(conn, state.session, values['users_races_id'], t.id))
+
+
+@event.listens_for(Training, 'after_delete')
+def training_deleted(mapper, conn, t):
+    values = _values(t)
+    _apply(conn, values, -1, training_owner(conn, inspect(t).session, values['users_races_id'], t.id))
+
+
+def training_totals(users_races_id):
+    """{type: TrainingTotal} for one race"""
+
+    rows = db.session.execute(db.select(TrainingTotal).filter_by(users_races_id=users_races_id)).scalars()
+
+    return {t.type: t for t in rows}
+
+
+def weekly_mileage(user_id, start, end, type=None):
+    """Weekly buckets for a user with start <= week_start <= end, oldest first"""
+
+    q = (db.select(WeeklyMileage)
+         .filter(WeeklyMileage.user_id == user_id,
+                 WeeklyMileage.week_start.between(week_start(start), end),
+                 WeeklyMileage.sessions > 0))
+    if type:
+        q = q.filter(WeeklyMileage.type == type)
+
+    return db.session.execute(q.order_by(WeeklyMileage.week_start, WeeklyMileage.type)).scalars().all()
+
+
+def rebuild_totals(users_races_id=None):
+    """Recomputes race totals from trainings, for one race or all of them"""
+
+    delete = db.delete(TrainingTotal)
+    totals = (db.select(Training.users_races_id, Training.type,
+                        db.func.sum(miles_expr(Training.distance, Training.units)),
+                        db.func.sum(db.func.coalesce(Training.time_spent, 0)),
+                        db.func.count())
+              .group_by(Training.users_races_id, Training.type))
+    if users_races_id is not None:
+        delete = delete.filter_by(users_races_id=users_races_id)
+        totals = totals.filter(Training.users_races_id == users_races_id)
+
+    db.session.execute(delete)
+    db.session.execute(insert(TrainingTotal).from_select(
+        ['users_races_id', 'type', 'miles', 'minutes', 'sessions'], totals))
+
+
+def rebuild_weekly(user_id=None):
+    """Recomputes weekly buckets from trainings, for one user or all of them"""
+
+    # date_trunc('week') is the ISO week's Monday, same as week_start()
+    week = db.cast(db.func.date_trunc('week', Training.created_at), db.Date)
+    delete = db.delete(WeeklyMileage)
+    weekly = (db.select(User_Race.user_id, Training.type, week,
+                        db.func.sum(miles_expr(Training.distance, Training.units)),
+                        db.func.sum(db.func.coalesce(Training.time_spent, 0)),
+                        db.func.count())
+              .join(User_Race, User_Race.id == Training.users_races_id)
+              .group_by(User_Race.user_id, Training.type, week))
+    if user_id is not None:
+        delete = delete.filter_by(user_id=user_id)
+        weekly = weekly.filter(User_Race.user_id == user_id)
+
+    db.session.execute(delete)
+    db.session.execute(insert(WeeklyMileage).from_select(
+        ['user_id', 'type', 'week_start', 'miles', 'minutes', 'sessions'], weekly))
@@ -0,0 +1,226 @@
+"""GPX track ingest for trainings.
+
+Track points are stream-parsed with iterparse (end events only) into flat
+arrays, and each point is emptied as it closes, so the element tree keeps
+one empty element per point rather than the document. Point times are
+converted to epoch seconds in numpy batches. Distance and moving
+time come from a vectorized haversine over the full track; only the
+Douglas-Peucker simplified points are kept, packed into a single
+training_tracks row (see TrainingTrack).
+"""
+
+import math
+import xml.etree.ElementTree as ET
+from array import array
+from datetime import datetime, timezone
+
+import numpy as np
+
+from models import TrainingTrack
+from training_stats import METERS_PER_MILE
+
+
+EARTH_RADIUS_M = 6371008.8
+# slower than this between two points counts as stopped (about 1.1 mph)
+MOVING_SPEED = 0.5
+DEFAULT_TOLERANCE_M = 5
+# point times converted per numpy call
+TIME_BATCH = 4096
+METERS_PER_UNIT = {'miles': METERS_PER_MILE, 'km': 1000, 'meters': 1}
+
+
+class TrackError(ValueError):
+    """Not a usable GPX track"""
+
+
+def _epoch(text):
+    when = datetime.fromisoformat(text.strip())
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+
+    return when.timestamp()
+
+
+def _epochs(times):
+    """Epoch seconds of ISO times, NaN where missing.
+
+    GPX times are UTC ('...Z'), which numpy parses in one go; a track with
+    offsets or no zone falls back to _epoch per point."""
+
+    if all(times) and all(w[-1] == 'Z' for w in times):
+        try:
+            return np.array([w[:-1] for w in times], dtype='datetime64[us]').astype(np.int64) / 1e6
+        except ValueError:
+            pass
+
+    return np.array([_epoch(w) if w else math.nan for w in times], dtype=float)
+
+
+def parse_gpx(stream):
+    """lat, lon, elevation and epoch seconds arrays of every trkpt in a GPX stream.
+
+    Missing elevations and times are NaN. Works for GPX 1.0 and 1.1 (any namespace)."""
+
+    lat, lon, ele, t, times = array('d'), array('d'), array('d'), array('d'), []
+    nan = float('nan')
+    trkpt = None
+    point_ele = point_time = None
+
+    try:
+        # end events only: a point's <ele> and <time> close before the point does
+        for _, elem in ET.iterparse(stream):
+            tag = elem.tag
+            if trkpt is None:
+                # the first element to close is inside <gpx>, whose namespace every tag shares
+                ns = tag[:tag.index('}') + 1] if tag[0] == '{' else ''
+                trkseg, trkpt, ele_tag, time_tag = ns + 'trkseg', ns + 'trkpt', ns + 'ele', ns + 'time'
+                others = {ns + 'wpt', ns + 'rtept', ns + 'metadata'}
+
+            if tag == ele_tag:
+                point_ele = elem.text
+            elif tag == time_tag:
+                point_time = elem.text
+            elif tag == trkpt:
+                lat.append(float(elem.get('lat')))
+                lon.append(float(elem.get('lon')))
+                ele.append(float(point_ele) if point_ele else nan)
+                times.append(point_time.strip() if point_time else None)
+                point_ele = point_time = None
+                # finished points are emptied so memory doesn't grow with the file
+                elem.clear()
+                if len(times) == TIME_BATCH:
+                    t.extend(_epochs(times))
+                    times.clear()
+            elif tag == trkseg:
+                # and so are segments, taking the emptied points with them
+                elem.clear()
+            elif tag in others:
+                # their <ele>/<time> aren't a track point's
+                point_ele = point_time = None
+        t.extend(_epochs(times))
+    except ET.ParseError as e:
+        raise TrackError(f'not a GPX file: {e}')
+    except (TypeError, ValueError) as e:
+        raise TrackError(f'bad track point: {e}')
+
+    if len(lat) < 2:
+        raise TrackError('the file has fewer than two track points')
+
+    return (np.frombuffer(lat), np.frombuffer(lon), np.frombuffer(ele), np.frombuffer(t))
+
+
+def haversine(lat, lon):
+    """Meters between each pair of consecutive points"""
+
+    phi, lam = np.radians(lat), np.radians(lon)
+    a = (np.sin(np.diff(phi) / 2) ** 2
+         + np.cos(phi[:-1]) * np.cos(phi[1:]) * np.sin(np.diff(lam) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def moving_seconds(segments, t):
+    """Seconds spent moving faster than MOVING_SPEED, or None without timestamps"""
+
+    dt = np.diff(t)
+    timed = np.isfinite(dt) & (dt > 0)
+    if not timed.any():
+        return None
+    moving = timed & (segments >= MOVING_SPEED * np.where(timed, dt, 0))
+
+    return float(dt[moving].sum())
+
+
+def douglas_peucker(lat, lon, tolerance):
+    """Boolean mask of the points Douglas-Peucker keeps at tolerance meters"""
+
+    # local equirectangular projection is plenty at track scale
+    y = np.radians(lat - lat[0]) * EARTH_RADIUS_M
+    x = np.radians(lon - lon[0]) * EARTH_RADIUS_M * np.cos(np.radians(lat.mean()))
+    # endpoints as python floats; numpy scalar arithmetic is slow
+    xs, ys = x.tolist(), y.tolist()
+
+    keep = np.zeros(len(lat), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(lat) - 1)] if len(lat) > 2 else []
+    while stack:
+        start, end = stack.pop()
+        x0, y0 = xs[start], ys[start]
+        dx, dy = xs[end] - x0, ys[end] - y0
+        length = math.hypot(dx, dy)
+        px, py = x[start + 1:end] - x0, y[start + 1:end] - y0
+        if length:
+            # cross product = distance from the line * length
+            distance = np.abs(px * dy - py * dx)
+            limit = tolerance * length
+        else:
+            # closed loop: distance from the shared end point
+            distance = np.hypot(px, py)
+            limit = tolerance
+
+        i = int(distance.argmax())
+        if distance[i] > limit:
+            split = start + 1 + i
+            keep[split] = True
+            if split - start > 1:
+                stack.append((start, split))
+            if end - split > 1:
+                stack.append((split, end))
+
+    return keep
+
+
+def build_track(stream, tolerance=DEFAULT_TOLERANCE_M):
+    """TrainingTrack for a GPX stream, with totals from every point and the simplified points packed"""
+
+    lat, lon, ele, t = parse_gpx(stream)
+    segments = haversine(lat, lon)
+    keep = douglas_peucker(lat, lon, tolerance)
+
+    timed = np.isfinite(t)
+    started = t[timed][0] if timed.any() else None
+    moving = moving_seconds(segments, t)
+    track = TrainingTrack(
+        started_at=(datetime.fromtimestamp(started, timezone.utc).replace(tzinfo=None)
+                    if started is not None else None),
+        distance_m=float(segments.sum()),
+        moving_seconds=round(moving) if moving is not None else None,
+        elapsed_seconds=round(float(t[timed][-1] - started)) if started is not None else None,
+        point_count=len(lat),
+        lat_e7=np.round(lat[keep] * 1e7).astype('<i4').tobytes(),
+        lon_e7=np.round(lon[keep] * 1e7).astype('<i4').tobytes(),
+    )
+    if np.isfinite(ele).any():
+        track.elevation = ele[keep].astype('<f4').tobytes()
+    if started is not None:
+        track.seconds = np.round(np.where(timed, t - started, -1)[keep]).astype('<i4').tobytes()
+
+    return track
+
+
+def track_points(track):
+    """(lat, lon, elevation, seconds) numpy arrays of a stored track; the last two may be None.
+
+    Points without a time have seconds -1."""
+
+    return (np.frombuffer(track.lat_e7, '<i4') / 1e7,
+            np.frombuffer(track.lon_e7, '<i4') / 1e7,
+            np.frombuffer(track.elevation, '<f4') if track.elevation else None,
+            np.frombuffer(track.seconds, '<i4') if track.seconds else None)
+
+
+def attach_track(training, stream, tolerance=DEFAULT_TOLERANCE_M):
+    """Attaches a GPX track to training and fills in its distance, time and date from it.
+
+    Distance is given in the training's units (miles if unset)."""
+
+    track = build_track(stream, tolerance)
+    training.track = track
+    training.units = training.units or 'miles'
+    training.distance = round(track.distance_m / METERS_PER_UNIT[training.units], 2)
+    if track.moving_seconds is not None:
+        training.time_spent = round(track.moving_seconds / 60)
+    if track.started_at is not None:
+        training.created_at = track.started_at
+
+    return track